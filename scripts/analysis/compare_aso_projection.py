@@ -6,10 +6,20 @@ Methods:
 1. Use dem geoid.
 2. Use Gdal
 3. Use gdal with proj strings
+
+Stats of the files are accumulated block by block, the ASO depths already in
+the database is described over the same area by PostGIS so none of its
+pixels are transferred.
 '''
 
 from subprocess import check_output
 
+import rasterio
+
+from snowexsql.analysis import StatsAccumulator, get_stats
+from snowexsql.db import get_db
+from snowexsql.raster import get_raster_stats
+
 in_file = '/home/micah/Downloads/ASO2016-17-20200918T212934Z-001/ASO2016-17/USCOGM20160926f1a1__lowest_vf_snowEX_extent.tif'
 
 
@@ -35,6 +45,18 @@ out_proj = 'EPSG:26912+5703'
 check_output('gdalwarp -s_srs "{}" -t_srs "{}" {} method4.tif'.format(in_proj,
                                                                       out_proj, in_file), shell=True)
 
+
+def file_stats(f):
+    """
+    Stats of the first band of a file read a block at a time
+    """
+    stats = StatsAccumulator()
+    with rasterio.open(f) as ds:
+        for _, window in ds.block_windows(1):
+            stats.update(ds.read(1, window=window, masked=True).compressed())
+    return stats
+
+
 print('Performing Stats...')
 for i in range(0, 5):
     if i == 0:
@@ -43,7 +65,14 @@ for i in range(0, 5):
     else:
         print('Method {}:'.format(i))
         f = 'method{}.tif'.format(i)
-    s = check_output('gdalinfo -stats {} | grep STAT'.format(f), shell=True)
-    s = s.decode('utf-8')
-    print(s)
+    stats = file_stats(f)
+    get_stats(stats)
     print('\n')
+
+print('Database:')
+engine, session = get_db('snowex')
+with rasterio.open('method4.tif') as ds:
+    bbox = tuple(ds.bounds)
+get_stats(get_raster_stats(session, bbox=bbox, type='depth',
+                           surveyors='ASO Inc.', max_workers=4))
+session.close()
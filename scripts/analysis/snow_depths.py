@@ -1,49 +1,17 @@
 '''
 '''
 
-import geoalchemy2.functions as gfunc
 import geopandas as gpd
 import matplotlib.pyplot as plt
-import progressbar
-from geoalchemy2.shape import from_shape, to_shape
-from geoalchemy2.types import Raster
-from shapely.geometry import Point, Polygon
-from sqlalchemy.sql import func
 
 from snowexsql.analysis import *
 from snowexsql.conversions import query_to_geopandas
 from snowexsql.data import *
 from snowexsql.db import get_db
+from snowexsql.raster import sample_rasters
 from snowexsql.utilities import get_logger
 
 
-def get_raster_value(session, point, surveyor, date=None):
-    '''
-    Grab the raster tiles that fall into the polygon. Resample. Attempt to get
-    raster value
-    '''
-
-    # Filter by surveyors and data name DEM
-    q = session.query(
-        func.ST_Value(
-            ImageData.raster,
-            1,
-            point)).filter(
-        ImageData.type == 'DEM')
-    q = q.filter(ImageData.surveyors == surveyor)
-
-    if date is not None:
-        q = q.filter(ImageData.date == date)
-
-    q = q.filter(gfunc.ST_Within(point, func.ST_Envelope(ImageData.raster)))
-    value = q.all()
-
-    if len(value) >= 1:
-        return value[0][0]
-    else:
-        return None
-
-
 def main():
 
     # Grab the db session
@@ -57,48 +25,22 @@ def main():
     dates = session.query(ImageData.date).filter(
         ImageData.surveyors == 'QSI').distinct().all()
 
-    # Build an empy dataframe fro storing our results in
-    results = gpd.GeoDataFrame(
-        columns=[
-            'geometry',
-            'aso',
-            'usgs',
-            'measured',
-            'date'])
-
     # Grab all depths and dates.
     q = session.query(PointData)
     q = q.filter(PointData.type == 'depth')
     df = query_to_geopandas(q, engine)
     log.info('Found {} snow depths...'.format(len(df)))
 
-    bar = progressbar.ProgressBar(max_value=len(df.index))
-
-    # Loop over all the points
-    for i, row in df.iterrows():
-
-        # Create an empty dict and add geometryand date for each point
-        data = {}
-        data['measured'] = row['value']
-        data['geometry'] = row['geom']
-        data['date'] = row['date']
-
-        point = from_shape(row['geom'], srid=26912).ST_AsEWKT()
-
-        # Get the raster value of a cell nearest center after resampling to the
-        # resolution
-        snow = get_raster_value(session, point, 'QSI', date=dates[0][0])
-
-        for surveyor in surveyors:
-            off = get_raster_value(session, point, surveyor.upper())
+    # Sample the snow on and snow off DEMs at every point in one pass
+    selections = [dict(type='DEM', surveyors='QSI', date=dates[0][0])]
+    selections += [dict(type='DEM', surveyors=s.upper()) for s in surveyors]
+    snow, *offs = sample_rasters(session, df, selections=selections, srid=26912)
 
-            if off is None or snow is None:
-                data[surveyor] = None
-            else:
-                data[surveyor] = (snow - off) * 100  # cm
+    results = gpd.GeoDataFrame({'measured': df['value'], 'date': df['date']},
+                               geometry=df['geom'].values)
 
-        results = results.append(data, ignore_index=True)
-        bar.update(i)
+    for surveyor, off in zip(surveyors, offs):
+        results[surveyor] = (snow - off) * 100  # cm
 
     session.close()
 
@@ -0,0 +1,77 @@
+'''
+Compare the throughput of N concurrent per site queries run on a thread
+pool with psycopg2 against the same queries run on one event loop with
+asyncpg.
+
+Usage:
+    python bench_async.py <db_name> [concurrency] [rounds]
+'''
+import asyncio
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.orm import Session
+
+from snowexsql import aio
+from snowexsql.conversions import query_to_pandas
+from snowexsql.data import LayerData
+from snowexsql.db import get_db, get_engine
+
+
+def site_query(session, site_id):
+    return session.query(LayerData.depth, LayerData.type, LayerData.value).filter(
+        LayerData.site_id == site_id)
+
+
+def run_threads(db_name, queries, concurrency):
+    engine = get_engine(db_name, pool_size=concurrency, max_overflow=0)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda q: query_to_pandas(q, engine), queries))
+
+
+async def run_async(db_name, queries, concurrency):
+    engine = aio.get_async_engine(db_name, pool_size=concurrency, max_overflow=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(q):
+        async with semaphore:
+            return await aio.query_to_pandas(q, engine)
+
+    try:
+        return await asyncio.gather(*[one(q) for q in queries])
+    finally:
+        await aio.dispose_async_engines()
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'snowex'
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    rounds = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+
+    engine, session = get_db(db_name)
+    sites = [s[0] for s in session.query(LayerData.site_id).distinct()]
+    session.close()
+
+    queries = [site_query(Session(), s) for s in sites] * rounds
+    print('{:,} queries over {} sites, {} in flight'.format(
+        len(queries), len(sites), concurrency))
+
+    # Warm up both pools
+    run_threads(db_name, queries[:concurrency], concurrency)
+
+    start = time.perf_counter()
+    run_threads(db_name, queries, concurrency)
+    t_threads = time.perf_counter() - start
+
+    start = time.perf_counter()
+    asyncio.run(run_async(db_name, queries, concurrency))
+    t_async = time.perf_counter() - start
+
+    print('threads: {:0.0f} queries/s, asyncio: {:0.0f} queries/s'.format(
+        len(queries) / t_threads, len(queries) / t_async))
+
+
+if __name__ == '__main__':
+    main()
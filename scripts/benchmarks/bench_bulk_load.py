@@ -0,0 +1,62 @@
+'''
+Compare the rows per second of loading point data with COPY against adding
+the same rows through the ORM. The gpr test file is repeated to make a file
+large enough to time.
+
+Usage:
+    python bench_bulk_load.py <db_name> [repeats]
+'''
+import sys
+import tempfile
+import time
+from os.path import dirname, join
+
+import pandas as pd
+from geoalchemy2.elements import WKBElement
+
+from snowexsql.data import PointData
+from snowexsql.db import get_db
+from snowexsql.load import load_points, read_point_csv
+
+DATA = join(dirname(__file__), '../../tests/data/gpr.csv')
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'test'
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    engine, session = get_db(db_name)
+
+    df = pd.read_csv(DATA)
+    big = pd.concat([df] * repeats, ignore_index=True)
+
+    with tempfile.NamedTemporaryFile(suffix='.csv') as f:
+        big.to_csv(f.name, index=False)
+
+        stats = load_points(engine, f.name, site_name='bench_copy')
+
+        # The ORM path gets the same parsed rows, only the insert differs
+        columns = set(PointData.__table__.columns.keys())
+        start = time.perf_counter()
+        rows = 0
+        for batch in read_point_csv(f.name, site_name='bench_orm'):
+            batch = batch[[c for c in batch.columns if c in columns]]
+            batch = batch.astype(object).where(batch.notna(), None)
+            batch['geom'] = [WKBElement(g, extended=True) for g in batch['geom']]
+            session.add_all([PointData(**r) for r in batch.to_dict('records')])
+            session.commit()
+            rows += len(batch)
+        t_orm = time.perf_counter() - start
+
+    print('{:,} rows, COPY: {:0.0f} rows/s, ORM: {:0.0f} rows/s'.format(
+        rows, stats['rows_per_sec'], rows / t_orm))
+
+    session.query(PointData).filter(
+        PointData.site_name.in_(['bench_copy', 'bench_orm'])).delete(
+        synchronize_session=False)
+    session.commit()
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+'''
+Compare reading a large select with pandas.read_sql against reading it with
+binary COPY.
+
+Usage:
+    python bench_copy.py <db_name> [limit]
+'''
+import sys
+import time
+
+from snowexsql.conversions import query_to_geopandas, query_to_pandas
+from snowexsql.data import LayerData, PointData
+from snowexsql.db import get_db
+
+
+def timeit(fn, *args, **kwargs):
+    start = time.perf_counter()
+    df = fn(*args, **kwargs)
+    return time.perf_counter() - start, len(df)
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'snowex'
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+    engine, session = get_db(db_name)
+
+    queries = {
+        'points (pandas)': (query_to_pandas, session.query(PointData).limit(limit)),
+        'points (geopandas)': (query_to_geopandas, session.query(PointData).limit(limit)),
+        'layers (pandas)': (query_to_pandas, session.query(LayerData).limit(limit)),
+    }
+
+    for name, (fn, qry) in queries.items():
+        t_sql, n = timeit(fn, qry, engine)
+        t_copy, n = timeit(fn, qry, engine, copy=True)
+        print('{}: {:,} rows, read_sql {:0.2f}s, copy {:0.2f}s, {:0.1f}x'
+              ''.format(name, n, t_sql, t_copy, t_sql / t_copy))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
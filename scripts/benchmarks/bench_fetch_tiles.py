@@ -0,0 +1,45 @@
+'''
+Time fetching and decoding every tile of a raster serially and with a
+growing number of pooled connections.
+
+Usage:
+    python bench_fetch_tiles.py <db_name> [surveyors]
+'''
+import sys
+import time
+
+from sqlalchemy import func
+
+from snowexsql.data import ImageData
+from snowexsql.db import get_db
+from snowexsql.raster import fetch_tiles, filter_images, raster_from_wkb
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'snowex'
+    surveyors = sys.argv[2] if len(sys.argv) > 2 else 'USGS'
+    engine, session = get_db(db_name)
+
+    q = filter_images(session.query(ImageData.id), type='DEM',
+                      surveyors=surveyors)
+    ids = [r[0] for r in q.all()]
+    print('Fetching {} tiles...'.format(len(ids)))
+
+    start = time.perf_counter()
+    q = session.query(func.ST_AsBinary(ImageData.raster)).filter(
+        ImageData.id.in_(ids))
+    tiles = [raster_from_wkb(r[0]) for r in q.all()]
+    serial = time.perf_counter() - start
+    print('Single query: {:0.2f}s'.format(serial))
+
+    for workers in [1, 2, 4, 8]:
+        start = time.perf_counter()
+        tiles = fetch_tiles(engine, ids, max_workers=workers)
+        dt = time.perf_counter() - start
+        print('{} workers: {:0.2f}s ({:0.1f}x)'.format(workers, dt, serial / dt))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
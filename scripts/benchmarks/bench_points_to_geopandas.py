@@ -0,0 +1,78 @@
+'''
+Compare the columnar points_to_geopandas against the original loop over
+every row and every attribute. No database is needed, records are built in
+memory.
+
+Usage:
+    python bench_points_to_geopandas.py [number of points]
+'''
+import sys
+import time
+
+import geopandas as gpd
+from geoalchemy2.shape import from_shape, to_shape
+from shapely.geometry import Point
+from sqlalchemy import inspect
+
+from snowexsql.conversions import points_to_geopandas
+from snowexsql.data import PointData
+
+
+def points_to_geopandas_loop(results):
+    '''
+    The original row by row, attribute by attribute conversion
+    '''
+    data = {a: [] for a in dir(PointData) if a[0:1] != '_' and a not in
+            ['metadata', 'registry']}
+
+    for r in results:
+        for k in data.keys():
+            v = getattr(r, k)
+
+            if k == 'geom':
+                v = to_shape(v)
+            data[k].append(v)
+
+    df = gpd.GeoDataFrame(data, geometry=data['geom'])
+    return df
+
+
+def make_records(n):
+    # Records loaded from the db have every column populated
+    columns = [c.key for c in inspect(PointData).column_attrs]
+    records = []
+    for i in range(n):
+        values = dict.fromkeys(columns)
+        values.update(
+            id=i, type='depth', value=float(i % 300), easting=743000.0 + i,
+            northing=4324500.0 + i, site_name='Grand Mesa', units='cm',
+            geom=from_shape(Point(743000 + i, 4324500 + i), srid=26912))
+        records.append(PointData(**values))
+    return records
+
+
+def timeit(fn, records, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(records)
+        dt = time.perf_counter() - start
+        best = dt if best is None else min(best, dt)
+    return best
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('Building {:,} records...'.format(n))
+    records = make_records(n)
+
+    loop = timeit(points_to_geopandas_loop, records)
+    columnar = timeit(points_to_geopandas, records)
+
+    print('Loop:     {:0.3f}s ({:,.0f} rows/s)'.format(loop, n / loop))
+    print('Columnar: {:0.3f}s ({:,.0f} rows/s)'.format(columnar, n / columnar))
+    print('Speedup:  {:0.1f}x'.format(loop / columnar))
+
+
+if __name__ == '__main__':
+    main()
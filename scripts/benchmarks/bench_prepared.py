@@ -0,0 +1,84 @@
+'''
+Measure the per call overhead of running a small parameterized lookup many
+times. Compares compiling the statement from scratch every call against the
+cached compiled form, then if a database is given times the full round trip
+with read_sql against server side prepared statements.
+
+Usage:
+    python bench_prepared.py [db_name] [calls]
+'''
+import sys
+import time
+
+import geoalchemy2.functions as gfunc
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from snowexsql.conversions import query_to_pandas
+from snowexsql.data import ImageData
+from snowexsql.db import get_db
+from snowexsql.statements import prepare_query
+
+
+def raster_value_query(session, x, y):
+    '''
+    Same lookup as get_raster_value in scripts/analysis/snow_depths.py
+    '''
+    point = func.ST_GeomFromEWKT('SRID=26912;POINT({} {})'.format(x, y))
+    q = session.query(func.ST_Value(ImageData.raster, 1, point))
+    q = q.filter(ImageData.type == 'DEM', ImageData.surveyors == 'QSI')
+    q = q.filter(gfunc.ST_Within(point, func.ST_Envelope(ImageData.raster)))
+    return q
+
+
+def per_call(fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i)
+    return (time.perf_counter() - start) / calls * 1e6
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else None
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    dialect = create_engine('postgresql+psycopg2://').dialect
+    session = Session()
+
+    def compile_each(i):
+        q = raster_value_query(session, 743000 + i, 4324000 + i)
+        str(q.statement.compile(dialect=postgresql.dialect()))
+
+    def compile_cached(i):
+        q = raster_value_query(session, 743000 + i, 4324000 + i)
+        prepare_query(q, dialect)
+
+    t_each = per_call(compile_each, calls)
+    t_cached = per_call(compile_cached, calls)
+    print('Compile: from scratch {:0.0f}us/call, cached {:0.0f}us/call, {:0.1f}x'
+          ''.format(t_each, t_cached, t_each / t_cached))
+
+    if db_name is None:
+        return
+
+    engine, session = get_db(db_name)
+
+    def read_sql(i):
+        query_to_pandas(raster_value_query(session, 743000 + i, 4324000 + i), engine)
+
+    def prepared(i):
+        query_to_pandas(raster_value_query(session, 743000 + i, 4324000 + i),
+                        engine, prepared=True)
+
+    t_sql = per_call(read_sql, calls)
+    t_prepared = per_call(prepared, calls)
+    print('Lookup: read_sql {:0.0f}us/call, prepared {:0.0f}us/call, {:0.1f}x'
+          ''.format(t_sql, t_prepared, t_sql / t_prepared))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+'''
+Time the server side (ST_Union) and client side mosaic strategies of
+get_raster_mosaic for growing bounding boxes. Used to pick
+snowexsql.raster.UNION_MAX_PIXELS.
+
+Usage:
+    python bench_raster_mosaic.py <db_name> [surveyors]
+'''
+import sys
+import time
+
+from sqlalchemy import func
+
+from snowexsql.data import ImageData
+from snowexsql.db import get_db
+from snowexsql.raster import filter_images, get_raster_mosaic
+
+
+def main():
+    db_name = sys.argv[1] if len(sys.argv) > 1 else 'snowex'
+    surveyors = sys.argv[2] if len(sys.argv) > 2 else 'USGS'
+    engine, session = get_db(db_name)
+
+    # Center the boxes on the middle of the rasters
+    q = filter_images(session.query(func.ST_Extent(
+        func.ST_Envelope(ImageData.raster))), type='DEM', surveyors=surveyors)
+    extent = q.scalar()
+
+    # Extents come back as BOX(xmin ymin,xmax ymax)
+    box = [float(v) for v in extent[4:-1].replace(',', ' ').split()]
+    cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+
+    for half in [50, 100, 250, 500, 1000, 2500]:
+        bbox = (cx - half, cy - half, cx + half, cy + half)
+        times = {}
+
+        for strategy in ['server', 'client']:
+            start = time.perf_counter()
+            raster = get_raster_mosaic(session, bbox, type='DEM',
+                                       surveyors=surveyors, strategy=strategy)
+            times[strategy] = time.perf_counter() - start
+
+        print('{:>8,} pixels: server {:0.3f}s, client {:0.3f}s'.format(
+            raster.width * raster.height, times['server'], times['client']))
+
+    session.close()
+
+
+if __name__ == '__main__':
+    main()
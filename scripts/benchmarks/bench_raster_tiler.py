@@ -0,0 +1,71 @@
+'''
+Time tiling and encoding a large DEM to PostGIS raster WKB with one process
+and with a process pool. A synthetic GeoTIFF is written when no raster is
+given. With a database name the tiles are also loaded into the images table.
+
+Usage:
+    python bench_raster_tiler.py [raster] [workers] [db_name]
+'''
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import rasterio
+
+from snowexsql.data import ImageData
+from snowexsql.db import get_db
+from snowexsql.load import load_raster, read_raster_tiles
+
+
+def make_dem(filename, size=6000):
+    x = np.linspace(0, 20, size, dtype=np.float32)
+    dem = 3000 + 50 * np.sin(x)[None, :] * np.cos(x)[:, None]
+
+    with rasterio.open(filename, 'w', driver='GTiff', width=size, height=size,
+                       count=1, dtype='float32', crs='EPSG:26912',
+                       nodata=-9999, tiled=True, compress='deflate',
+                       transform=rasterio.Affine(1, 0, 743000, 0, -1, 4324500)) as dst:
+        dst.write(dem, 1)
+
+
+def time_tiles(filename, workers):
+    start = time.perf_counter()
+    count = sum(len(df) for df in read_raster_tiles(filename,
+                                                     max_workers=workers))
+    return count, time.perf_counter() - start
+
+
+def main():
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    db_name = sys.argv[3] if len(sys.argv) > 3 else None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(sys.argv) > 1 and sys.argv[1] != '-':
+            filename = sys.argv[1]
+        else:
+            filename = os.path.join(tmp, 'dem.tif')
+            make_dem(filename)
+
+        count, t_one = time_tiles(filename, 1)
+        _, t_pool = time_tiles(filename, workers)
+
+        print('{:,} tiles, 1 process: {:0.2f}s, {} processes: {:0.2f}s '
+              '({:0.1f}x)'.format(count, t_one, workers, t_pool, t_one / t_pool))
+
+        if db_name is not None:
+            engine, session = get_db(db_name)
+            stats = load_raster(engine, filename, max_workers=workers,
+                                type='bench_tiler')
+            print('Loaded {:,} tiles at {:0.0f} tiles/s'.format(
+                stats['rows'], stats['rows_per_sec']))
+
+            session.query(ImageData).filter(
+                ImageData.type == 'bench_tiler').delete(synchronize_session=False)
+            session.commit()
+            session.close()
+
+
+if __name__ == '__main__':
+    main()
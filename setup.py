@@ -38,6 +38,10 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        'arrow': ['pyarrow>=5.0'],
+        'async': ['asyncpg>=0.22'],
+    },
     long_description=readme + '\n\n' + history,
     long_description_content_type='text/x-rst',
     include_package_data=True,
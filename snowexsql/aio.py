@@ -0,0 +1,222 @@
+"""
+Module containing asyncio versions of the database access and query
+conversions. A single event loop can keep many queries in flight at once
+which suits services answering lots of small queries concurrently.
+
+Requires the asyncpg driver, install it with: pip install snowexsql[async]
+"""
+import asyncio
+import threading
+
+import numpy as np
+import pandas as pd
+
+from .conversions import _decode_geometry
+from .db import _connection_string
+from .raster import _tiles_statement, raster_from_wkb
+
+# Async engines shared by the whole process, keyed by the connection string
+# and pool settings. Connections belong to the event loop that opened them
+# so share these within a single loop
+_async_engines = {}
+_lock = threading.Lock()
+
+
+def _import_async():
+    """
+    Import the sqlalchemy asyncio extension which needs asyncpg
+    """
+    try:
+        import asyncpg  # noqa: F401
+        from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    except ImportError:
+        raise ImportError('asyncpg is required for the asyncio api,'
+                          ' install it with: pip install asyncpg')
+
+    return AsyncSession, create_async_engine
+
+
+def get_async_engine(db_str, credentials=None, pool_size=10, max_overflow=20,
+                     pool_recycle=3600, pool_pre_ping=True):
+    """
+    Returns a shared async engine for a database using the asyncpg driver
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        pool_size: Number of connections kept open in the pool
+        max_overflow: Number of connections allowed past pool_size under load
+        pool_recycle: Seconds after which a connection is replaced
+        pool_pre_ping: Check connections are alive before handing them out
+
+    Returns:
+        engine: sqlalchemy AsyncEngine object
+    """
+    AsyncSession, create_async_engine = _import_async()
+
+    db = _connection_string(db_str, credentials=credentials, driver='asyncpg')
+    key = (db, pool_size, max_overflow, pool_recycle, pool_pre_ping)
+
+    with _lock:
+        engine = _async_engines.get(key)
+
+        if engine is None:
+            # Always create a Session in US/Mountain TZ
+            engine = create_async_engine(
+                db, echo=False, connect_args={
+                    "server_settings": {"timezone": "us/mountain"}},
+                pool_size=pool_size, max_overflow=max_overflow,
+                pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+            _async_engines[key] = engine
+
+    return engine
+
+
+def get_async_db(db_str, credentials=None, **kwargs):
+    """
+    Returns the async DB engine and an async session, the asyncio
+    counterpart of db.get_db
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        kwargs: Pool settings passed to get_async_engine
+
+    Returns:
+        tuple: **engine** - sqlalchemy AsyncEngine object
+               **session** - sqlalchemy AsyncSession object
+    """
+    AsyncSession, _ = _import_async()
+    engine = get_async_engine(db_str, credentials=credentials, **kwargs)
+    session = AsyncSession(engine, expire_on_commit=False)
+
+    return engine, session
+
+
+async def dispose_async_engines():
+    """
+    Close every pooled connection and empty the async engine registry
+    """
+    with _lock:
+        engines = list(_async_engines.values())
+        _async_engines.clear()
+
+    for engine in engines:
+        await engine.dispose()
+
+
+async def _execute(query, engine):
+    """
+    Run a query on its own connection returning the column names and rows
+    """
+    statement = getattr(query, 'statement', query)
+
+    async with engine.connect() as conn:
+        result = await conn.execute(statement)
+        names = list(result.keys())
+        rows = result.fetchall()
+
+    return names, rows
+
+
+async def query_to_pandas(query, engine):
+    """
+    Convert a GeoAlchemy2 Query meant for postgis to a pandas dataframe
+    without blocking the event loop. Build the query with a regular
+    Session or use a select statement.
+
+    Args:
+        query: Query object or sqlalchemy selectable
+        engine: sqlalchemy AsyncEngine
+
+    Returns:
+        df: pandas.DataFrame instance
+    """
+    names, rows = await _execute(query, engine)
+    return pd.DataFrame.from_records(rows, columns=names)
+
+
+async def query_to_geopandas(query, engine, geom_col='geom', crs=None):
+    """
+    Convert a GeoAlchemy2 Query meant for postgis to a geopandas dataframe
+    without blocking the event loop. Requires that a geometry column is
+    included
+
+    Args:
+        query: Query object or sqlalchemy selectable
+        engine: sqlalchemy AsyncEngine
+        geom_col: Name of the geometry column
+        crs: Optional crs, defaults to the srid of the first geometry
+
+    Returns:
+        df: geopandas.GeoDataFrame instance
+    """
+    df = await query_to_pandas(query, engine)
+    return _decode_geometry(df, geom_col, crs=crs)
+
+
+async def query_to_rasters(query, engine):
+    """
+    Run a query selecting raster values and decode each one
+
+    Args:
+        query: Query object or selectable whose first column is a raster
+               or its ST_AsBinary
+        engine: sqlalchemy AsyncEngine
+
+    Returns:
+        rasters: List of raster.RasterArray, None for null rasters
+    """
+    names, rows = await _execute(query, engine)
+    return [None if r[0] is None else raster_from_wkb(r[0]) for r in rows]
+
+
+async def _fetch_batch(engine, ids, envelope, semaphore):
+    """
+    Fetch and decode a batch of tiles once a slot is free
+    """
+    async with semaphore:
+        async with engine.connect() as conn:
+            result = await conn.execute(_tiles_statement(ids, envelope=envelope))
+            rows = result.fetchall()
+
+    return {i: raster_from_wkb(wkb) for i, wkb in rows if wkb is not None}
+
+
+async def fetch_tiles(engine, ids, envelope=None, max_concurrency=8,
+                      batch_size=None):
+    """
+    Fetch and decode tiles from the images table with many batches in
+    flight at once, the asyncio counterpart of raster.fetch_tiles. Keep
+    max_concurrency within the pool size plus overflow of the engine.
+
+    Args:
+        engine: sqlalchemy AsyncEngine
+        ids: List of tile ids to fetch
+        envelope: Optional geometry to clip each tile to on the server
+        max_concurrency: Number of queries in flight at once
+        batch_size: Tiles per query, defaults to spreading the ids over
+                    four batches per slot
+
+    Returns:
+        tiles: Dictionary of tile id to RasterArray
+    """
+    ids = list(ids)
+    if not ids:
+        return {}
+
+    if batch_size is None:
+        batch_size = max(1, int(np.ceil(len(ids) / (4 * max_concurrency))))
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    results = await asyncio.gather(
+        *[_fetch_batch(engine, batch, envelope, semaphore) for batch in batches])
+
+    tiles = {}
+    for r in results:
+        tiles.update(r)
+
+    return tiles
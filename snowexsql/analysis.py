@@ -1,27 +1,363 @@
+from collections.abc import Iterator
+
 import numpy as np
+import pandas as pd
+from sqlalchemy import Float, case, cast, func, select
+from sqlalchemy.sql import Select, sqltypes
+
+from .summaries import NUMBER_PATTERN
+
 
+class StatsAccumulator(object):
+    """
+    Streaming count, mean, variance, min and max of values seen a chunk at a
+    time. Each chunk is reduced once and combined with the running totals
+    using the parallel form of Welford's algorithm (Chan et al.), so the
+    data never has to be in memory at once. Accumulators can be merged, e.g.
+    after computing over separate chunks in a process pool, and pickled.
 
-def get_stats(data, logger=None):
+    Optionally keeps a histogram over fixed bins and a uniform random sample
+    of the values for approximate quantiles, both of which merge too.
     """
-    Calculate and report the typical stats on an numpy array.
+
+    def __init__(self, bins=None, range=None, sample_size=None, seed=None):
+        """
+        Args:
+            bins: Number of histogram bins, needs range, or a sequence of
+                  bin edges. None keeps no histogram.
+            range: (min, max) of the histogram when bins is a number
+            sample_size: Number of values to keep for approximate quantiles,
+                         None keeps no sample
+            seed: Seed of the random sampling
+        """
+        self.count = 0
+        self.mean = np.nan
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+
+        if bins is not None and np.ndim(bins) == 0:
+            if range is None:
+                raise ValueError('A range is needed with a number of bins so '
+                                 'histograms of every chunk line up')
+            bins = np.linspace(range[0], range[1], int(bins) + 1)
+
+        self.edges = None if bins is None else np.asarray(bins, dtype=float)
+        self.histogram = None if bins is None else np.zeros(len(self.edges) - 1,
+                                                            dtype=np.int64)
+        self.outside = 0
+
+        self.sample_size = sample_size
+        self.sample = np.empty(0)
+        self.rng = np.random.default_rng(seed)
+
+    def _merge_moments(self, count, mean, m2, vmin, vmax):
+        """
+        Combine the moments of another set of values with these
+        """
+        if count == 0:
+            return
+
+        if self.count == 0:
+            self.count, self.mean, self.m2 = count, mean, m2
+            self.min, self.max = vmin, vmax
+            return
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def _merge_sample(self, sample, count):
+        """
+        Combine a uniform sample of count values with the one kept so the
+        result is still a uniform sample of everything seen
+        """
+        n_self = self.count - count
+        size = min(self.sample_size, len(self.sample) + len(sample))
+
+        # Draw how many to keep from each side as sampling without replacement
+        keep = self.rng.hypergeometric(n_self, count, size) if n_self else 0
+        keep = min(keep, len(self.sample), size)
+
+        self.sample = np.concatenate([
+            self.rng.choice(self.sample, keep, replace=False),
+            self.rng.choice(sample, min(size - keep, len(sample)), replace=False)])
+
+    def update(self, data):
+        """
+        Add a chunk of values, nans are ignored
+
+        Args:
+            data: Numpy array, pandas Series/DataFrame or anything array like
+
+        Returns:
+            self
+        """
+        values = np.asarray(data, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+
+        if len(values) == 0:
+            return self
+
+        mean = values.mean()
+        self._merge_moments(len(values), mean, ((values - mean) ** 2).sum(),
+                            values.min(), values.max())
+
+        if self.histogram is not None:
+            counts, _ = np.histogram(values, self.edges)
+            self.histogram += counts
+            self.outside += len(values) - counts.sum()
+
+        if self.sample_size:
+            sample = values
+            if len(values) > self.sample_size:
+                sample = self.rng.choice(values, self.sample_size, replace=False)
+            self._merge_sample(sample, len(values))
+
+        return self
+
+    def merge(self, other):
+        """
+        Add the values seen by another accumulator
+
+        Args:
+            other: StatsAccumulator with the same histogram bins
+
+        Returns:
+            self
+        """
+        if self.histogram is not None:
+            if other.histogram is None or not np.array_equal(self.edges, other.edges):
+                raise ValueError('Histograms with different bins cannot be merged')
+            self.histogram += other.histogram
+            self.outside += other.outside
+
+        self._merge_moments(other.count, other.mean, other.m2, other.min,
+                            other.max)
+
+        if self.sample_size and other.count:
+            self._merge_sample(other.sample, other.count)
+
+        return self
+
+    @property
+    def var(self):
+        """
+        Population variance, like numpy.nanvar
+        """
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        """
+        Population standard deviation, like numpy.nanstd
+        """
+        return np.sqrt(self.var)
+
+    def quantile(self, q):
+        """
+        Approximate quantiles from the kept sample, exact while fewer values
+        than the sample size have been seen
+
+        Args:
+            q: Quantile or sequence of quantiles between 0 and 1
+
+        Returns:
+            value: Quantile value(s)
+        """
+        if not self.sample_size:
+            raise ValueError('Quantiles need a sample_size')
+
+        if len(self.sample) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+
+        return np.quantile(self.sample, q)
+
+    def to_dict(self):
+        """
+        Statistics as a dictionary of mean, min, max, std and count
+        """
+        return {'mean': self.mean, 'min': self.min, 'max': self.max,
+                'std': self.std, 'count': self.count}
+
+
+def accumulate(chunks, column=None, by=None, **kwargs):
+    """
+    Accumulate statistics over an iterable of chunks, e.g. the dataframes
+    from conversions.query_to_pandas_chunks, optionally per group
 
     Args:
-        data: Numpy array or Pandas Dataframe
+        chunks: Iterable of arrays or dataframes
+        column: Column of the dataframes to use, defaults to all values
+        by: Column or list of columns to group the dataframes by
+        kwargs: Options passed to StatsAccumulator
+
+    Returns:
+        stats: StatsAccumulator, or a dictionary of group to
+               StatsAccumulator when grouping
+    """
+    if by is None:
+        stats = StatsAccumulator(**kwargs)
+        for chunk in chunks:
+            stats.update(chunk if column is None else chunk[column])
+        return stats
+
+    if column is None:
+        raise ValueError('A column is needed to accumulate by group')
+
+    groups = {}
+    for chunk in chunks:
+        for key, values in chunk.groupby(by)[column]:
+            if key not in groups:
+                groups[key] = StatsAccumulator(**kwargs)
+            groups[key].update(values)
+
+    return groups
+
+
+def _numeric(column):
+    """
+    Column as a number, text like the layers values only where it is a number
+    """
+    if not isinstance(column.type, sqltypes.String):
+        return column
+
+    return case((column.op('~')(NUMBER_PATTERN), cast(column, Float)), else_=None)
+
+
+def _quantile_name(q):
+    return 'q{:g}'.format(q)
+
+
+def query_stats(query, engine=None, column='value', by=None, quantiles=None,
+                ddof=0):
+    """
+    Calculate statistics of a column of a query in the database. The query
+    is wrapped in a single aggregate so only the summary is returned.
+
+    Args:
+        query: Query object or sqlalchemy select
+        engine: sqlalchemy engine, defaults to the bind of the query session
+        column: Name of the column of the query to describe
+        by: Column name or list of names of the query to group by
+        quantiles: Optional list of quantiles between 0 and 1 computed
+                   exactly with percentile_cont
+        ddof: 0 for the population standard deviation like get_stats, 1
+              for the sample standard deviation
+
+    Returns:
+        df: pandas.DataFrame of the by columns then count, mean, min, max,
+            std and a q<quantile> column per quantile
+    """
+    if engine is None:
+        engine = query.session.get_bind()
+
+    statement = getattr(query, 'statement', query).subquery()
+    value = _numeric(statement.c[column])
+    by = [by] if isinstance(by, str) else list(by or [])
+    groups = [statement.c[b] for b in by]
+
+    std = func.stddev_samp if ddof else func.stddev_pop
+    columns = groups + [func.count(value).label('count'),
+                        func.avg(value).label('mean'),
+                        func.min(value).label('min'),
+                        func.max(value).label('max'),
+                        std(value).label('std')]
+
+    for q in quantiles or []:
+        columns.append(func.percentile_cont(q).within_group(value).label(
+            _quantile_name(q)))
+
+    stmt = select(*columns)
+    if groups:
+        stmt = stmt.group_by(*groups).order_by(*groups)
+
+    with engine.connect() as conn:
+        result = conn.execute(stmt)
+        df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+    # Averages of integer columns come back as Decimal
+    stats = ['mean', 'min', 'max', 'std'] + [_quantile_name(q) for q in quantiles or []]
+    df[stats] = df[stats].astype(float)
+
+    return df
+
+
+def _report(msg, logger=None):
+    if logger is not None:
+        logger.info(msg)
+    else:
+        print(msg)
+
+
+def get_stats(data, logger=None, engine=None, column='value', by=None,
+              quantiles=None):
+    """
+    Calculate and report the typical stats on an numpy array. Queries are
+    calculated in the database with query_stats so only the stats are
+    transferred.
+
+    Args:
+        data: Numpy array or Pandas Dataframe, an iterator of chunks of
+              either, a StatsAccumulator or a query
         logger: Use a logger to report stats
+        engine: Engine to run a query with, defaults to its session's bind
+        column: Column of a query to describe
+        by: Column(s) of a query to group by
+        quantiles: Optional list of quantiles to add e.g. [0.5] adds q0.5
     Return:
-        result: Dictionary containing statistics
+        result: Dictionary containing statistics or a DataFrame of them
+                per group when grouping a query
     """
+    names = ['mean', 'min', 'max', 'std'] + [_quantile_name(q) for q in quantiles or []]
+    is_query = hasattr(data, 'statement') or isinstance(data, Select)
 
-    results = {}
+    if by is not None and not is_query:
+        raise ValueError('Only queries can be grouped, use accumulate for '
+                         'chunks of data')
+
+    if quantiles and (isinstance(data, Iterator) or (
+            isinstance(data, StatsAccumulator) and not data.sample_size)):
+        raise ValueError('Quantiles of chunks need a StatsAccumulator with a '
+                         'sample_size')
+
+    if is_query:
+        df = query_stats(data, engine=engine, column=column, by=by,
+                         quantiles=quantiles)
+
+        if by is not None:
+            for row in df.itertuples(index=False):
+                _report('\t' + ', '.join('{} = {}'.format(k, v)
+                                         for k, v in zip(df.columns, row)), logger)
+            return df
 
-    for stat in ['mean', 'min', 'max', 'std']:
-        fn = getattr(np, 'nan' + stat)
-        results[stat] = fn(data)
-        msg = '\t{} = {}'.format(stat, results[stat])
+        values = df.iloc[0].to_dict()
 
-        if logger is not None:
-            logger.info(msg)
+    else:
+        if isinstance(data, StatsAccumulator):
+            stats = data
+        elif isinstance(data, Iterator):
+            stats = accumulate(data)
         else:
-            print(msg)
+            stats = StatsAccumulator().update(data)
+
+        values = stats.to_dict()
+
+        for q in quantiles or []:
+            if stats is data:
+                values[_quantile_name(q)] = stats.quantile(q)
+            else:
+                values[_quantile_name(q)] = np.nanquantile(
+                    np.asarray(data, dtype=float), q)
+
+    results = {}
+
+    for stat in names:
+        results[stat] = values[stat]
+        _report('\t{} = {}'.format(stat, results[stat]), logger)
 
     return results
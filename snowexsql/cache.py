@@ -0,0 +1,297 @@
+"""
+Module for caching the results of queries on disk. Results are stored as
+parquet files keyed by the compiled sql, its parameters and a version token
+of every table the query reads from, so a cached result is only used while
+the tables it came from are unchanged.
+"""
+import hashlib
+import json
+import os
+import time
+from glob import glob
+from os.path import getsize, join
+
+import geopandas as gpd
+import pandas as pd
+from sqlalchemy import Table, bindparam, text
+from sqlalchemy.sql.util import find_tables
+
+from .pgcopy import compile_query
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+# Columns recording when rows were written, used to version tables
+TIMESTAMP_COLUMNS = ['time_created', 'time_updated']
+
+
+def query_tables(query):
+    """
+    Find every table a query reads from
+
+    Args:
+        query: Query object or sqlalchemy selectable
+
+    Returns:
+        tables: Sorted list of (schema, table name)
+    """
+    statement = getattr(query, 'statement', query)
+    found = find_tables(statement, check_columns=True, include_aliases=True,
+                        include_joins=True)
+
+    return sorted({(t.schema or 'public', t.name) for t in found
+                   if isinstance(t, Table)})
+
+
+class QueryCache(object):
+    """
+    On disk cache of query results with least recently used eviction once
+    the files exceed a size budget. Pass an instance as the cache argument
+    of the conversions query functions to use it.
+
+    By default the table version token is the row count and the latest
+    time_created and time_updated of each table. It is read from the table
+    itself, so any write committed before the lookup is always seen. Rows
+    updated outside the ORM need time_updated set for it to be noticed.
+    Tables without those columns are versioned by their row count alone.
+
+    version='stats' instead builds the token from the insert/update/delete
+    counters in pg_stat_user_tables, a single cheap lookup that doesn't scan
+    the table. The table oid, its file node and the time the statistics were
+    last reset are included so a truncated or recreated table gets a new
+    token. It is only approximate, PostgreSQL reports the counters
+    asynchronously some time after each transaction commits and may drop
+    updates to them under load, so a result cached right before a write can
+    still be returned right after it.
+    """
+
+    def __init__(self, directory, max_bytes=1024 ** 3, version='timestamps',
+                 version_ttl=0):
+        """
+        Args:
+            directory: Folder to store the results in, created if missing
+            max_bytes: Maximum bytes of results on disk before evicting
+            version: How to version tables, 'timestamps' or the approximate
+                     'stats'
+            version_ttl: Seconds to reuse a table version before checking the
+                         database again. Within it repeat queries never touch
+                         the database
+        """
+        if version not in ['stats', 'timestamps']:
+            raise ValueError('Unknown table version method {}'.format(version))
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.version = version
+        self.version_ttl = version_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._versions = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+    def table_versions(self, engine, tables):
+        """
+        Retrieve a version token for each table. With the timestamps
+        version the token changes whenever rows are inserted, deleted or
+        updated through the ORM. The stats version also notices truncating
+        or recreating the table but lags behind writes.
+
+        Args:
+            engine: sqlalchemy engine
+            tables: List of (schema, table name)
+
+        Returns:
+            versions: List of version tokens in the order of tables
+        """
+        now = time.monotonic()
+        key = (str(engine.url), tuple(tables))
+        cached = self._versions.get(key)
+
+        if cached is not None and now - cached[0] < self.version_ttl:
+            return cached[1]
+
+        versions = []
+        with engine.connect() as conn:
+            for schema, name in tables:
+                if self.version == 'stats':
+                    row = conn.execute(text(
+                        'SELECT relid, pg_relation_filenode(relid), '
+                        'n_tup_ins, n_tup_upd, n_tup_del, '
+                        'pg_stat_get_db_stat_reset_time(d.oid) '
+                        'FROM pg_stat_user_tables, pg_database d '
+                        'WHERE schemaname = :schema AND relname = :name '
+                        'AND d.datname = current_database()'),
+                        dict(schema=schema, name=name)).first()
+                else:
+                    stamps = conn.execute(text(
+                        'SELECT column_name FROM information_schema.columns '
+                        'WHERE table_schema = :schema AND table_name = :name '
+                        'AND column_name IN :columns ORDER BY column_name'
+                    ).bindparams(bindparam('columns', expanding=True)),
+                        dict(schema=schema, name=name,
+                             columns=TIMESTAMP_COLUMNS)).scalars().all()
+
+                    row = conn.execute(text('SELECT {} FROM "{}"."{}"'.format(
+                        ', '.join(['count(*)'] + ['max({})'.format(c) for c in stamps]),
+                        schema, name))).first()
+
+                versions.append(None if row is None else [str(v) for v in row])
+
+        self._versions[key] = (now, versions)
+        return versions
+
+    def key(self, query, engine, kind, **options):
+        """
+        Build the cache key of a query
+
+        Args:
+            query: Query object or sqlalchemy selectable
+            engine: sqlalchemy engine
+            kind: Name of what the result is being converted to
+            options: Any other options that change the result
+
+        Returns:
+            key: Hex digest identifying the result
+        """
+        sql, params = compile_query(query, engine.dialect)
+        tables = query_tables(query)
+
+        content = json.dumps({
+            'url': str(engine.url),
+            'kind': kind,
+            'sql': sql,
+            'params': params,
+            'options': options,
+            'tables': tables,
+            'versions': self.table_versions(engine, tables)},
+            sort_keys=True, default=str)
+
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return join(self.directory, '{}.parquet'.format(key))
+
+    def get(self, key, geo=False):
+        """
+        Retrieve a cached result marking it as recently used
+
+        Args:
+            key: Key from QueryCache.key
+            geo: Read the result as a GeoDataFrame
+
+        Returns:
+            df: Cached dataframe or None when missing
+        """
+        f = self._path(key)
+
+        try:
+            df = gpd.read_parquet(f) if geo else pd.read_parquet(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Modification time tracks use for the LRU eviction
+        os.utime(f)
+        self.hits += 1
+        return df
+
+    def put(self, key, df):
+        """
+        Store a result then evict the least recently used results over
+        budget. Results that can't be written to parquet are skipped.
+
+        Args:
+            key: Key from QueryCache.key
+            df: DataFrame or GeoDataFrame to store
+        """
+        f = self._path(key)
+        tmp = '{}.{}.tmp'.format(f, os.getpid())
+
+        try:
+            df.to_parquet(tmp)
+        except Exception as e:
+            log.debug('Not caching result, {}'.format(e))
+            if os.path.isfile(tmp):
+                os.remove(tmp)
+            return
+
+        # Replace atomically so readers never see a partial file
+        os.replace(tmp, f)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until under max_bytes
+        """
+        files = []
+        for f in glob(join(self.directory, '*.parquet')):
+            try:
+                files.append((os.stat(f).st_mtime, getsize(f), f))
+            except OSError:
+                pass
+
+        total = sum(f[1] for f in files)
+
+        for mtime, size, f in sorted(files):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(f)
+            except OSError:
+                continue
+
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove every cached result
+        """
+        for f in glob(join(self.directory, '*.parquet')):
+            os.remove(f)
+
+        self._versions.clear()
+
+    def fetch(self, query, engine, read, kind='pandas', **options):
+        """
+        Return a cached result for the query or read it and cache it
+
+        Args:
+            query: Query object or sqlalchemy selectable
+            engine: sqlalchemy engine
+            read: Callable with no arguments returning the dataframe
+            kind: 'pandas' or 'geopandas'
+            options: Any other options that change the result
+
+        Returns:
+            df: DataFrame or GeoDataFrame
+        """
+        key = self.key(query, engine, kind, **options)
+        df = self.get(key, geo=kind == 'geopandas')
+
+        if df is None:
+            df = read()
+            self.put(key, df)
+
+        return df
+
+    def stats(self):
+        """
+        Report the hit/miss counts and disk usage of the cache
+
+        Returns:
+            stats: Dictionary of statistics
+        """
+        files = glob(join(self.directory, '*.parquet'))
+        lookups = self.hits + self.misses
+
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(files),
+                'bytes': sum(getsize(f) for f in files)}
@@ -3,46 +3,162 @@ Module contains all conversions used for manipulating data. This includes:
 filetypes, datatypes, etc. Many tools here will be useful for most end users
 of the database.
 """
+import json
+from contextlib import contextmanager
+from itertools import chain, islice
+from operator import attrgetter, itemgetter
 from os.path import basename, dirname, join
 
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import psycopg2
 import rasterio
-from geoalchemy2.shape import to_shape
+from geoalchemy2.elements import WKBElement
+from geoalchemy2.types import Geometry, Raster
+from pyproj import CRS
 from rasterio import MemoryFile
-from sqlalchemy.dialects import postgresql
+from sqlalchemy import func, inspect, types
+from sqlalchemy.engine import Row
 
-from .data import PointData
+from .data import ImageData, PointData
+from .instrumentation import timed
+from .pgcopy import CopyNotSupported, read_copy
+from .raster import filter_images, get_raster_points, is_geotiff, raster_from_wkb
+from .statements import execute_prepared
+from .utilities import get_logger
 
+log = get_logger(__name__)
 
+# Rows fetched to estimate the size of a row before the first chunk when a
+# memory ceiling is given
+PROBE_ROWS = 100
+
+
+def _wkb_to_geoseries(values, crs=None):
+    """
+    Decode a sequence of WKB/EWKB geometries in a single vectorized call
+
+    Args:
+        values: Iterable of geoalchemy2 WKBElements, raw WKB bytes or hex
+                strings. Nones are kept as missing geometries
+        crs: Optional crs to assign to the result
+
+    Returns:
+        geoms: geopandas.GeoSeries instance
+    """
+    wkb = np.empty(len(values), dtype=object)
+
+    for i, v in enumerate(values):
+        # Unwrap the geoalchemy elements to their raw buffer
+        v = getattr(v, 'data', v)
+
+        if isinstance(v, memoryview):
+            v = v.tobytes()
+        wkb[i] = v
+
+    return gpd.GeoSeries.from_wkb(wkb, crs=crs)
+
+
+@timed
 def points_to_geopandas(results):
     """
-    Converts a successful query list into a geopandas data frame
+    Converts a successful query list into a geopandas data frame. Columns
+    are taken from the table mapper and the geometry is decoded in bulk
 
     Args:
-        results: List of PointData objects
+        results: List of PointData objects (or any other mapped table)
 
     Returns:
         df: geopandas.GeoDataFrame instance
     """
-    # grab all the attributes of the class to assign
-    if isinstance(results[0], PointData):
-        data = {a: [] for a in dir(PointData) if a[0:1] != '__'}
+    # grab all the column attributes of the class to assign
+    DataCls = type(results[0]) if len(results) > 0 else PointData
+    keys = [c.key for c in inspect(DataCls).column_attrs]
+
+    # Pull each row as a tuple in one call then pivot into columns. Loaded
+    # records keep their values in the instance dict which skips the ORM
+    # attribute machinery, expired records fall back to getattr
+    from_dict = itemgetter(*keys)
+    from_attr = attrgetter(*keys)
+    rows = []
 
     for r in results:
-        for k in data.keys():
-            v = getattr(r, k)
+        try:
+            rows.append(from_dict(r.__dict__))
+        except KeyError:
+            rows.append(from_attr(r))
+
+    columns = zip(*rows) if rows else [[] for k in keys]
+    data = dict(zip(keys, columns))
+
+    data['geom'] = _wkb_to_geoseries(data['geom']).values
+    df = gpd.GeoDataFrame(data, geometry='geom')
+    return df
+
+
+def _query_to_frame_copy(query, engine, geom_col=None, crs=None):
+    """
+    Read a query using binary COPY into a dataframe. Geometry comes back as
+    EWKB and is decoded in bulk when a geom_col is provided.
+    """
+    names, columns = read_copy(engine, query)
+    df = pd.DataFrame(dict(enumerate(columns)))
+    df.columns = names
+
+    if geom_col is not None:
+        df = _decode_geometry(df, geom_col, crs=crs)
+
+    return df
+
 
-            if k == 'geom':
-                v = to_shape(v)
-            data[k].append(v)
+def _query_to_frame_prepared(query, engine, geom_col=None, crs=None):
+    """
+    Read a query as a server side prepared statement into a dataframe.
+    Geometry comes back as hex EWKB and is decoded in bulk when a geom_col
+    is provided.
+    """
+    names, rows = execute_prepared(engine, query)
+    df = pd.DataFrame.from_records(rows, columns=names)
+
+    if geom_col is not None:
+        df = _decode_geometry(df, geom_col, crs=crs)
 
-    df = gpd.GeoDataFrame(data, geometry=data['geom'])
     return df
 
 
-def query_to_geopandas(query, engine, **kwargs):
+def _decode_geometry(df, geom_col, crs=None):
+    """
+    Decode a column of EWKB into a GeoDataFrame
+    """
+    wkb = df[geom_col].dropna()
+
+    # Mimic from_postgis and use the srid of the first geometry
+    if crs is None and len(wkb) > 0:
+        srid = WKBElement(getattr(wkb.iloc[0], 'data', wkb.iloc[0])).srid
+        crs = 'epsg:{}'.format(srid) if srid > 0 else None
+
+    df[geom_col] = _wkb_to_geoseries(df[geom_col].values).values
+    return gpd.GeoDataFrame(df, geometry=geom_col, crs=crs)
+
+
+def _try_copy(query, engine, **kwargs):
+    """
+    Attempt a binary COPY read, returns None when the query can't be used
+    with COPY so the caller can fall back to a normal read
+    """
+    try:
+        return _query_to_frame_copy(query, engine, **kwargs)
+
+    except (CopyNotSupported, psycopg2.Error) as e:
+        log.debug('Falling back from COPY, {}'.format(e))
+
+    return None
+
+
+@timed
+def query_to_geopandas(query, engine, copy=False, cache=None, prepared=False,
+                       **kwargs):
     """
     Convert a GeoAlchemy2 Query meant for postgis to a geopandas dataframe. Requires that a geometry column is
     included
@@ -50,12 +166,43 @@ def query_to_geopandas(query, engine, **kwargs):
     Args:
         query: GeoAlchemy2.Query Object
         engine: sqlalchemy engine
+        copy: Read the results using binary COPY which is much faster for
+              large selects. timestamptz columns come back in UTC like the
+              normal read. Falls back to the normal read when the query
+              can't be used with COPY or kwargs other than geom_col and crs
+              are given
+        cache: Optional cache.QueryCache to reuse results of repeat
+               queries from disk while the tables are unchanged
+        prepared: Run the query as a server side prepared statement so
+                  repeat calls of the same query shape skip compiling and
+                  planning. Good for many small lookups in a loop
+        kwargs: Keyword arguments passed to GeoDataFrame.from_postgis
 
     Returns:
         df: geopandas.GeoDataFrame instance
     """
-    # Fill out the variables in the query
-    sql = query.statement.compile(dialect=postgresql.dialect())
+    if cache is not None:
+        return cache.fetch(
+            query, engine, lambda: query_to_geopandas(
+                query, engine, copy=copy, prepared=prepared, **kwargs),
+            kind='geopandas', copy=copy, prepared=prepared, **kwargs)
+
+    # Reading options other than the geometry need read_postgis
+    native = set(kwargs).issubset(['geom_col', 'crs'])
+
+    if copy and native:
+        df = _try_copy(query, engine, geom_col=kwargs.get('geom_col', 'geom'),
+                       crs=kwargs.get('crs'))
+        if df is not None:
+            return df
+
+    if prepared and native:
+        return _query_to_frame_prepared(
+            query, engine, geom_col=kwargs.get('geom_col', 'geom'),
+            crs=kwargs.get('crs'))
+
+    # Pass the statement so the engine reuses its compiled form
+    sql = query.statement
 
     # Get dataframe from geopandas using the query and engine
     df = gpd.GeoDataFrame.from_postgis(sql, engine, **kwargs)
@@ -63,19 +210,49 @@ def query_to_geopandas(query, engine, **kwargs):
     return df
 
 
-def query_to_pandas(query, engine, **kwargs):
+@timed
+def query_to_pandas(query, engine, copy=False, cache=None, prepared=False,
+                    **kwargs):
     """
     Convert a GeoAlchemy2 Query meant for postgis to a pandas dataframe.
 
     Args:
         query: Query Object
         engine: sqlalchemy engine
+        copy: Read the results using binary COPY which is much faster for
+              large selects. Geometries are left as WKB bytes and
+              timestamptz columns come back in UTC like the normal read.
+              Falls back to the normal read when the query can't be used
+              with COPY or any kwargs are given
+        cache: Optional cache.QueryCache to reuse results of repeat
+               queries from disk while the tables are unchanged
+        prepared: Run the query as a server side prepared statement so
+                  repeat calls of the same query shape skip compiling and
+                  planning. Good for many small lookups in a loop
+        kwargs: Keyword arguments passed to pandas.read_sql
 
     Returns:
         df: pandas.DataFrame instance
     """
-    # Fill out the variables in the query
-    sql = query.statement.compile(dialect=postgresql.dialect())
+    if cache is not None:
+        return cache.fetch(
+            query, engine, lambda: query_to_pandas(
+                query, engine, copy=copy, prepared=prepared, **kwargs),
+            kind='pandas', copy=copy, prepared=prepared, **kwargs)
+
+    # Reading options need read_sql
+    native = not kwargs
+
+    if copy and native:
+        df = _try_copy(query, engine)
+        if df is not None:
+            return df
+
+    if prepared and native:
+        return _query_to_frame_prepared(query, engine)
+
+    # Pass the statement so the engine reuses its compiled form
+    sql = query.statement
 
     # Get dataframe from geopandas using the query and engine
     df = pd.read_sql(sql, engine, **kwargs)
@@ -83,13 +260,390 @@ def query_to_pandas(query, engine, **kwargs):
     return df
 
 
+def _to_frame(chunk, columns, geom_col=None, crs=None):
+    """
+    Build a dataframe from a list of rows, decoding the geometry column
+    """
+    df = pd.DataFrame.from_records(chunk, columns=columns)
+
+    if geom_col is not None:
+        df[geom_col] = _wkb_to_geoseries(df[geom_col].values).values
+        df = gpd.GeoDataFrame(df, geometry=geom_col, crs=crs)
+
+    return df
+
+
+def _rows_within(df, chunksize, max_bytes):
+    """
+    Number of rows like those in df that fit in max_bytes
+    """
+    row_bytes = df.memory_usage(deep=True).sum() / len(df)
+    return max(1, min(chunksize, int(max_bytes // row_bytes)))
+
+
+def _iter_dataframes(rows, columns, chunksize=10000, max_bytes=None,
+                     geom_col=None, crs=None):
+    """
+    Group an iterator of rows into dataframes of a bounded size. When
+    max_bytes is provided the first chunk is sized from a small probe of
+    rows and the rows per chunk are adjusted after each chunk so the in
+    memory size of a chunk stays under it.
+
+    Args:
+        rows: Iterator of row tuples
+        columns: List of column names matching the rows
+        chunksize: Maximum number of rows per dataframe
+        max_bytes: Optional ceiling on the memory used by a single chunk
+        geom_col: Name of a WKB column to decode, if None pandas dataframes
+                  are produced
+        crs: Crs assigned to the geometry column
+
+    Yields:
+        df: pandas.DataFrame or geopandas.GeoDataFrame instance
+    """
+    rows = iter(rows)
+    n = chunksize
+
+    if max_bytes is not None:
+        probe = list(islice(rows, min(chunksize, PROBE_ROWS)))
+        if probe:
+            n = _rows_within(_to_frame(probe, columns, geom_col=geom_col),
+                             chunksize, max_bytes)
+        rows = chain(probe, rows)
+
+    while True:
+        chunk = list(islice(rows, n))
+        if not chunk:
+            break
+
+        df = _to_frame(chunk, columns, geom_col=geom_col, crs=crs)
+        del chunk
+
+        if max_bytes is not None:
+            n = _rows_within(df, chunksize, max_bytes)
+
+        yield df
+
+
+@contextmanager
+def _execute_stream(query, engine, chunksize=10000):
+    """
+    Execute a query on a server side cursor yielding the open result
+    """
+    statement = getattr(query, 'statement', query)
+
+    with engine.connect() as conn:
+        # stream_results uses a named cursor with psycopg2 so rows are only
+        # sent over as they are requested
+        conn = conn.execution_options(stream_results=True,
+                                      max_row_buffer=chunksize)
+        result = conn.execute(statement)
+
+        try:
+            yield result
+        finally:
+            result.close()
+
+
+def _stream_query(query, engine, chunksize=10000, max_bytes=None,
+                  geom_col=None, crs=None):
+    """
+    Execute a query on a server side cursor and yield chunked dataframes
+    """
+    with _execute_stream(query, engine, chunksize=chunksize) as result:
+        yield from _iter_dataframes(result, list(result.keys()),
+                                    chunksize=chunksize, max_bytes=max_bytes,
+                                    geom_col=geom_col, crs=crs)
+
+
+def query_to_geopandas_chunks(query, engine, chunksize=10000, max_bytes=None,
+                              geom_col='geom', crs=None):
+    """
+    Stream a GeoAlchemy2 Query meant for postgis as a series of geopandas
+    dataframes. Rows are pulled from a server side cursor so no more than a
+    chunk of the results is ever held in memory.
+
+    Args:
+        query: GeoAlchemy2.Query Object
+        engine: sqlalchemy engine
+        chunksize: Maximum number of rows per dataframe
+        max_bytes: Optional ceiling on the memory of a single dataframe, the
+                   number of rows per chunk is reduced to stay under it
+        geom_col: Name of the geometry column
+        crs: Crs to assign to the geometry column
+
+    Yields:
+        df: geopandas.GeoDataFrame instance
+    """
+    yield from _stream_query(query, engine, chunksize=chunksize,
+                             max_bytes=max_bytes, geom_col=geom_col, crs=crs)
+
+
+def query_to_pandas_chunks(query, engine, chunksize=10000, max_bytes=None):
+    """
+    Stream a GeoAlchemy2 Query meant for postgis as a series of pandas
+    dataframes pulled from a server side cursor.
+
+    Args:
+        query: Query Object
+        engine: sqlalchemy engine
+        chunksize: Maximum number of rows per dataframe
+        max_bytes: Optional ceiling on the memory of a single dataframe, the
+                   number of rows per chunk is reduced to stay under it
+
+    Yields:
+        df: pandas.DataFrame instance
+    """
+    yield from _stream_query(query, engine, chunksize=chunksize,
+                             max_bytes=max_bytes)
+
+
+def _import_pyarrow():
+    """
+    Import pyarrow which is only required for the arrow/parquet exports
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+    except ImportError:
+        raise ImportError('pyarrow is required for arrow and parquet exports,'
+                          ' install it with: pip install pyarrow')
+
+    return pa, pq
+
+
+def _arrow_type(sql_type):
+    """
+    Map a sqlalchemy column type to an arrow type, None means infer it
+    """
+    pa, pq = _import_pyarrow()
+
+    if isinstance(sql_type, (Geometry, Raster)):
+        return pa.binary()
+
+    for cls, arrow_type in [(types.Boolean, pa.bool_()),
+                            (types.BigInteger, pa.int64()),
+                            (types.SmallInteger, pa.int16()),
+                            (types.Integer, pa.int32()),
+                            (types.Float, pa.float64()),
+                            (types.String, pa.string()),
+                            (types.Date, pa.date32()),
+                            (types.Time, pa.time64('us'))]:
+        if isinstance(sql_type, cls):
+            return arrow_type
+
+    if isinstance(sql_type, types.DateTime):
+        return pa.timestamp('us', tz='UTC' if sql_type.timezone else None)
+
+    return None
+
+
+def _result_fields(query, result):
+    """
+    Pair up the result column names with their sqlalchemy types
+    """
+    statement = getattr(query, 'statement', query)
+    columns = list(statement.selected_columns)
+    names = list(result.keys())
+
+    if len(columns) != len(names):
+        return [(n, None) for n in names]
+
+    return [(n, c.type) for n, c in zip(names, columns)]
+
+
+def _arrow_values(values, sql_type):
+    """
+    Prepare a column of python values for arrow. Geometries are written as
+    ISO WKB without the srid, rasters as their WKB bytes
+    """
+    if isinstance(sql_type, Geometry):
+        return _wkb_to_geoseries(values).to_wkb().values
+
+    elif isinstance(sql_type, Raster):
+        return [None if v is None else bytes.fromhex(v.data)
+                if isinstance(v.data, str) else bytes(v.data) for v in values]
+
+    elif isinstance(sql_type, types.Time):
+        # Arrow times have no time zone
+        return [None if v is None else v.replace(tzinfo=None) for v in values]
+
+    return values
+
+
+def _geo_metadata(rows, fields):
+    """
+    Build the GeoParquet metadata for the geometry columns. The crs is taken
+    from the srid of the first geometry in each column
+    """
+    geoms = [i for i, (n, t) in enumerate(fields) if isinstance(t, Geometry)]
+
+    if not geoms:
+        return {}
+
+    names = [fields[i][0] for i in geoms]
+    primary = 'geom' if 'geom' in names else names[0]
+    columns = {}
+
+    for i in geoms:
+        column = {'encoding': 'WKB', 'geometry_types': []}
+        first = next((r[i] for r in rows if r[i] is not None), None)
+
+        if first is not None:
+            if not isinstance(first, WKBElement):
+                first = WKBElement(first)
+
+            srid = first.srid
+            if srid > 0:
+                column['crs'] = CRS.from_epsg(srid).to_json_dict()
+
+        columns[fields[i][0]] = column
+
+    geo = {'version': '1.0.0', 'primary_column': primary, 'columns': columns}
+    return {b'geo': json.dumps(geo).encode('utf-8')}
+
+
+def _rows_to_batch(rows, fields, schema=None):
+    """
+    Convert a list of row tuples into an arrow RecordBatch
+    """
+    pa, pq = _import_pyarrow()
+    columns = list(zip(*rows)) if rows else [[] for f in fields]
+    arrays = []
+
+    for i, ((name, sql_type), values) in enumerate(zip(fields, columns)):
+        if schema is not None:
+            arrow_type = schema.field(i).type
+        else:
+            arrow_type = _arrow_type(sql_type)
+
+        arrays.append(pa.array(_arrow_values(values, sql_type),
+                               type=arrow_type))
+
+    names = [f[0] for f in fields]
+    batch = pa.RecordBatch.from_arrays(arrays, names=names)
+
+    if schema is not None:
+        batch = batch.replace_schema_metadata(schema.metadata)
+
+    return batch
+
+
+def _arrow_batches(partitions, fields):
+    """
+    Convert an iterator of row lists into RecordBatches sharing one schema,
+    the schema carries the GeoParquet metadata found from the first rows
+    """
+    schema = None
+
+    for rows in partitions:
+        if schema is None:
+            batch = _rows_to_batch(rows, fields)
+            schema = batch.schema.with_metadata(_geo_metadata(rows, fields))
+
+        yield _rows_to_batch(rows, fields, schema=schema)
+
+
+@timed
+def query_to_arrow(query, engine, chunksize=100000):
+    """
+    Convert a GeoAlchemy2 Query meant for postgis to an arrow table.
+    Geometry columns are stored as WKB with GeoParquet metadata on the schema
+
+    Args:
+        query: GeoAlchemy2.Query Object
+        engine: sqlalchemy engine
+        chunksize: Number of rows fetched and converted at a time
+
+    Returns:
+        table: pyarrow.Table instance
+    """
+    pa, pq = _import_pyarrow()
+
+    with _execute_stream(query, engine, chunksize=chunksize) as result:
+        fields = _result_fields(query, result)
+        batches = list(_arrow_batches(result.partitions(chunksize), fields))
+
+    if not batches:
+        batches = [_rows_to_batch([], fields)]
+
+    table = pa.Table.from_batches(batches)
+
+    return table
+
+
+def _write_parquet(batches, fields, path, row_group_size=100000,
+                   compression='snappy'):
+    """
+    Write an iterator of RecordBatches to a parquet file one row group at a
+    time, returns the number of rows written
+    """
+    pa, pq = _import_pyarrow()
+    writer = None
+    count = 0
+
+    try:
+        for batch in batches:
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema,
+                                          compression=compression)
+
+            writer.write_table(pa.Table.from_batches([batch]),
+                               row_group_size=row_group_size)
+            count += batch.num_rows
+
+        # Still write out the schema for empty results
+        if writer is None:
+            empty = _rows_to_batch([], fields)
+            writer = pq.ParquetWriter(path, empty.schema,
+                                      compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return count
+
+
+@timed
+def query_to_geoparquet(query, engine, path, row_group_size=100000,
+                        compression='snappy'):
+    """
+    Write the results of a GeoAlchemy2 Query meant for postgis to a
+    GeoParquet file. Results are streamed from the database one row group
+    at a time so the full result is never held in memory
+
+    Args:
+        query: GeoAlchemy2.Query Object
+        engine: sqlalchemy engine
+        path: Path to the parquet file to write
+        row_group_size: Number of rows fetched and written per row group
+        compression: Parquet compression codec
+
+    Returns:
+        count: Number of rows written
+    """
+    with _execute_stream(query, engine, chunksize=row_group_size) as result:
+        fields = _result_fields(query, result)
+        batches = _arrow_batches(result.partitions(row_group_size), fields)
+        count = _write_parquet(batches, fields, path,
+                               row_group_size=row_group_size,
+                               compression=compression)
+
+    return count
+
+
+@timed
 def raster_to_rasterio(session, rasters):
     """
-    Retrieve the numpy array of a raster by converting to a temporary file
+    Retrieve the rasterio datasets of rasters. Rasters queried directly or
+    with ST_AsBinary are decoded natively without any GeoTIFF encoding. Tiffs
+    from ST_AsTiff are still accepted.
 
     Args:
         session: sqlalchemy session object
-        raster: list of :py:class:`geoalchemy2.types.Raster`
+        raster: list of :py:class:`geoalchemy2.types.Raster` or query
+                results containing them
 
     Returns:
         dataset: list of rasterio datasets
@@ -97,9 +651,59 @@ def raster_to_rasterio(session, rasters):
     """
     datasets = []
     for r in rasters:
-        bdata = bytes(r[0])
+        # Allow for results rows
+        if isinstance(r, (tuple, Row)):
+            r = r[0]
+
+        if is_geotiff(r):
+            # Copy into a dataset that doesn't depend on the memory file
+            with MemoryFile(bytes(r)) as tmpfile:
+                with tmpfile.open() as src:
+                    dataset = rasterio.open(
+                        'snowexsql_raster', 'w+', driver='MEM',
+                        width=src.width, height=src.height, count=src.count,
+                        dtype=src.dtypes[0], crs=src.crs,
+                        transform=src.transform, nodata=src.nodata)
+                    dataset.write(src.read())
+        else:
+            dataset = raster_from_wkb(r).to_rasterio()
 
-        with MemoryFile() as tmpfile:
-            tmpfile.write(bdata)
-            datasets.append(tmpfile.open())
+        datasets.append(dataset)
     return datasets
+
+
+@timed
+def raster_to_geopandas(session, geom=None, bbox=None, type=None,
+                        surveyors=None, date=None, srid=None, **kwargs):
+    """
+    Extract the pixels of the rasters in a polygon or bbox as a point
+    geodataframe, e.g. to compare point measurements with a gridded
+    product. Pixels are decoded in bulk tile by tile, see
+    raster.iter_raster_points.
+
+    Args:
+        session: sqlalchemy session object
+        geom: Shapely polygon to extract the pixels inside of
+        bbox: (xmin, ymin, xmax, ymax) to use instead of a polygon
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+        srid: Srid of the polygon or bbox when not that of the rasters, the
+              points are always in the raster srid
+        kwargs: band, batch_size and max_workers passed on
+
+    Returns:
+        df: geopandas.GeoDataFrame with a value column and the pixel centers
+            as geometry
+    """
+    filters = dict(type=type, surveyors=surveyors, date=date)
+
+    q = filter_images(session.query(func.ST_SRID(ImageData.raster)), **filters)
+    raster_srid = q.limit(1).scalar()
+
+    x, y, values = get_raster_points(session, geom=geom, bbox=bbox, srid=srid,
+                                     **filters, **kwargs)
+    crs = 'EPSG:{}'.format(raster_srid) if raster_srid else None
+
+    return gpd.GeoDataFrame({'value': values},
+                            geometry=gpd.points_from_xy(x, y), crs=crs)
@@ -6,7 +6,7 @@ Mapping in the sqlalchemy or ORM.
 """
 import datetime
 
-from geoalchemy2 import Geometry, Raster
+import geoalchemy2
 from sqlalchemy import Column, Date, DateTime, Float, Integer, String, Time
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
@@ -14,6 +14,22 @@ from sqlalchemy.sql import func
 Base = declarative_base()
 
 
+class Geometry(geoalchemy2.Geometry):
+    """
+    GeoAlchemy2 geometry that sqlalchemy can cache statements with. Its
+    arguments are all hashable, GeoAlchemy2 only marks its types uncacheable
+    to be safe.
+    """
+    cache_ok = True
+
+
+class Raster(geoalchemy2.Raster):
+    """
+    GeoAlchemy2 raster that sqlalchemy can cache statements with
+    """
+    cache_ok = True
+
+
 class SnowData(object):
     """
     Base class for which all data will have these attributes
@@ -4,44 +4,76 @@ getting a session, initializing the database, getting table attributes, etc.
 """
 
 import json
+import os
+import threading
+from contextlib import contextmanager
+
+import sqlalchemy
 from sqlalchemy import MetaData, create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import base as pool_base
+
+from .data import Base, PointData
+from .indexes import ensure_indexes
+from .partitions import create_partitioned_points
+from .summaries import drop_summaries
 
-from .data import Base
+# Engines and session factories shared by the whole process, keyed by the
+# connection string and pool settings
+_engines = {}
+_session_factories = {}
+_scoped_sessions = {}
+_lock = threading.Lock()
 
+# Sessions, pools and DBAPI connections a forked child inherited from its
+# parent. They stay referenced for the life of the child so they are never
+# garbage collected, which would reset or close the parent's connections
+# over the sockets both processes share.
+_inherited = []
 
-def initialize(engine):
+
+def initialize(engine, partitions=None):
     """
     Creates the original database from scratch, currently only for
-    point data
+    point data. This drops every table, use migrate.migrate to update the
+    schema of an existing database instead. The summaries of the old data
+    are dropped with it.
 
+    Args:
+        engine: sqlalchemy engine
+        partitions: Optional partitions.PartitionScheme to create the points
+                    table partitioned with
     """
+    drop_summaries(engine)
+
     meta = Base.metadata
     meta.drop_all(bind=engine)
-    meta.create_all(bind=engine)
+
+    if partitions is None:
+        meta.create_all(bind=engine)
+    else:
+        points = PointData.__table__
+        meta.create_all(bind=engine,
+                        tables=[t for t in meta.sorted_tables if t is not points])
+        create_partitioned_points(engine, partitions)
+
+    ensure_indexes(engine)
 
 
-def get_db(db_str, credentials=None, return_metadata=False):
+def _connection_string(db_str, credentials=None, driver='psycopg2'):
     """
-    Returns the DB engine, MetaData, and session object
+    Build the sqlalchemy connection string for a database
 
     Args:
         db_str: Just the name of the database
         credentials: Path to a json file containing username and password for the database
-        return_metadata: Boolean indicating whether the metadata object is
-                         being returned, useful only for developers
+        driver: Name of the postgres driver to connect with
 
     Returns:
-        tuple: **engine** - sqlalchemy Engine object for directly sending
-                            querys to the DB
-               **session** - sqlalchemy Session Object for using object
-                             relational mapping (ORM)
-               **metadata** (optional) - sqlalchemy MetaData object for
-                            modifying the database
+        db: Connection string using the driver
     """
-
-    # This library requires a postgres dialect and the psycopg2 driver
-    prefix = f'postgresql+psycopg2://'
+    # This library requires a postgres dialect, psycopg2 unless async
+    prefix = f'postgresql+{driver}://'
 
     if credentials is not None:
         # Read in the credentials
@@ -54,14 +86,290 @@ def get_db(db_str, credentials=None, return_metadata=False):
     else:
         db = f"{prefix}{db_str}"
 
-    # Always create a Session in US/Mountain TZ
-    engine = create_engine(
-        db, echo=False, connect_args={
-            "options": "-c timezone=us/mountain"})
+    return db
+
+
+def get_engine(db_str, credentials=None, pool_size=5, max_overflow=10,
+               pool_recycle=3600, pool_pre_ping=True):
+    """
+    Returns the engine for a database from a process wide registry so every
+    caller shares one connection pool instead of opening new connections
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        pool_size: Number of connections kept open in the pool
+        max_overflow: Number of connections allowed past pool_size under load
+        pool_recycle: Seconds after which a connection is replaced, avoids
+                      using connections the server or network dropped
+        pool_pre_ping: Check connections are alive before handing them out
+
+    Returns:
+        engine: sqlalchemy Engine object
+    """
+    db = _connection_string(db_str, credentials=credentials)
+    key = (db, pool_size, max_overflow, pool_recycle, pool_pre_ping)
+
+    with _lock:
+        engine = _engines.get(key)
+
+        if engine is None:
+            # Always create a Session in US/Mountain TZ
+            engine = create_engine(
+                db, echo=False, connect_args={
+                    "options": "-c timezone=us/mountain"},
+                pool_size=pool_size, max_overflow=max_overflow,
+                pool_recycle=pool_recycle, pool_pre_ping=pool_pre_ping)
+            _engines[key] = engine
+
+    return engine
+
+
+def get_session_factory(db_str, credentials=None, **kwargs):
+    """
+    Returns a session factory bound to the shared engine of a database
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        kwargs: Pool settings passed to get_engine
+
+    Returns:
+        Session: sqlalchemy sessionmaker, each call makes a new session
+    """
+    engine = get_engine(db_str, credentials=credentials, **kwargs)
+
+    with _lock:
+        Session = _session_factories.get(engine)
+
+        if Session is None:
+            Session = sessionmaker(bind=engine, expire_on_commit=False)
+            _session_factories[engine] = Session
+
+    return Session
+
+
+@contextmanager
+def session_scope(db_str, credentials=None, **kwargs):
+    """
+    Provide a short lived session from the shared pool. Changes are
+    committed when the block finishes, rolled back on an error and the
+    connection is always returned to the pool.
+
+    Usage:
+        with session_scope('localhost/snowex') as session:
+            session.query(...)
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        kwargs: Pool settings passed to get_engine
+
+    Yields:
+        session: sqlalchemy Session object
+    """
+    session = get_session_factory(db_str, credentials=credentials, **kwargs)()
+
+    try:
+        yield session
+        session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+    finally:
+        session.close()
+
+
+def get_scoped_session(db_str, credentials=None, scopefunc=None, **kwargs):
+    """
+    Returns a registry handing out one session per thread, or per whatever
+    scopefunc identifies, all sharing the pool of one engine. Calling the
+    registry gives the session of the current scope, call remove() on it
+    when the scope's work is done to close the session.
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        scopefunc: Optional function returning a key for the current scope
+                   e.g. a task id, defaults to the current thread
+        kwargs: Pool settings passed to get_engine
+
+    Returns:
+        Session: sqlalchemy scoped_session
+    """
+    factory = get_session_factory(db_str, credentials=credentials, **kwargs)
+
+    with _lock:
+        key = (factory, scopefunc)
+        Session = _scoped_sessions.get(key)
+
+        if Session is None:
+            Session = scoped_session(factory, scopefunc=scopefunc)
+            _scoped_sessions[key] = Session
+
+    return Session
+
+
+@contextmanager
+def worker_session(db_str, credentials=None, scopefunc=None, **kwargs):
+    """
+    Provide the session of the current thread (or scope) for a unit of work
+    in a pool of workers. Changes are committed when the block finishes,
+    rolled back on an error and the session is removed so the next task on
+    the thread starts clean. Nested blocks in the same scope share the
+    session and leave committing to the outermost one.
+
+    Usage:
+        def work(site_id):
+            with worker_session('localhost/snowex') as session:
+                return session.query(...).filter(...).all()
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(work, sites))
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        scopefunc: Optional function returning a key for the current scope
+        kwargs: Pool settings passed to get_engine
+
+    Yields:
+        session: sqlalchemy Session object
+    """
+    Session = get_scoped_session(db_str, credentials=credentials,
+                                 scopefunc=scopefunc, **kwargs)
+
+    if Session.registry.has():
+        yield Session()
+        return
+
+    session = Session()
+
+    try:
+        yield session
+        session.commit()
+
+    except Exception:
+        session.rollback()
+        raise
+
+    finally:
+        Session.remove()
+
+
+def dispose_engines():
+    """
+    Close every pooled connection and empty the engine registry
+    """
+    with _lock:
+        for Session in _scoped_sessions.values():
+            Session.remove()
+
+        for engine in _engines.values():
+            engine.dispose()
+
+        _engines.clear()
+        _session_factories.clear()
+        _scoped_sessions.clear()
+
+
+def _after_fork():
+    """
+    Give a forked child process fresh connection pools. The inherited
+    connections belong to the parent, they are detached from the child's
+    sessions and pools and kept referenced so they are never rolled back or
+    closed from the child, leaving the parent's connections and open
+    transactions untouched. Lets process pools use the shared engines and
+    ORM models safely.
+    """
+    global _lock
+    _lock = threading.Lock()
+
+    # Connections checked out at the fork, e.g. by a session mid
+    # transaction. Without a DBAPI connection returning them to the pool
+    # does nothing.
+    checked_out = pool_base._strong_ref_connection_records
+    for ref, record in list(checked_out.items()):
+        fairy = ref()
+        if fairy is not None and fairy.dbapi_connection is not None:
+            _inherited.append(fairy.dbapi_connection)
+            fairy.dbapi_connection = None
+
+        if record.dbapi_connection is not None:
+            _inherited.append(record.dbapi_connection)
+            record.dbapi_connection = None
+
+    for Session in _scoped_sessions.values():
+        # Forget the parent's sessions, a custom scopefunc keeps them in a
+        # dictionary of every scope
+        sessions = Session.registry.registry
+        if isinstance(sessions, dict):
+            _inherited.extend(sessions.values())
+            sessions.clear()
+        else:
+            if Session.registry.has():
+                _inherited.append(Session.registry())
+            Session.registry.clear()
+
+    for engine in _engines.values():
+        # The old pool holds the parent's idle connections
+        _inherited.append(engine.pool)
+        engine.dispose(close=False)
+
+
+def _check_pool_internals():
+    """
+    Make sure the pool internals _after_fork detaches connections through
+    are there. A sqlalchemy release without them would otherwise leave the
+    parent's connections to be reset from every child without any error.
+
+    Raises:
+        ImportError: if sqlalchemy's pool no longer has them
+    """
+    internals = [(pool_base, '_strong_ref_connection_records'),
+                 (pool_base._ConnectionFairy, 'dbapi_connection'),
+                 (pool_base._ConnectionRecord, 'dbapi_connection')]
+    missing = [name for obj, name in internals if not hasattr(obj, name)]
+
+    if missing:
+        raise ImportError(
+            'snowexsql can not keep connections fork safe with sqlalchemy {}, '
+            'its pool is missing {}'.format(sqlalchemy.__version__,
+                                            ', '.join(missing)))
+
+
+if hasattr(os, 'register_at_fork'):
+    _check_pool_internals()
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def get_db(db_str, credentials=None, return_metadata=False, **kwargs):
+    """
+    Returns the DB engine, MetaData, and session object. The engine is
+    shared with every other call for the same database.
+
+    Args:
+        db_str: Just the name of the database
+        credentials: Path to a json file containing username and password for the database
+        return_metadata: Boolean indicating whether the metadata object is
+                         being returned, useful only for developers
+        kwargs: Pool settings passed to get_engine
+
+    Returns:
+        tuple: **engine** - sqlalchemy Engine object for directly sending
+                            querys to the DB
+               **session** - sqlalchemy Session Object for using object
+                             relational mapping (ORM)
+               **metadata** (optional) - sqlalchemy MetaData object for
+                            modifying the database
+    """
+    engine = get_engine(db_str, credentials=credentials, **kwargs)
+    Session = get_session_factory(db_str, credentials=credentials, **kwargs)
 
-    Session = sessionmaker(bind=engine)
     metadata = MetaData(bind=engine)
-    session = Session(expire_on_commit=False)
+    session = Session()
 
     if return_metadata:
         result = (engine, session, metadata)
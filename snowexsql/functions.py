@@ -3,24 +3,33 @@ This module holds all PostGIS functions that have not been mapped yet for use
 with ORM. Many function already exist in GeoAlchemy.functions module
 """
 import geoalchemy2.functions as gfunc
-from geoalchemy2.types import CompositeType, Geometry, Raster
-from sqlalchemy.dialects import postgresql
+from geoalchemy2.types import CompositeType
 from sqlalchemy.types import Float, Integer
 
+from .data import Geometry, Raster
+
 
 class ST_PixelAsPoint(gfunc.GenericFunction):
     name = 'ST_PixelAsPoint'
     type = Geometry
 
 
+class PixelAsPoints(CompositeType):
+    """
+    Row of ST_PixelAsPoints, one per pixel
+    """
+    typemap = {
+        'geom': Geometry,
+        'val': Float,
+        'x': Integer,
+        'y': Integer}
+
+    cache_ok = True
+
+
 class ST_PixelAsPoints(gfunc.GenericFunction):
     name = 'ST_PixelAsPoints'
-    type = CompositeType
-    typemap = {
-        'x': postgresql.ARRAY(Integer),
-        'y': postgresql.ARRAY(Integer),
-        'val': postgresql.ARRAY(Float),
-        'geom': postgresql.ARRAY(Geometry)}
+    type = PixelAsPoints
 
 
 class ST_RasterToWorldCoord(gfunc.GenericFunction):
@@ -0,0 +1,236 @@
+"""
+Module for managing the indexes of the database. Every index the queries in
+this library rely on is listed here so it can be created on any database,
+including ones built before the index was added, and checked against how the
+tables are actually being scanned.
+"""
+from collections import namedtuple
+
+import pandas as pd
+from sqlalchemy import text
+
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+IndexSpec = namedtuple('IndexSpec', ['name', 'table', 'columns', 'using'])
+IndexSpec.__doc__ = """
+A managed index. columns are column names or expressions and using is the
+index method e.g. btree, gist or brin
+"""
+
+# Spatial indexes use the GeoAlchemy2 names so databases built with
+# create_all, which makes them automatically, are left alone
+INDEXES = [
+    # Points, filtered by type then date, site or who collected them
+    IndexSpec('idx_points_geom', 'points', ['geom'], 'gist'),
+    IndexSpec('ix_points_type_date', 'points', ['type', 'date'], 'btree'),
+    IndexSpec('ix_points_site_id', 'points', ['site_id'], 'btree'),
+    IndexSpec('ix_points_surveyors', 'points', ['surveyors'], 'btree'),
+    IndexSpec('ix_points_instrument', 'points', ['instrument'], 'btree'),
+    IndexSpec('brin_points_date', 'points', ['date'], 'brin'),
+
+    # Layers, mostly read a site at a time
+    IndexSpec('idx_layers_geom', 'layers', ['geom'], 'gist'),
+    IndexSpec('ix_layers_site_id_type', 'layers', ['site_id', 'type'], 'btree'),
+    IndexSpec('ix_layers_type_date', 'layers', ['type', 'date'], 'btree'),
+    IndexSpec('ix_layers_surveyors', 'layers', ['surveyors'], 'btree'),
+    IndexSpec('ix_layers_instrument', 'layers', ['instrument'], 'btree'),
+    IndexSpec('brin_layers_date', 'layers', ['date'], 'brin'),
+
+    # Sites
+    IndexSpec('idx_sites_geom', 'sites', ['geom'], 'gist'),
+    IndexSpec('ix_sites_site_id', 'sites', ['site_id'], 'btree'),
+    IndexSpec('ix_sites_date', 'sites', ['date'], 'btree'),
+
+    # Images, tiles are found by their footprint and what raster they are
+    IndexSpec('idx_images_raster', 'images', ['ST_ConvexHull(raster)'], 'gist'),
+    IndexSpec('ix_images_type_surveyors_date', 'images',
+              ['type', 'surveyors', 'date'], 'btree'),
+]
+
+
+def index_sql(index, schema='public', concurrently=False):
+    """
+    Build the CREATE INDEX statement for a managed index. The statement does
+    nothing if the index already exists.
+
+    Args:
+        index: IndexSpec to create
+        schema: Schema of the table
+        concurrently: Build without locking out writes, can't be run inside
+                      a transaction
+
+    Returns:
+        sql: CREATE INDEX statement
+    """
+    return 'CREATE INDEX {}IF NOT EXISTS {} ON {}.{} USING {} ({})'.format(
+        'CONCURRENTLY ' if concurrently else '', index.name, schema,
+        index.table, index.using, ', '.join(index.columns))
+
+
+def existing_indexes(engine, schema='public'):
+    """
+    Retrieve the names of the indexes in the database
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema to look in
+
+    Returns:
+        names: Set of index names
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT indexname FROM pg_indexes WHERE schemaname = :schema'),
+            dict(schema=schema))
+        return {r[0] for r in rows}
+
+
+def partitioned_tables(engine, schema='public'):
+    """
+    Retrieve the names of the partitioned tables in the database. Their
+    indexes can't be built concurrently.
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema to look in
+
+    Returns:
+        names: Set of table names
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT c.relname FROM pg_partitioned_table p '
+            'JOIN pg_class c ON c.oid = p.partrelid '
+            'JOIN pg_namespace n ON n.oid = c.relnamespace '
+            'WHERE n.nspname = :schema'), dict(schema=schema))
+        return {r[0] for r in rows}
+
+
+def ensure_indexes(engine, tables=None, concurrently=False, schema='public'):
+    """
+    Create any managed index missing from the database. Safe to run at any
+    time, existing indexes are left untouched.
+
+    Args:
+        engine: sqlalchemy engine
+        tables: Optional list of table names to limit to
+        concurrently: Build the indexes without blocking writes to the tables,
+                      slower but can be used on a live database. Ignored
+                      for partitioned tables which don't support it.
+        schema: Schema of the tables
+
+    Returns:
+        created: List of the names of the indexes created
+    """
+    existing = existing_indexes(engine, schema=schema)
+    partitioned = partitioned_tables(engine, schema=schema) if concurrently else set()
+    missing = [i for i in INDEXES if i.name not in existing and
+               (tables is None or i.table in tables)]
+
+    created = []
+
+    # CONCURRENTLY can't be used inside a transaction
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as conn:
+        for index in missing:
+            log.info('Creating index {} on {}'.format(index.name, index.table))
+            conn.execute(text(index_sql(
+                index, schema=schema,
+                concurrently=concurrently and index.table not in partitioned)))
+            created.append(index.name)
+
+        # Refresh the planner statistics so the new indexes get used
+        for table in sorted({i.table for i in missing}):
+            conn.execute(text('ANALYZE {}.{}'.format(schema, table)))
+
+    return created
+
+
+def table_scan_stats(engine, schema='public'):
+    """
+    Retrieve how each table has been scanned since the statistics were last
+    reset from pg_stat_user_tables
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema of the tables
+
+    Returns:
+        df: pandas.DataFrame with a row per table
+    """
+    with engine.connect() as conn:
+        result = conn.execute(text(
+            'SELECT relname AS table, n_live_tup AS rows, seq_scan, '
+            'seq_tup_read, COALESCE(idx_scan, 0) AS idx_scan '
+            'FROM pg_stat_user_tables WHERE schemaname = :schema'),
+            dict(schema=schema))
+        return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+
+def advise(stats, existing, min_rows=10000, min_scan_rows=1000):
+    """
+    Decide which tables are being read with sequential scans that an index
+    should have served
+
+    Args:
+        stats: Dataframe from table_scan_stats
+        existing: Set of the index names in the database
+        min_rows: Ignore tables smaller than this, scanning them is cheap
+        min_scan_rows: Ignore tables whose sequential scans read fewer rows
+                       than this on average, e.g. mostly LIMIT queries
+
+    Returns:
+        df: pandas.DataFrame of the flagged tables, worst first
+    """
+    columns = ['table', 'rows', 'seq_scan', 'idx_scan', 'rows_per_scan',
+               'missing_indexes', 'advice']
+    advice = []
+
+    for row in stats.itertuples(index=False):
+        if row.rows < min_rows or row.seq_scan == 0:
+            continue
+
+        rows_per_scan = row.seq_tup_read / row.seq_scan
+        if rows_per_scan < min_scan_rows or row.seq_scan <= row.idx_scan:
+            continue
+
+        missing = [i.name for i in INDEXES
+                   if i.table == row.table and i.name not in existing]
+
+        if missing:
+            msg = 'Run ensure_indexes to create {}'.format(', '.join(missing))
+        else:
+            msg = ('Sequential scans outnumber index scans, check the filters '
+                   'used with EXPLAIN or run ANALYZE')
+
+        advice.append([row.table, row.rows, row.seq_scan, row.idx_scan,
+                       rows_per_scan, missing, msg])
+
+    df = pd.DataFrame(advice, columns=columns)
+    return df.sort_values('rows_per_scan', ascending=False, ignore_index=True)
+
+
+def index_advisor(engine, schema='public', **kwargs):
+    """
+    Report tables being read with sequential scans that should have used an
+    index, based on the counters in pg_stat_user_tables
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema of the tables
+        kwargs: Thresholds passed to advise
+
+    Returns:
+        df: pandas.DataFrame of the flagged tables, worst first
+    """
+    stats = table_scan_stats(engine, schema=schema)
+    existing = existing_indexes(engine, schema=schema)
+    df = advise(stats, existing, **kwargs)
+
+    for row in df.itertuples(index=False):
+        log.info('{}: {:,} sequential scans averaging {:,.0f} rows. {}'.format(
+            row.table, row.seq_scan, row.rows_per_scan, row.advice))
+
+    return df
@@ -0,0 +1,418 @@
+"""
+Module for measuring where the time of database access goes. An
+Instrumentation attached to an engine records every statement through the
+sqlalchemy engine events: the shape of the sql, the time to execute it, the
+time spent fetching the rows, the row count and roughly how many bytes came
+back. The conversions functions report the rest of their time as client
+side decoding. Slow statements can optionally have their plan captured with
+EXPLAIN, which plans the statement without running it again.
+"""
+import functools
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import deque
+
+import pandas as pd
+from sqlalchemy import event
+
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+# Instrumentations currently attached, checked before doing any work so
+# nothing is measured when instrumentation isn't in use
+_active = []
+
+_local = threading.local()
+
+# Rows of each statement sampled to estimate the bytes returned
+SAMPLE_ROWS = 100
+
+# Bytes counted for values that aren't strings or buffers
+VALUE_BYTES = 8
+
+# Longest a plan is waited for before giving up on it
+EXPLAIN_TIMEOUT_MS = 2000
+
+# Reads that lock rows or call functions with side effects aren't explained
+SIDE_EFFECTS = re.compile(
+    r'\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b|'
+    r'\b(pg_advisory_\w+|pg_try_advisory_\w+|nextval|setval|'
+    r'pg_sleep\w*|pg_terminate_backend|pg_cancel_backend|set_config|'
+    r'lo_\w+|dblink\w*)\s*\(', re.IGNORECASE)
+
+
+def statement_shape(sql):
+    """
+    Reduce a statement to its shape so repeats with different values and
+    IN lists of different lengths group together
+
+    Args:
+        sql: SQL string with placeholders
+
+    Returns:
+        shape: Normalized SQL
+    """
+    shape = re.sub(r'%\(\w+\)s|%s|\$\d+', '?', sql)
+    shape = re.sub(r'\?(\s*,\s*\?)+', '?, ...', shape)
+    return ' '.join(shape.split())
+
+
+def _row_bytes(row):
+    """
+    Approximate size of a row as returned by the database
+    """
+    size = 0
+    for v in row:
+        if isinstance(v, (str, bytes, bytearray, memoryview)):
+            size += len(v)
+        elif v is not None:
+            size += VALUE_BYTES
+    return size
+
+
+def _can_explain(sql):
+    """
+    Only plain reads are explained, leaving out ones that lock rows or call
+    functions with side effects like taking an advisory lock
+    """
+    words = sql.lstrip().upper()
+    if SIDE_EFFECTS.search(words):
+        return False
+
+    if words.startswith('SELECT'):
+        return True
+
+    return words.startswith('WITH') and not re.search(
+        r'\b(INSERT|UPDATE|DELETE|MERGE)\b', words)
+
+
+class _TimedCursor(object):
+    """
+    Wraps a DBAPI cursor timing and counting the rows fetched from it. The
+    statement record is finished when the cursor is closed, which
+    sqlalchemy does once the result is exhausted or closed.
+    """
+
+    def __init__(self, cursor, record, owner):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_record', record)
+        object.__setattr__(self, '_owner', owner)
+        object.__setattr__(self, '_sampled', 0)
+        object.__setattr__(self, '_sample_bytes', 0)
+        object.__setattr__(self, '_closed', False)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _fetched(self, rows, seconds):
+        record = self._record
+        record['fetch_seconds'] += seconds
+        record['rows'] += len(rows)
+
+        # Size a sample of the rows and scale up by the row count
+        if self._sampled < SAMPLE_ROWS:
+            sample = rows[:SAMPLE_ROWS - self._sampled]
+            object.__setattr__(self, '_sampled', self._sampled + len(sample))
+            object.__setattr__(self, '_sample_bytes', self._sample_bytes +
+                               sum(_row_bytes(r) for r in sample))
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched([] if row is None else [row], time.perf_counter() - start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        if size is None:
+            rows = self._cursor.fetchmany()
+        else:
+            rows = self._cursor.fetchmany(size)
+        self._fetched(rows, time.perf_counter() - start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(rows, time.perf_counter() - start)
+        return rows
+
+    def close(self):
+        self._cursor.close()
+
+        if not self._closed:
+            object.__setattr__(self, '_closed', True)
+            record = self._record
+
+            if self._sampled:
+                record['bytes'] = int(
+                    self._sample_bytes / self._sampled * record['rows'])
+            elif record['rows'] == 0 and self._cursor.rowcount > 0:
+                # Nothing fetched, e.g. an insert or update
+                record['rows'] = self._cursor.rowcount
+
+            self._owner._finish(record)
+
+
+class Instrumentation(object):
+    """
+    Records the statements run through the engines it is attached to. Use
+    as a context manager to attach for a block of code, records are kept
+    afterwards for reporting. Safe to share between threads.
+
+    Example:
+        with Instrumentation(engine) as stats:
+            df = query_to_geopandas(qry, engine)
+        print(stats.report())
+    """
+
+    def __init__(self, *engines, max_records=100000, explain_threshold=None):
+        """
+        Args:
+            engines: Engines to attach to
+            max_records: Most recent records to keep
+            explain_threshold: Capture the plan of reads taking at least
+                               this many seconds with EXPLAIN on a separate
+                               connection. The statement is only planned,
+                               not run again.
+        """
+        self.explain_threshold = explain_threshold
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self._engines = []
+
+        for engine in engines:
+            self.attach(engine)
+
+    def attach(self, engine):
+        """
+        Start recording the statements of an engine
+        """
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        self._engines.append(engine)
+
+        if self not in _active:
+            _active.append(self)
+
+    def detach(self, engine=None):
+        """
+        Stop recording an engine, or every engine when none is given
+        """
+        engines = self._engines if engine is None else [engine]
+
+        for e in list(engines):
+            event.remove(e, 'before_cursor_execute', self._before)
+            event.remove(e, 'after_cursor_execute', self._after)
+            self._engines.remove(e)
+
+        if not self._engines and self in _active:
+            _active.remove(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        context._snowexsql_start = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        start = getattr(context, '_snowexsql_start', None)
+        if start is None or context is None:
+            return
+
+        record = dict(
+            kind='statement',
+            shape=statement_shape(statement),
+            started=time.time(),
+            execute_seconds=time.perf_counter() - start,
+            fetch_seconds=0.0,
+            decode_seconds=0.0,
+            rows=0,
+            bytes=0,
+            thread=threading.get_ident(),
+            plan=None)
+        record['fingerprint'] = hashlib.sha1(
+            record['shape'].encode('utf-8')).hexdigest()[:16]
+
+        if self.explain_threshold is not None and not executemany:
+            record['_explain'] = (conn.engine, statement, parameters)
+
+        # A named cursor, e.g. psycopg2 with stream_results, has no
+        # description until the first fetch so its rows are counted as fetched
+        streamed = getattr(cursor, 'name', None) is not None
+
+        if executemany or (cursor.description is None and not streamed):
+            record['rows'] = max(cursor.rowcount, 0)
+            self._finish(record)
+        else:
+            context.cursor = _TimedCursor(cursor, record, self)
+
+    def _finish(self, record):
+        explain = record.pop('_explain', None)
+        seconds = record['execute_seconds'] + record['fetch_seconds']
+
+        if explain is not None and seconds >= self.explain_threshold and \
+                _can_explain(explain[1]):
+            record['plan'] = self._explain(*explain)
+
+        # Database time of the conversion calls running on this thread
+        for frame in getattr(_local, 'calls', []):
+            frame['db_seconds'] += seconds
+
+        with self._lock:
+            self._records.append(record)
+
+    def _explain(self, engine, statement, parameters):
+        """
+        Plan a statement with EXPLAIN on a separate connection, returns the
+        plan as JSON text. A timeout stops it waiting on locks held by the
+        connection that ran the statement.
+        """
+        conn = engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT set_config('statement_timeout', %s, true)",
+                           (str(EXPLAIN_TIMEOUT_MS),))
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0]
+            cursor.close()
+            conn.rollback()
+            return plan if isinstance(plan, str) else json.dumps(plan)
+
+        except Exception as e:
+            log.debug('Could not explain statement, {}'.format(e))
+            conn.rollback()
+            return None
+
+        finally:
+            conn.close()
+
+    def _add_call(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def records(self, kind=None):
+        """
+        Retrieve the records as dictionaries
+
+        Args:
+            kind: Only return statement or call records
+
+        Returns:
+            records: List of dictionaries, oldest first
+        """
+        with self._lock:
+            records = list(self._records)
+
+        return [dict(r) for r in records if kind is None or r['kind'] == kind]
+
+    def to_dataframe(self, kind=None):
+        """
+        Records as a pandas.DataFrame, one row per record
+        """
+        return pd.DataFrame(self.records(kind=kind))
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def report(self, top=20):
+        """
+        Summarize the statements by their shape, slowest in total first,
+        along with the time the conversion functions spent decoding
+
+        Args:
+            top: Number of statement shapes to include
+
+        Returns:
+            df: pandas.DataFrame with a row per shape and a row per
+                conversion function
+        """
+        columns = ['kind', 'shape', 'calls', 'total_seconds', 'execute_seconds',
+                   'fetch_seconds', 'decode_seconds', 'rows', 'bytes']
+        df = self.to_dataframe()
+
+        if df.empty:
+            return pd.DataFrame(columns=columns)
+
+        df['total_seconds'] = (df['execute_seconds'] + df['fetch_seconds'] +
+                               df['decode_seconds'])
+        report = df.groupby(['kind', 'shape'], as_index=False).agg(
+            calls=('shape', 'size'),
+            total_seconds=('total_seconds', 'sum'),
+            execute_seconds=('execute_seconds', 'sum'),
+            fetch_seconds=('fetch_seconds', 'sum'),
+            decode_seconds=('decode_seconds', 'sum'),
+            rows=('rows', 'sum'),
+            bytes=('bytes', 'sum'))
+
+        statements = report[report['kind'] == 'statement'].nlargest(
+            top, 'total_seconds')
+        calls = report[report['kind'] == 'call'].sort_values(
+            'total_seconds', ascending=False)
+
+        report = pd.concat([statements, calls], ignore_index=True)[columns]
+
+        for row in report.itertuples(index=False):
+            log.info('{} x{}: {:0.3f}s (execute {:0.3f}s, fetch {:0.3f}s, '
+                     'decode {:0.3f}s), {:,} rows, {:,} bytes'.format(
+                         row.shape[:80], row.calls, row.total_seconds,
+                         row.execute_seconds, row.fetch_seconds,
+                         row.decode_seconds, row.rows, row.bytes))
+
+        return report
+
+
+def timed(fn):
+    """
+    Decorator recording a conversion function as a call record. Time spent
+    outside the statements it runs is reported as decode time. Does nothing
+    unless an Instrumentation is attached.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not _active:
+            return fn(*args, **kwargs)
+
+        calls = getattr(_local, 'calls', None)
+        if calls is None:
+            calls = _local.calls = []
+
+        frame = dict(db_seconds=0.0)
+        calls.append(frame)
+        start = time.perf_counter()
+
+        try:
+            return fn(*args, **kwargs)
+
+        finally:
+            seconds = time.perf_counter() - start
+            calls.pop()
+
+            # Nested calls are part of the outermost one
+            if not calls:
+                record = dict(kind='call', shape=fn.__name__,
+                              started=time.time() - seconds,
+                              execute_seconds=0.0, fetch_seconds=0.0,
+                              decode_seconds=max(seconds - frame['db_seconds'], 0),
+                              rows=0, bytes=0, thread=threading.get_ident(),
+                              plan=None, fingerprint=None)
+                for inst in list(_active):
+                    inst._add_call(record)
+
+    return wrapper
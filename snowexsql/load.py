@@ -0,0 +1,709 @@
+"""
+Module for bulk loading the SnowEx csv formats and rasters into the
+database. Files are parsed into dataframes in batches, geometry is built for
+a whole batch at a time and the rows are streamed into the points, layers,
+sites and images tables with COPY FROM STDIN instead of being added one
+object at a time through the ORM. Rasters are tiled and encoded to PostGIS
+raster WKB across a process pool.
+"""
+import csv
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from pyproj import Transformer
+from rasterio.windows import Window
+from sqlalchemy import text
+
+from .data import ImageData, LayerData, PointData, SiteData
+from .raster import RasterArray, raster_to_wkb
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+# Point measurements by their standardized column name, (type, units)
+POINT_TYPES = {
+    'depth': ('depth', 'cm'),
+    'twt': ('two_way_travel', 'ns'),
+    'avgdensity': ('density', 'kg/m^3'),
+    'swe': ('swe', 'mm'),
+}
+
+# Manual depth instruments by their code in the depths files
+INSTRUMENTS = {'MP': 'magnaprobe', 'M2': 'mesa', 'PR': 'pit ruler'}
+
+# Standardized profile columns holding the depths rather than measurements
+PROFILE_DEPTHS = {'top': 'depth', 'height': 'depth',
+                  'sample_top_height': 'depth', 'bottom': 'bottom_depth'}
+
+# Profile measurements renamed in the database
+PROFILE_RENAMES = {'avg_density': 'density'}
+
+# Site details header keys to SiteData columns
+SITE_COLUMNS = {
+    'location': 'site_name', 'site': 'site_id', 'slope': 'slope_angle',
+    'aspect': 'aspect', 'air_temp': 'air_temp', 'total_depth': 'total_depth',
+    'weather': 'weather_description', 'precip': 'precip', 'sky': 'sky_cover',
+    'wind': 'wind', 'ground_condition': 'ground_condition',
+    'ground_roughness': 'ground_roughness',
+    'ground_vegetation': 'ground_vegetation',
+    'vegetation_height': 'vegetation_height', 'tree_canopy': 'tree_canopy',
+    'comments': 'site_notes'}
+
+# Aspects given as a cardinal direction are stored in degrees
+CARDINALS = {'N': 0, 'NE': 45, 'E': 90, 'SE': 135, 'S': 180, 'SW': 225,
+             'W': 270, 'NW': 315}
+
+# Raster constraints that can be set with AddRasterConstraints in the order
+# of its arguments. Only the srid is set by default since the images table
+# holds rasters of many resolutions and extents.
+RASTER_CONSTRAINTS = ['srid', 'scale_x', 'scale_y', 'blocksize_x',
+                      'blocksize_y', 'same_alignment', 'regular_blocking',
+                      'num_bands', 'pixel_types', 'nodata_values', 'out_db',
+                      'extent']
+
+# Hex pairs of every byte value for encoding geometry in bulk
+_HEX = np.array(['{:02X}'.format(i).encode() for i in range(256)], dtype='S2')
+
+
+def standardize_name(name):
+    """
+    Standardize a column or header name and pull out any units in it
+
+    Args:
+        name: Raw name e.g. 'Depth (cm)' or '# Easting [m]'
+
+    Returns:
+        tuple: **name** - Lower case name with underscores e.g. depth
+               **units** - Units found in brackets or None
+    """
+    name = name.strip().lstrip('\ufeff#').strip()
+    units = re.search(r'[\(\[](.*?)[\)\]]', name)
+    units = units.group(1).strip() if units else None
+
+    name = re.sub(r'\s*[\(\[].*?[\)\]]', '', name).lower()
+    return re.sub(r'[^a-z0-9]+', '_', name).strip('_'), units
+
+
+def points_to_ewkb(x, y, srid):
+    """
+    Encode coordinates as hex EWKB points without a loop over the points
+
+    Args:
+        x: Array of x coordinates
+        y: Array of y coordinates
+        srid: Spatial reference id of the coordinates
+
+    Returns:
+        wkb: Array of hex EWKB strings ready for COPY
+    """
+    n = len(x)
+    records = np.empty(n, dtype=[('order', 'u1'), ('type', '<u4'),
+                                 ('srid', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    records['order'] = 1
+    records['type'] = 0x20000001  # Point with the srid flag set
+    records['srid'] = srid
+    records['x'] = x
+    records['y'] = y
+
+    hexed = _HEX[records.view(np.uint8).reshape(n, -1)]
+    return np.frombuffer(hexed.tobytes(), dtype='S50').astype(str)
+
+
+def _add_location(df, epsg):
+    """
+    Add geometry and any missing lat/lon or utm coordinates to a dataframe
+    """
+    if 'easting' not in df.columns or df['easting'].isna().all():
+        to_utm = Transformer.from_crs(4326, epsg, always_xy=True)
+        df['easting'], df['northing'] = to_utm.transform(
+            df['longitude'].values, df['latitude'].values)
+
+    elif 'latitude' not in df.columns or df['latitude'].isna().all():
+        to_ll = Transformer.from_crs(epsg, 4326, always_xy=True)
+        df['longitude'], df['latitude'] = to_ll.transform(
+            df['easting'].values, df['northing'].values)
+
+    df['geom'] = points_to_ewkb(df['easting'].values, df['northing'].values,
+                                epsg)
+    return df
+
+
+def _local_time(values):
+    """
+    Format datetimes as local time strings, local times in the files are all
+    Mountain Standard Time
+    """
+    return values.dt.strftime('%H:%M:%S') + '-07:00'
+
+
+def _point_rows(df, epsg, metadata):
+    """
+    Convert a batch of a point csv to rows of the points table, one row per
+    measurement in the file
+    """
+    df = df.rename(columns={'utm_wgs84_easting': 'easting',
+                            'utm_wgs84_northing': 'northing'})
+
+    # Magnaprobe/mesa/pit ruler depths
+    if 'measurement_tool' in df.columns:
+        stamp = pd.to_datetime(df['date'].astype(str) + ' ' + df['time'].astype(str),
+                               format='%Y%m%d %H:%M')
+        df['instrument'] = df['measurement_tool'].map(INSTRUMENTS).fillna(
+            df['measurement_tool'])
+        df['time'] = _local_time(stamp)
+
+    # GPR, times are UTC, time of day is HHMMSS.sss
+    elif 'utcyear' in df.columns:
+        tod = df['utctod'].astype(float)
+        seconds = (tod // 10000) * 3600 + (tod // 100 % 100) * 60 + tod % 100
+        stamp = (pd.to_datetime(df['utcyear'].astype(str), format='%Y') +
+                 pd.to_timedelta(df['utcdoy'] - 1, unit='D') +
+                 pd.to_timedelta(seconds, unit='s'))
+        df['instrument'] = 'gpr'
+        df['utm_zone'] = df['utmzone'].str.extract(r'(\d+)', expand=False)
+        df['time'] = stamp.dt.strftime('%H:%M:%S.%f') + '+00:00'
+
+    # Camera derived depths
+    elif 'camera' in df.columns:
+        stamp = pd.to_datetime(df['date_time'])
+        df['instrument'] = 'camera'
+        df['equipment'] = 'camera id = ' + df['camera'].astype(str)
+        df['time'] = _local_time(stamp)
+
+    else:
+        raise ValueError('Unrecognized point data columns {}'.format(
+            ', '.join(df.columns)))
+
+    df['date'] = stamp.dt.strftime('%Y-%m-%d')
+    df = _add_location(df, epsg)
+
+    # One row per measurement type in the file
+    frames = []
+    for column, (data_type, units) in POINT_TYPES.items():
+        if column in df.columns:
+            rows = df.assign(type=data_type, units=units, value=df[column])
+            frames.append(rows[rows['value'].notna()])
+
+    rows = pd.concat(frames, ignore_index=True)
+    return rows.assign(**metadata)
+
+
+def read_point_csv(filename, epsg=26912, chunksize=50000, **metadata):
+    """
+    Read a point data csv (manual depths, GPR or camera depths) in batches
+    of rows for the points table
+
+    Args:
+        filename: Path to the csv
+        epsg: EPSG code of the easting/northing coordinates
+        chunksize: Number of file rows per batch
+        metadata: Values assigned to every row e.g. site_name, surveyors
+
+    Returns:
+        batches: Iterator of dataframes of points table columns
+    """
+    reader = pd.read_csv(filename, chunksize=chunksize, encoding='utf-8-sig')
+
+    for df in reader:
+        df.columns = [standardize_name(c)[0] for c in df.columns]
+        yield _point_rows(df, epsg, metadata)
+
+
+def _split_header(filename):
+    """
+    Split a profile or site file into its '# key,value' header rows and the
+    remaining data lines. Quoted header values can span lines.
+    """
+    with open(filename, encoding='utf-8-sig') as fp:
+        lines = fp.read().splitlines()
+
+    header_lines = []
+    i = 0
+    quoted = False
+
+    # Header lines start with # or continue a quoted value
+    while i < len(lines) and (lines[i].startswith('#') or quoted):
+        line = re.sub(r'^#\s?', '', lines[i])
+        header_lines.append(line)
+        quoted = quoted != (line.count('"') % 2 == 1)
+        i += 1
+
+    header = list(csv.reader(StringIO('\n'.join(header_lines)),
+                             skipinitialspace=True))
+    return [h for h in header if h], lines[i:]
+
+
+def _header_info(header):
+    """
+    Convert the key/value header rows of a profile or site file to a
+    dictionary of standardized keys
+    """
+    info = {}
+    for row in header:
+        if len(row) > 1:
+            info[standardize_name(row[0])[0]] = ','.join(row[1:]).strip()
+
+    return info
+
+
+def _pit_stamp(info):
+    """
+    Parse the local date and time of a pit from its header
+    """
+    value = info.get('date_time', info.get('date_local_time'))
+    return pd.to_datetime(value.replace('T', '-'), format='%Y-%m-%d-%H:%M')
+
+
+def _pit_location(info, epsg):
+    """
+    Build the location columns of a pit from its header
+    """
+    easting = float(info['easting'])
+    northing = float(info['northing'])
+    to_ll = Transformer.from_crs(epsg, 4326, always_xy=True)
+    longitude, latitude = to_ll.transform(easting, northing)
+
+    return dict(easting=easting, northing=northing, latitude=latitude,
+                longitude=longitude,
+                utm_zone=re.sub(r'\D', '', info.get('utm_zone', '')) or None,
+                geom=points_to_ewkb([easting], [northing], epsg)[0])
+
+
+def _to_text(value):
+    """
+    Format a layer value as text, the layers value column is a string.
+    Averages are rounded to drop floating point noise
+    """
+    if pd.isna(value):
+        return None
+    elif isinstance(value, float):
+        return str(round(value, 6))
+    return str(value)
+
+
+def read_profile_csv(filename, epsg=26912, **metadata):
+    """
+    Read a pit profile csv (density, LWC, SSA, temperature, stratigraphy)
+    into rows for the layers table, one row per measurement per layer.
+    Measurements with multiple samples e.g. density A/B/C are stored as
+    sample_a/b/c with the average as the value.
+
+    Args:
+        filename: Path to the csv
+        epsg: EPSG code of the easting/northing coordinates
+        metadata: Values assigned to every row e.g. surveyors
+
+    Returns:
+        df: Dataframe of layers table columns
+    """
+    header, lines = _split_header(filename)
+
+    # The last header row names the columns
+    names = [standardize_name(c) for c in header[-1]]
+    info = _header_info(header[:-1])
+
+    df = pd.read_csv(StringIO('\n'.join(lines)), header=None,
+                     names=[n for n, u in names], skipinitialspace=True)
+    units = dict(names)
+    df = df.rename(columns=PROFILE_DEPTHS)
+
+    comments = df.pop('comments') if 'comments' in df.columns else None
+    stamp = _pit_stamp(info)
+
+    # Group the sample columns e.g. density_a, density_b under density
+    groups = {}
+    for c in df.columns:
+        if c in ['depth', 'bottom_depth']:
+            continue
+        base = re.sub(r'_[a-c]$', '', c)
+        groups.setdefault(PROFILE_RENAMES.get(base, base), []).append(c)
+
+    frames = []
+    for data_type, columns in groups.items():
+        rows = pd.DataFrame({'depth': df['depth'],
+                             'bottom_depth': df.get('bottom_depth')})
+
+        if len(columns) > 1:
+            samples = df[columns].astype(float)
+            for letter, c in zip('abc', columns):
+                rows['sample_' + letter] = samples[c].map(_to_text)
+            values = samples.mean(axis=1)
+        else:
+            values = df[columns[0]]
+
+        rows['value'] = values.map(_to_text)
+        rows['type'] = data_type
+        rows['units'] = units.get(columns[0])
+
+        if comments is not None:
+            rows['comments'] = comments
+
+        frames.append(rows[rows['value'].notna()])
+
+    rows = pd.concat(frames, ignore_index=True)
+    rows = rows.assign(site_name=info.get('location'), site_id=info.get('site'),
+                       date=stamp.strftime('%Y-%m-%d'),
+                       time=stamp.strftime('%H:%M:%S') + '-07:00',
+                       **_pit_location(info, epsg))
+
+    if 'instrument' in info:
+        rows['instrument'] = info['instrument']
+
+    return rows.assign(**metadata)
+
+
+def read_site_csv(filename, epsg=26912, **metadata):
+    """
+    Read a site details csv into a row for the sites table
+
+    Args:
+        filename: Path to the csv
+        epsg: EPSG code of the easting/northing coordinates
+        metadata: Values assigned to the row
+
+    Returns:
+        df: Dataframe with a single row of sites table columns
+    """
+    header, lines = _split_header(filename)
+    info = _header_info(header)
+    stamp = _pit_stamp(info)
+
+    row = {column: info.get(key) for key, column in SITE_COLUMNS.items()}
+
+    # Numbers are given with units or as cardinal directions
+    for column in ['slope_angle', 'air_temp', 'total_depth']:
+        value = re.sub(r'[^0-9.\-]', '', row[column] or '')
+        row[column] = float(value) if value else None
+
+    aspect = (row['aspect'] or '').strip()
+    if aspect.upper() in CARDINALS:
+        row['aspect'] = float(CARDINALS[aspect.upper()])
+    else:
+        value = re.sub(r'[^0-9.\-]', '', aspect)
+        row['aspect'] = float(value) if value else None
+
+    row.update(date=stamp.strftime('%Y-%m-%d'),
+               time=stamp.strftime('%H:%M:%S') + '-07:00',
+               **_pit_location(info, epsg))
+    row.update(metadata)
+
+    return pd.DataFrame([row])
+
+
+def copy_rows(cursor, table, df):
+    """
+    Stream a dataframe into a table with COPY FROM STDIN. Only the columns
+    of the table are sent, the rest get their defaults.
+
+    Args:
+        cursor: psycopg2 cursor
+        table: sqlalchemy Table to load
+        df: Dataframe of rows
+
+    Returns:
+        count: Number of rows copied
+    """
+    skip = ['id', 'time_created', 'time_updated']
+    columns = [c.name for c in table.columns
+               if c.name in df.columns and c.name not in skip]
+
+    buf = StringIO()
+    df[columns].to_csv(buf, index=False, header=False)
+    buf.seek(0)
+
+    cursor.copy_expert(
+        'COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.schema or 'public', table.name, ', '.join(columns)), buf)
+
+    return len(df)
+
+
+def bulk_load(engine, table, batches):
+    """
+    Copy batches of rows into a table in a single transaction, reporting
+    the load rate
+
+    Args:
+        engine: sqlalchemy engine
+        table: sqlalchemy Table to load
+        batches: Iterable of dataframes
+
+    Returns:
+        stats: Dictionary of rows, seconds and rows_per_sec
+    """
+    start = time.perf_counter()
+    count = 0
+    conn = engine.raw_connection()
+
+    try:
+        cursor = conn.cursor()
+
+        for df in batches:
+            count += copy_rows(cursor, table, df)
+
+        cursor.close()
+        conn.commit()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    seconds = time.perf_counter() - start
+    stats = dict(rows=count, seconds=seconds,
+                 rows_per_sec=count / seconds if seconds > 0 else 0.0)
+
+    log.info('Loaded {:,} rows into {} in {:0.2f}s ({:,.0f} rows/s)'.format(
+        count, table.name, seconds, stats['rows_per_sec']))
+
+    return stats
+
+
+def load_points(engine, filename, epsg=26912, batch_size=50000, **metadata):
+    """
+    Bulk load a point data csv into the points table
+
+    Args:
+        engine: sqlalchemy engine
+        filename: Path to the csv
+        epsg: EPSG code of the coordinates
+        batch_size: File rows per batch, bounds the memory used
+        metadata: Values assigned to every row e.g. site_name, surveyors
+
+    Returns:
+        stats: Dictionary of rows, seconds and rows_per_sec
+    """
+    batches = read_point_csv(filename, epsg=epsg, chunksize=batch_size,
+                             **metadata)
+    return bulk_load(engine, PointData.__table__, batches)
+
+
+def load_profile(engine, filename, epsg=26912, **metadata):
+    """
+    Bulk load a pit profile csv into the layers table
+
+    Args:
+        engine: sqlalchemy engine
+        filename: Path to the csv
+        epsg: EPSG code of the coordinates
+        metadata: Values assigned to every row e.g. surveyors
+
+    Returns:
+        stats: Dictionary of rows, seconds and rows_per_sec
+    """
+    df = read_profile_csv(filename, epsg=epsg, **metadata)
+    return bulk_load(engine, LayerData.__table__, [df])
+
+
+def load_site(engine, filename, epsg=26912, **metadata):
+    """
+    Bulk load a site details csv into the sites table
+
+    Args:
+        engine: sqlalchemy engine
+        filename: Path to the csv
+        epsg: EPSG code of the coordinates
+        metadata: Values assigned to the row
+
+    Returns:
+        stats: Dictionary of rows, seconds and rows_per_sec
+    """
+    df = read_site_csv(filename, epsg=epsg, **metadata)
+    return bulk_load(engine, SiteData.__table__, [df])
+
+
+def raster_windows(width, height, tile_size=(256, 256)):
+    """
+    Split a raster into tile windows, tiles on the right and bottom edges
+    are cut short rather than padded
+
+    Args:
+        width: Raster width in pixels
+        height: Raster height in pixels
+        tile_size: (width, height) of the tiles in pixels
+
+    Returns:
+        windows: List of rasterio Windows in row major order
+    """
+    tile_w, tile_h = tile_size
+    return [Window(col, row, min(tile_w, width - col), min(tile_h, height - row))
+            for row in range(0, height, tile_h)
+            for col in range(0, width, tile_w)]
+
+
+def _is_empty(bands, nodata):
+    """
+    Check whether every pixel of every band is nodata, nan counts as nodata
+    for floating point bands
+    """
+    for band, value in zip(bands, nodata):
+        if band.dtype.kind == 'f' and (value is None or np.isnan(value)):
+            missing = np.isnan(band)
+        elif value is None:
+            return False
+        else:
+            missing = band == value
+
+        if not missing.all():
+            return False
+
+    return True
+
+
+def _encode_tiles(filename, windows, srid, skip_empty):
+    """
+    Read and encode a batch of tiles. Runs in the worker processes so the
+    file is opened once per batch.
+    """
+    tiles = []
+
+    with rasterio.open(filename) as src:
+        nodata = list(src.nodatavals)
+
+        for window in windows:
+            bands = list(src.read(window=window))
+
+            if skip_empty and _is_empty(bands, nodata):
+                continue
+
+            # Upper left corner of the tile
+            t = src.transform
+            col, row = window.col_off, window.row_off
+            transform = Affine(t.a, t.b, t.c + col * t.a + row * t.b,
+                               t.d, t.e, t.f + col * t.d + row * t.e)
+            raster = RasterArray(bands, transform, srid, nodata)
+            tiles.append(raster_to_wkb(raster))
+
+    return tiles
+
+
+def read_raster_tiles(filename, epsg=None, tile_size=(256, 256),
+                      max_workers=None, batch_size=64, skip_empty=True,
+                      **metadata):
+    """
+    Cut a raster file (GeoTIFF, ADF or anything rasterio opens) into tiles
+    encoded as PostGIS raster WKB. Batches of tiles are read and encoded
+    across a process pool.
+
+    Args:
+        filename: Path to the raster
+        epsg: EPSG code of the raster, defaults to the one in the file
+        tile_size: (width, height) of the tiles in pixels
+        max_workers: Number of processes, defaults to the number of cores.
+                     1 encodes in this process.
+        batch_size: Tiles per batch handed to a worker
+        skip_empty: Skip tiles where every pixel is nodata
+        metadata: Values assigned to every tile e.g. type, surveyors, date
+
+    Returns:
+        batches: Iterator of dataframes of images table columns
+    """
+    with rasterio.open(filename) as src:
+        srid = epsg or (src.crs.to_epsg() if src.crs else None)
+        windows = raster_windows(src.width, src.height, tile_size=tile_size)
+
+    if srid is None:
+        raise ValueError('No EPSG code found for {}, pass one with '
+                         'epsg'.format(filename))
+
+    batches = [windows[i:i + batch_size]
+               for i in range(0, len(windows), batch_size)]
+    args = [(filename, b, srid, skip_empty) for b in batches]
+
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if max_workers == 1 or len(batches) == 1:
+        results = (_encode_tiles(*a) for a in args)
+    else:
+        results = _encode_in_pool(args, max_workers)
+
+    for tiles in results:
+        if tiles:
+            # Raster columns take hex WKB as text
+            yield pd.DataFrame({'raster': [t.hex() for t in tiles]}).assign(
+                **metadata)
+
+
+def _encode_in_pool(args, max_workers):
+    """
+    Encode batches of tiles across a process pool yielding them in order.
+    Only a couple of batches per worker are in flight so memory stays
+    bounded when the database is slower than the encoding.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+
+        for a in args:
+            pending.append(pool.submit(_encode_tiles, *a))
+
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def add_raster_constraints(engine, constraints=('srid',), table='images',
+                           schema='public'):
+    """
+    Set raster constraints on the raster column so it is registered with
+    its properties in raster_columns. This is a one off maintenance step,
+    existing constraints of the same kind are replaced and every tile in the
+    table is scanned to check it satisfies the new ones.
+
+    The constraints hold for the whole table, with the srid constraint every
+    raster loaded afterwards has to be in the same srid, e.g. a raster in
+    another UTM zone can no longer be loaded. Drop them with
+    DropRasterConstraints before loading one.
+
+    Args:
+        engine: sqlalchemy engine
+        constraints: Names of the constraints to set, see RASTER_CONSTRAINTS
+        table: Table holding the raster column
+        schema: Schema of the table
+    """
+    unknown = set(constraints) - set(RASTER_CONSTRAINTS)
+    if unknown:
+        raise ValueError('Unknown raster constraints {}'.format(
+            ', '.join(sorted(unknown))))
+
+    flags = ', '.join('TRUE' if c in constraints else 'FALSE'
+                      for c in RASTER_CONSTRAINTS)
+    args = "'{}', '{}', 'raster', {}".format(schema, table, flags)
+
+    with engine.begin() as conn:
+        conn.execute(text('SELECT DropRasterConstraints({})'.format(args)))
+        conn.execute(text('SELECT AddRasterConstraints({})'.format(args)))
+
+
+def load_raster(engine, filename, epsg=None, tile_size=(256, 256),
+                max_workers=None, **metadata):
+    """
+    Bulk load a raster file into the images table, tiling and encoding it in
+    parallel and streaming the tiles in with COPY. No raster constraints
+    are set, see add_raster_constraints.
+
+    Args:
+        engine: sqlalchemy engine
+        filename: Path to the raster
+        epsg: EPSG code of the raster, defaults to the one in the file
+        tile_size: (width, height) of the tiles in pixels
+        max_workers: Number of encoding processes, defaults to the cores
+        metadata: Values assigned to every tile e.g. type, surveyors, date
+
+    Returns:
+        stats: Dictionary of rows, seconds and rows_per_sec
+    """
+    batches = read_raster_tiles(filename, epsg=epsg, tile_size=tile_size,
+                                max_workers=max_workers, **metadata)
+    return bulk_load(engine, ImageData.__table__, batches)
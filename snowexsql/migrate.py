@@ -0,0 +1,315 @@
+"""
+Module for migrating an existing database to the models in snowexsql.data
+without rebuilding it. The live schema is compared against the models and
+only additive changes are applied: new tables, new columns, widened column
+types and missing indexes. Nothing is ever dropped or narrowed, anything
+that would need that is reported instead. Every applied step is recorded in
+a versioned migrations table.
+
+New columns and indexes are applied without blocking reads or writes for
+long. Widening a column is not: lengthening a varchar only changes the
+catalog, but integer to bigint and real to double precision rewrite the
+whole table under an ACCESS EXCLUSIVE lock, blocking every read and write of
+it until done. Plan those for a maintenance window on large tables.
+"""
+from collections import namedtuple
+
+from sqlalchemy import (BigInteger, Column, DateTime, Float, Integer,
+                        MetaData, SmallInteger, String, Table, Text, inspect,
+                        text)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sqlalchemy.sql import func
+
+from .data import Base
+from .indexes import INDEXES, existing_indexes, index_sql, partitioned_tables
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+MigrationStep = namedtuple('MigrationStep', ['key', 'sql', 'transactional'])
+MigrationStep.__doc__ = """
+A single schema change. key names what it changes e.g. add_column:points.doi
+and transactional is False for steps that can't run inside a transaction
+"""
+
+# Arbitrary key for the advisory lock stopping two migrations at once
+LOCK_KEY = 80615
+
+migrations_meta = MetaData()
+
+MigrationsTable = Table(
+    'snowexsql_migrations', migrations_meta,
+    Column('version', Integer, primary_key=True),
+    Column('key', String(250)),
+    Column('sql', Text),
+    Column('applied', DateTime(timezone=True), server_default=func.now()),
+    schema='public')
+
+
+def _float_size(t):
+    """
+    Bytes of a floating point type, REAL is 4 and FLOAT/DOUBLE PRECISION is 8
+    """
+    if isinstance(t, postgresql.REAL):
+        return 4
+
+    precision = getattr(t, 'precision', None)
+    return 4 if precision is not None and precision <= 24 else 8
+
+
+def _integer_size(t):
+    """
+    Bytes of an integer type
+    """
+    if isinstance(t, SmallInteger):
+        return 2
+    elif isinstance(t, BigInteger):
+        return 8
+    return 4
+
+
+def compare_types(live, model):
+    """
+    Compare a column type in the database to the type in the model
+
+    Args:
+        live: Reflected sqlalchemy type of the database column
+        model: sqlalchemy type of the model column
+
+    Returns:
+        result: 'same' when nothing needs to change, 'widen' when the
+                database type can be altered to the model type without
+                losing data and 'conflict' otherwise
+    """
+    live_affinity = live._type_affinity
+    model_affinity = model._type_affinity
+
+    if live_affinity is not model_affinity or \
+            getattr(live, 'name', None) != getattr(model, 'name', None):
+        return 'conflict'
+
+    if model_affinity is String:
+        live_len = getattr(live, 'length', None) or float('inf')
+        model_len = getattr(model, 'length', None) or float('inf')
+
+    elif model_affinity is Integer:
+        live_len, model_len = _integer_size(live), _integer_size(model)
+
+    elif isinstance(model, Float) and isinstance(live, Float):
+        live_len, model_len = _float_size(live), _float_size(model)
+
+    else:
+        return 'same'
+
+    if model_len == live_len:
+        return 'same'
+
+    return 'widen' if model_len > live_len else 'conflict'
+
+
+def diff_schema(live, metadata=Base.metadata, dialect=None, indexes=None,
+                partitioned=None):
+    """
+    Compare a live schema with the models producing the steps to migrate
+    it. Pure function, the live schema is passed in.
+
+    Args:
+        live: Dictionary of table name to a dictionary of column name to
+              reflected type
+        metadata: MetaData of the models
+        dialect: Dialect to compile the statements for
+        indexes: Set of index names in the database
+        partitioned: Set of partitioned table names, their indexes can't be
+                     built concurrently
+
+    Returns:
+        tuple: **steps** - List of MigrationStep in the order to apply
+               **conflicts** - List of messages describing differences that
+                               can't be migrated without losing data
+    """
+    dialect = dialect or postgresql.dialect()
+    indexes = indexes or set()
+    partitioned = partitioned or set()
+    steps = []
+    conflicts = []
+
+    for table in metadata.sorted_tables:
+        name = '{}.{}'.format(table.schema or 'public', table.name)
+
+        if table.name not in live:
+            steps.append(MigrationStep(
+                'create_table:{}'.format(table.name),
+                str(CreateTable(table).compile(dialect=dialect)).strip(), True))
+            continue
+
+        columns = live[table.name]
+
+        for column in table.columns:
+            key = '{}.{}'.format(table.name, column.name)
+
+            if column.name not in columns:
+                if column.primary_key:
+                    conflicts.append('{} is a missing primary key'.format(key))
+                    continue
+
+                spec = CreateColumn(column).compile(dialect=dialect)
+                steps.append(MigrationStep(
+                    'add_column:{}'.format(key),
+                    'ALTER TABLE {} ADD COLUMN IF NOT EXISTS {}'.format(name, spec),
+                    True))
+                continue
+
+            result = compare_types(columns[column.name], column.type)
+
+            if result == 'widen':
+                steps.append(MigrationStep(
+                    'widen_column:{}'.format(key),
+                    'ALTER TABLE {} ALTER COLUMN {} TYPE {}'.format(
+                        name, column.name, column.type.compile(dialect=dialect)),
+                    True))
+
+            elif result == 'conflict':
+                conflicts.append('{} is {} in the database but {} in the '
+                                 'model'.format(key, columns[column.name],
+                                                column.type))
+
+    # Indexes go last so new columns exist, built without blocking writes
+    # where postgres allows it
+    for index in INDEXES:
+        if index.name not in indexes:
+            concurrently = index.table not in partitioned
+            steps.append(MigrationStep(
+                'create_index:{}'.format(index.name),
+                index_sql(index, concurrently=concurrently), not concurrently))
+
+    return steps, conflicts
+
+
+def reflect_schema(engine, schema='public'):
+    """
+    Read the tables and column types in the database
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema to read
+
+    Returns:
+        live: Dictionary of table name to a dictionary of column name to
+              reflected type
+    """
+    inspector = inspect(engine)
+    live = {}
+
+    for table in inspector.get_table_names(schema=schema):
+        live[table] = {c['name']: c['type']
+                       for c in inspector.get_columns(table, schema=schema)}
+
+    return live
+
+
+def plan_migration(engine, schema='public'):
+    """
+    Work out the steps needed to bring the database up to the models
+
+    Args:
+        engine: sqlalchemy engine
+        schema: Schema of the tables
+
+    Returns:
+        tuple: **steps** - List of MigrationStep in the order to apply
+               **conflicts** - List of differences that can't be migrated
+    """
+    live = reflect_schema(engine, schema=schema)
+    indexes = existing_indexes(engine, schema=schema)
+    partitioned = partitioned_tables(engine, schema=schema)
+
+    return diff_schema(live, dialect=engine.dialect, indexes=indexes,
+                       partitioned=partitioned)
+
+
+def schema_version(engine):
+    """
+    Retrieve the version of the last applied migration step
+
+    Args:
+        engine: sqlalchemy engine
+
+    Returns:
+        version: Integer version, 0 when nothing has been migrated
+    """
+    MigrationsTable.create(bind=engine, checkfirst=True)
+
+    with engine.connect() as conn:
+        version = conn.execute(
+            func.max(MigrationsTable.c.version).select()).scalar()
+
+    return version or 0
+
+
+def _log_conflicts(conflicts):
+    for c in conflicts:
+        log.warning('Skipping {}'.format(c))
+
+
+def migrate(engine, dry_run=False, schema='public'):
+    """
+    Apply every additive change needed to bring the database up to the
+    models. Each step commits on its own and is recorded in the
+    snowexsql_migrations table so an interrupted migration picks up where
+    it stopped when run again. Widening column types rewrites tables and
+    blocks them while it runs, see the module docstring.
+
+    Args:
+        engine: sqlalchemy engine
+        dry_run: Only plan and log the steps
+        schema: Schema of the tables
+
+    Returns:
+        steps: List of the MigrationStep applied (or planned for a dry run)
+    """
+    if dry_run:
+        steps, conflicts = plan_migration(engine, schema=schema)
+        _log_conflicts(conflicts)
+
+        for step in steps:
+            log.info('Would run {}'.format(step.sql))
+        return steps
+
+    MigrationsTable.create(bind=engine, checkfirst=True)
+
+    # Only one migration runs at a time, the lock is held by this connection
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as lock:
+        lock.execute(text('SELECT pg_advisory_lock(:key)'), dict(key=LOCK_KEY))
+
+        try:
+            # Plan under the lock so a migration that waited for another
+            # sees the schema it left behind
+            steps, conflicts = plan_migration(engine, schema=schema)
+            _log_conflicts(conflicts)
+
+            for step in steps:
+                if step.key.startswith('widen_column:'):
+                    log.warning('Applying {}, this may rewrite the table and '
+                                'block it until done'.format(step.key))
+                else:
+                    log.info('Applying {}'.format(step.key))
+
+                record = MigrationsTable.insert().values(key=step.key, sql=step.sql)
+
+                if step.transactional:
+                    # Apply and record the step together
+                    with engine.begin() as conn:
+                        conn.execute(text(step.sql))
+                        conn.execute(record)
+
+                else:
+                    lock.execute(text(step.sql))
+                    lock.execute(record)
+
+        finally:
+            lock.execute(text('SELECT pg_advisory_unlock(:key)'),
+                         dict(key=LOCK_KEY))
+
+    return steps
@@ -0,0 +1,244 @@
+"""
+Module for partitioning the points table. Points can be split by list on
+type, by range on date in water years or by both, with type first. Queries
+filtered on type and date then only scan the partitions that can hold
+matches, and vacuum and index maintenance work a partition at a time.
+Partitioning is opt in, the models are unchanged and an unpartitioned
+points table keeps working as before.
+"""
+import re
+from collections import namedtuple
+from datetime import date
+
+from sqlalchemy import MetaData, PrimaryKeyConstraint, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+
+from .data import PointData
+from .indexes import INDEXES, index_sql, partitioned_tables
+from .migrate import LOCK_KEY, MigrationsTable
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+PartitionScheme = namedtuple('PartitionScheme', ['by', 'types', 'water_years'],
+                             defaults=[('type',), None, None])
+PartitionScheme.__doc__ = """
+How to partition the points table. by is the partition keys in order, any
+of type and date. types get a partition each and water_years a partition
+each from October 1st of the year before, anything else lands in a default
+partition. Rows need a type, and a date when partitioned on date.
+"""
+
+# Types given their own partition when none are listed
+PARTITION_TYPES = ['depth', 'two_way_travel', 'density', 'swe']
+
+# Water years given their own partition when none are listed, the SnowEx
+# campaigns so far
+WATER_YEARS = list(range(2017, 2025))
+
+# Partition method of each key
+METHODS = {'type': 'LIST (type)', 'date': 'RANGE (date)'}
+
+
+def _suffix(value):
+    """
+    Make a value safe to use in a partition name
+    """
+    return re.sub(r'\W+', '_', str(value).lower()).strip('_')
+
+
+def _bounds(key, scheme):
+    """
+    Partition name suffix and bound of each partition of a key, the default
+    partition last
+    """
+    if key == 'type':
+        bounds = [(_suffix(t), "FOR VALUES IN ('{}')".format(t.replace("'", "''")))
+                  for t in scheme.types or PARTITION_TYPES]
+    else:
+        bounds = [('wy{}'.format(y), "FOR VALUES FROM ('{}') TO ('{}')".format(
+            date(y - 1, 10, 1), date(y, 10, 1)))
+            for y in scheme.water_years or WATER_YEARS]
+
+    return bounds + [('default', 'DEFAULT')]
+
+
+def partitioned_table(scheme, metadata=None):
+    """
+    Build the partitioned version of the points table. The partition keys
+    join id in the primary key since postgres requires it.
+
+    Args:
+        scheme: PartitionScheme to use
+        metadata: MetaData to add the table to, defaults to a new one
+
+    Returns:
+        table: sqlalchemy Table partitioned on the first key
+    """
+    by = list(scheme.by)
+    if not by or set(by) - set(METHODS) or len(set(by)) != len(by):
+        raise ValueError('Points can be partitioned by type and/or date, '
+                         'not {}'.format(', '.join(by)))
+
+    table = PointData.__table__.to_metadata(metadata or MetaData())
+
+    # A composite key only gets a serial id when asked for
+    table.c.id.autoincrement = True
+    for key in by:
+        table.c[key].primary_key = True
+
+    table.append_constraint(PrimaryKeyConstraint('id', *by))
+    table.dialect_options['postgresql']['partition_by'] = METHODS[by[0]]
+
+    return table
+
+
+def _partitions(parent, prefix, keys, scheme, schema):
+    """
+    Statements creating the partitions of a parent, named from prefix,
+    recursing into the sub partitions of the remaining keys
+    """
+    statements = []
+
+    for suffix, bound in _bounds(keys[0], scheme):
+        name = '{}_{}'.format(prefix, suffix)
+        sql = 'CREATE TABLE {0}.{1} PARTITION OF {0}.{2} {3}'.format(
+            schema, name, parent, bound)
+
+        if len(keys) > 1:
+            statements.append(sql + ' PARTITION BY ' + METHODS[keys[1]])
+            statements += _partitions(name, name, keys[1:], scheme, schema)
+        else:
+            statements.append(sql)
+
+    return statements
+
+
+def partition_ddl(scheme, dialect=None, name=None):
+    """
+    Build the statements creating the partitioned points table and every
+    partition
+
+    Args:
+        scheme: PartitionScheme to use
+        dialect: Dialect to compile for
+        name: Create the table under this name instead of points, the
+              partitions are still named after points
+
+    Returns:
+        statements: List of SQL strings in the order to run
+    """
+    table = partitioned_table(scheme)
+    prefix = table.name
+    if name is not None:
+        table.name = name
+
+    schema = table.schema or 'public'
+    create = CreateTable(table).compile(dialect=dialect or postgresql.dialect())
+
+    return [str(create).strip()] + _partitions(table.name, prefix,
+                                               list(scheme.by), scheme, schema)
+
+
+def is_partitioned(engine, schema='public'):
+    """
+    Check whether the points table is partitioned
+    """
+    return PointData.__tablename__ in partitioned_tables(engine, schema=schema)
+
+
+def create_partitioned_points(engine, scheme):
+    """
+    Create the partitioned points table and its partitions in an empty
+    database, used by db.initialize
+
+    Args:
+        engine: sqlalchemy engine
+        scheme: PartitionScheme to use
+    """
+    with engine.begin() as conn:
+        for sql in partition_ddl(scheme, dialect=engine.dialect):
+            conn.execute(text(sql))
+
+
+def partition_points(engine, scheme, schema='public'):
+    """
+    Migrate an existing points table to a partitioned one. The partitioned
+    table is built, filled and indexed under a temporary name while the old
+    table stays readable, writes to points wait for the migration to finish.
+    The old table is then swapped out in the same transaction, reads only
+    wait for the drop and renames at the end.
+
+    Args:
+        engine: sqlalchemy engine
+        scheme: PartitionScheme to use
+        schema: Schema of the points table
+
+    Returns:
+        migrated: False when points was already partitioned
+    """
+    if is_partitioned(engine, schema=schema):
+        log.info('points is already partitioned')
+        return False
+
+    MigrationsTable.create(bind=engine, checkfirst=True)
+    new = 'points_partitioned'
+    statements = partition_ddl(scheme, dialect=engine.dialect, name=new)
+    columns = ', '.join(c.name for c in PointData.__table__.columns)
+    indexes = [index for index in INDEXES if index.table == 'points']
+
+    with engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as lock:
+        lock.execute(text('SELECT pg_advisory_lock(:key)'), dict(key=LOCK_KEY))
+
+        try:
+            with engine.begin() as conn:
+                # Writes wait from here, reads carry on
+                conn.execute(text('LOCK TABLE {}.points IN SHARE MODE'.format(
+                    schema)))
+
+                for sql in statements:
+                    conn.execute(text(sql))
+
+                log.info('Copying points into partitions by {}'.format(
+                    ', '.join(scheme.by)))
+                conn.execute(text(
+                    'INSERT INTO {0}.{2} ({1}) SELECT {1} FROM {0}.points'.format(
+                        schema, columns, new)))
+
+                for index in indexes:
+                    conn.execute(text(index_sql(index._replace(
+                        name='{}_{}'.format(index.name, new), table=new),
+                        schema=schema)))
+
+                # Swap the tables, its sequence and indexes go with the old
+                # one and the new ones take their names
+                log.info('Swapping in the partitioned points table')
+                conn.execute(text('DROP TABLE {}.points'.format(schema)))
+                conn.execute(text('ALTER TABLE {0}.{1} RENAME TO points'.format(
+                    schema, new)))
+                conn.execute(text('ALTER TABLE {0}.points RENAME CONSTRAINT '
+                                  '{1}_pkey TO points_pkey'.format(schema, new)))
+                conn.execute(text('ALTER SEQUENCE {0}.{1}_id_seq RENAME TO '
+                                  'points_id_seq'.format(schema, new)))
+
+                for index in indexes:
+                    conn.execute(text('ALTER INDEX {0}.{1}_{2} RENAME TO {1}'.format(
+                        schema, index.name, new)))
+
+                conn.execute(text(
+                    "SELECT setval('{0}.points_id_seq', COALESCE("
+                    "(SELECT max(id) FROM {0}.points), 0) + 1, false)".format(schema)))
+
+                conn.execute(MigrationsTable.insert().values(
+                    key='partition_table:points',
+                    sql=';\n'.join(statements)))
+
+            lock.execute(text('ANALYZE {}.points'.format(schema)))
+
+        finally:
+            lock.execute(text('SELECT pg_advisory_unlock(:key)'),
+                         dict(key=LOCK_KEY))
+
+    return True
@@ -0,0 +1,341 @@
+"""
+Module for moving data in and out of the database using the PostgreSQL
+binary COPY format. Reading with COPY skips the row by row fetch of the
+driver and lets fixed width columns be decoded straight into numpy arrays.
+"""
+import struct
+from datetime import time, timedelta, timezone
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+
+# Microseconds/days are counted from 2000-01-01 in the binary format
+PG_EPOCH_DAYS = np.datetime64('2000-01-01', 'D')
+PG_EPOCH_US = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# Fixed width types by OID, these are decoded directly from the buffer
+FIXED_TYPES = {
+    16: np.dtype('?'),  # bool
+    20: np.dtype('>i8'),  # int8
+    21: np.dtype('>i2'),  # int2
+    23: np.dtype('>i4'),  # int4
+    26: np.dtype('>u4'),  # oid
+    700: np.dtype('>f4'),  # float4
+    701: np.dtype('>f8'),  # float8
+    1082: np.dtype('>i4'),  # date
+    1083: np.dtype('>i8'),  # time
+    1114: np.dtype('>i8'),  # timestamp
+    1184: np.dtype('>i8'),  # timestamptz
+    1266: np.dtype([('us', '>i8'), ('zone', '>i4')]),  # timetz
+}
+
+# Timestamps with a time zone are sent as UTC
+TIMESTAMPTZ_TYPE = 1184
+
+# Variable width types by OID that are decoded as text
+TEXT_TYPES = {18, 19, 25, 1042, 1043}
+
+# Types that are returned as their raw bytes. Geometries are sent as EWKB
+BYTEA_TYPE = 17
+BINARY_TYPE_NAMES = {'geometry', 'geography'}
+
+_int32 = struct.Struct('>i')
+_int16 = struct.Struct('>h')
+
+
+class CopyNotSupported(Exception):
+    """
+    Raised when a query has columns that are not handled by the binary reader
+    """
+    pass
+
+
+def compile_query(statement, dialect):
+    """
+    Compile a statement for a dialect returning the sql and its parameters
+    with all the bind processors applied
+
+    Args:
+        statement: sqlalchemy selectable or Query object
+        dialect: sqlalchemy dialect to compile for, e.g. engine.dialect
+
+    Returns:
+        tuple: **sql** - Sql string with driver placeholders
+               **params** - Dictionary of parameters ready for the driver
+    """
+    statement = getattr(statement, 'statement', statement)
+    compiled = statement.compile(
+        dialect=dialect, compile_kwargs={'render_postcompile': True})
+
+    params = compiled.construct_params()
+    processors = compiled._bind_processors
+
+    for k, v in params.items():
+        if k in processors:
+            params[k] = processors[k](v)
+
+    return str(compiled), params
+
+
+def parse_copy_binary(buf, type_oids):
+    """
+    Parse a PostgreSQL binary COPY stream into numpy column arrays. Fixed
+    width columns become numeric/datetime arrays, nulls in numeric columns
+    become NaN/NaT. Text columns become object arrays of str and anything
+    else is returned as raw bytes.
+
+    Args:
+        buf: Bytes like object containing the full COPY output
+        type_oids: List of the column type OIDs or 'binary' for columns to
+                   be kept as bytes (e.g. geometry)
+
+    Returns:
+        columns: List of numpy arrays in the order of type_oids
+    """
+    view = memoryview(buf)
+
+    if bytes(view[:11]) != SIGNATURE:
+        raise ValueError('Buffer is not in the PostgreSQL binary COPY format')
+
+    # Skip the flags and the header extension
+    ext = _int32.unpack_from(view, 15)[0]
+    start = 19 + ext
+
+    offsets, lengths = _field_positions(view, start, type_oids)
+
+    u8 = np.frombuffer(view, dtype=np.uint8)
+    columns = []
+
+    for i, oid in enumerate(type_oids):
+        columns.append(
+            _decode_column(u8, view, offsets[:, i], lengths[:, i], oid))
+
+    return columns
+
+
+def _field_positions(view, start, type_oids):
+    """
+    Find the offset and length of every field in the stream. When every
+    column is fixed width and nothing is null the rows are all the same size
+    and the positions are computed without walking the rows.
+    """
+    ncols = len(type_oids)
+    widths = [FIXED_TYPES[o].itemsize if o in FIXED_TYPES else None
+              for o in type_oids]
+
+    # Fast path, fixed width rows, trailer is a single int16 of -1
+    if None not in widths:
+        row_size = 2 + sum(4 + w for w in widths)
+        nbytes = len(view) - start - 2
+
+        if nbytes % row_size == 0:
+            nrows = nbytes // row_size
+            fields = [('n', '>i2')]
+            for i, w in enumerate(widths):
+                fields += [('l{}'.format(i), '>i4'), ('v{}'.format(i), 'V{}'.format(w))]
+
+            rows = np.frombuffer(view, dtype=np.dtype(fields), count=nrows,
+                                 offset=start)
+            lengths = np.stack([rows['l{}'.format(i)] for i in range(ncols)],
+                               axis=1) if nrows else np.empty((0, ncols))
+
+            if np.all(rows['n'] == ncols) and np.all(lengths == widths):
+                field_start = np.cumsum([2 + 4] + [4 + w for w in widths[:-1]])
+                offsets = (start + np.arange(nrows)[:, None] * row_size +
+                           field_start[None, :])
+                return offsets, lengths.astype(np.int64)
+
+    # Walk the rows reading each field length
+    offsets = []
+    lengths = []
+    pos = start
+    unpack_int16 = _int16.unpack_from
+    unpack_int32 = _int32.unpack_from
+
+    while True:
+        n = unpack_int16(view, pos)[0]
+        pos += 2
+
+        if n == -1:
+            break
+        elif n != ncols:
+            raise ValueError(
+                'Expected {} fields in a row, found {}'.format(ncols, n))
+
+        for i in range(ncols):
+            length = unpack_int32(view, pos)[0]
+            pos += 4
+            offsets.append(pos)
+            lengths.append(length)
+
+            if length > 0:
+                pos += length
+
+    offsets = np.array(offsets, dtype=np.int64).reshape(-1, ncols)
+    lengths = np.array(lengths, dtype=np.int64).reshape(-1, ncols)
+    return offsets, lengths
+
+
+def _decode_column(u8, view, offsets, lengths, oid):
+    """
+    Decode a single column from the positions of its fields
+    """
+    valid = lengths >= 0
+
+    if oid in FIXED_TYPES:
+        dtype = FIXED_TYPES[oid]
+        w = dtype.itemsize
+
+        # Gather the bytes of every valid field then view them as the type
+        idx = offsets[valid][:, None] + np.arange(w)[None, :]
+        raw = u8[idx].view(dtype).ravel().astype(dtype.newbyteorder('='))
+
+        if oid == 1082:
+            values = np.full(len(offsets), np.datetime64('NaT'), dtype='datetime64[D]')
+            values[valid] = PG_EPOCH_DAYS + raw.astype('timedelta64[D]')
+
+        elif oid in [1114, 1184]:
+            values = np.full(len(offsets), np.datetime64('NaT'), dtype='datetime64[us]')
+            values[valid] = PG_EPOCH_US + raw.astype('timedelta64[us]')
+
+        elif oid in [1083, 1266]:
+            values = np.full(len(offsets), None, dtype=object)
+            values[valid] = _to_times(raw)
+
+        elif valid.all():
+            values = raw
+
+        elif oid == 16:
+            values = np.full(len(offsets), None, dtype=object)
+            values[valid] = raw
+
+        else:
+            # Nulls in numeric columns become NaN just like pandas would
+            values = np.full(len(offsets), np.nan)
+            values[valid] = raw
+
+        return values
+
+    values = np.full(len(offsets), None, dtype=object)
+
+    if oid in TEXT_TYPES:
+        for i in np.flatnonzero(valid):
+            o = offsets[i]
+            values[i] = str(view[o:o + lengths[i]], 'utf-8')
+
+    elif oid == BYTEA_TYPE or oid == 'binary':
+        for i in np.flatnonzero(valid):
+            o = offsets[i]
+            values[i] = view[o:o + lengths[i]].tobytes()
+
+    else:
+        raise CopyNotSupported('Unable to decode type OID {}'.format(oid))
+
+    return values
+
+
+def _to_times(raw):
+    """
+    Convert microseconds since midnight (and an optional zone offset in
+    seconds west of UTC) to datetime.time objects to match the driver
+    """
+    if raw.dtype.names is not None:
+        us, zones = raw['us'], raw['zone']
+    else:
+        us, zones = raw, np.zeros(len(raw), dtype=int)
+
+    tz = {z: timezone(timedelta(seconds=-int(z))) for z in np.unique(zones)}
+    hour, rem = np.divmod(us, 3600000000)
+    minute, rem = np.divmod(rem, 60000000)
+    second, micro = np.divmod(rem, 1000000)
+
+    times = [time(*t, tzinfo=tz[z] if raw.dtype.names else None) for z, t in
+             zip(zones, zip(hour.tolist(), minute.tolist(), second.tolist(),
+                            micro.tolist()))]
+    return times
+
+
+def _column_types(cursor, sql):
+    """
+    Retrieve the names and type OIDs of the columns a query would return
+    without running it. Geometry types are marked as binary.
+    """
+    cursor.execute('SELECT * FROM ({}) AS q LIMIT 0'.format(sql))
+    names = [d[0] for d in cursor.description]
+    oids = [d[1] for d in cursor.description]
+
+    # Extension types have no fixed OID so look them up by name
+    unknown = [o for o in oids if o not in FIXED_TYPES and
+               o not in TEXT_TYPES and o != BYTEA_TYPE]
+
+    if unknown:
+        cursor.execute('SELECT oid, typname FROM pg_type WHERE oid = ANY(%s)',
+                       (list(set(unknown)),))
+        type_names = dict(cursor.fetchall())
+
+        for i, o in enumerate(oids):
+            if o in type_names:
+                if type_names[o] in BINARY_TYPE_NAMES:
+                    oids[i] = 'binary'
+                else:
+                    raise CopyNotSupported(
+                        'Column {} of type {} cannot be read with COPY'
+                        ''.format(names[i], type_names[o]))
+
+    return names, oids
+
+
+def read_copy(engine, query):
+    """
+    Run a query through COPY ... TO STDOUT WITH BINARY and decode the
+    result into numpy arrays. timestamptz columns are returned tz aware in
+    UTC, the same as pandas.read_sql returns them.
+
+    Args:
+        engine: sqlalchemy engine
+        query: Query object or sqlalchemy selectable
+
+    Returns:
+        tuple: **names** - List of the column names
+               **columns** - List of numpy arrays, or pandas
+               DatetimeIndex for timestamptz, in the same order
+
+    Raises:
+        CopyNotSupported: if a column cannot be read with the binary reader
+    """
+    sql, params = compile_query(query, engine.dialect)
+    conn = engine.raw_connection()
+
+    try:
+        cursor = conn.cursor()
+
+        # COPY does not accept parameters, so bind them in with the driver
+        sql = cursor.mogrify(sql, params).decode('utf-8')
+        names, oids = _column_types(cursor, sql)
+
+        buf = BytesIO()
+        cursor.copy_expert(
+            'COPY ({}) TO STDOUT WITH BINARY'.format(sql), buf)
+        cursor.close()
+        conn.rollback()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    columns = parse_copy_binary(buf.getbuffer(), oids)
+
+    # The binary values are UTC, match the nanosecond UTC values read_sql
+    # coerces timestamptz to
+    for i, oid in enumerate(oids):
+        if oid == TIMESTAMPTZ_TYPE:
+            columns[i] = pd.to_datetime(columns[i].astype('datetime64[ns]'),
+                                        utc=True)
+
+    return names, columns
@@ -0,0 +1,1235 @@
+"""
+Module for working with the rasters stored in the images table. Rasters are
+decoded straight from the PostGIS raster WKB format into numpy arrays which
+avoids encoding a GeoTIFF on the server and decoding it again locally.
+"""
+import struct
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import rasterio
+from affine import Affine
+from geoalchemy2.shape import from_shape
+from sqlalchemy import Float, cast, func, select, true
+from sqlalchemy.dialects import postgresql
+
+from .analysis import StatsAccumulator
+from .data import ImageData
+
+# PostGIS pixel types by their id in the band flags
+PIXEL_TYPES = {
+    0: np.uint8,  # 1BB
+    1: np.uint8,  # 2BUI
+    2: np.uint8,  # 4BUI
+    3: np.int8,  # 8BSI
+    4: np.uint8,  # 8BUI
+    5: np.int16,  # 16BSI
+    6: np.uint16,  # 16BUI
+    7: np.int32,  # 32BSI
+    8: np.uint32,  # 32BUI
+    9: np.float16,  # 16BF
+    10: np.float32,  # 32BF
+    11: np.float64,  # 64BF
+}
+
+# PostGIS pixel type ids of the numpy types that can be encoded
+PIXEL_TYPE_IDS = {
+    np.dtype(np.int8): 3,
+    np.dtype(np.uint8): 4,
+    np.dtype(np.int16): 5,
+    np.dtype(np.uint16): 6,
+    np.dtype(np.int32): 7,
+    np.dtype(np.uint32): 8,
+    np.dtype(np.float32): 10,
+    np.dtype(np.float64): 11,
+}
+
+# Band flags
+BAND_PIXTYPE_MASK = 0x0F
+BAND_IS_OFFLINE = 0x80
+BAND_HAS_NODATA = 0x40
+
+# endian, version, bands, scale x/y, upper left x/y, skew x/y, srid, w, h
+HEADER = 'BHHddddddiHH'
+HEADER_SIZE = struct.calcsize('<' + HEADER)
+
+# Magic numbers at the start of little and big endian GeoTIFFs
+TIFF_MAGIC = [b'II*\x00', b'MM\x00*']
+
+# Largest mosaic in pixels that is unioned on the server when choosing
+# a mosaic strategy automatically
+UNION_MAX_PIXELS = 250000
+
+
+class RasterArray(object):
+    """
+    Bands of a raster as numpy arrays along with the georeferencing needed
+    to use them. Mimics the read interface of a rasterio dataset.
+    """
+
+    def __init__(self, bands, transform, srid, nodata):
+        """
+        Args:
+            bands: List of 2D numpy arrays, one per band
+            transform: affine.Affine transform of the upper left corner
+            srid: Spatial reference id of the raster
+            nodata: List of nodata values per band, None when not set
+        """
+        self.bands = bands
+        self.transform = transform
+        self.srid = srid
+        self.nodata = nodata
+
+    @property
+    def count(self):
+        return len(self.bands)
+
+    @property
+    def height(self):
+        return self.bands[0].shape[0] if self.bands else 0
+
+    @property
+    def width(self):
+        return self.bands[0].shape[1] if self.bands else 0
+
+    @property
+    def shape(self):
+        return (self.count, self.height, self.width)
+
+    @property
+    def dtype(self):
+        return self.bands[0].dtype if self.bands else None
+
+    @property
+    def crs(self):
+        return 'EPSG:{}'.format(self.srid) if self.srid > 0 else None
+
+    @property
+    def bounds(self):
+        """
+        Bounds of the raster as (left, bottom, right, top)
+        """
+        t = self.transform
+        xs = [t.c, t.c + t.a * self.width + t.b * self.height]
+        ys = [t.f, t.f + t.d * self.width + t.e * self.height]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def read(self, band=None):
+        """
+        Read a band like rasterio, bands start at 1. When no band is given
+        all bands are stacked into a 3D array.
+        """
+        if band is None:
+            return np.stack(self.bands)
+
+        return self.bands[band - 1]
+
+    def to_points(self, band=1):
+        """
+        Coordinates of the centers of the pixels holding data along with
+        their values, nodata and nan pixels are left out
+
+        Args:
+            band: Band number to read the values of
+
+        Returns:
+            tuple: **x**, **y**, **values** - 1D numpy arrays
+        """
+        values = self.read(band)
+        nodata = self.nodata[band - 1] if self.nodata else None
+
+        valid = ~np.isnan(values) if values.dtype.kind == 'f' else \
+            np.ones(values.shape, dtype=bool)
+        if nodata is not None:
+            valid &= values != nodata
+
+        rows, cols = np.nonzero(valid)
+        t = self.transform
+        x = t.c + (cols + 0.5) * t.a + (rows + 0.5) * t.b
+        y = t.f + (cols + 0.5) * t.d + (rows + 0.5) * t.e
+
+        return x, y, values[valid]
+
+    def to_rasterio(self):
+        """
+        Wrap the raster in a rasterio in memory dataset which lives as long
+        as the dataset does
+
+        Returns:
+            dataset: rasterio dataset opened in w+ mode
+        """
+        nodata = self.nodata[0] if self.nodata else None
+        dataset = rasterio.open('snowexsql_raster', 'w+', driver='MEM',
+                                width=self.width, height=self.height,
+                                count=self.count, dtype=self.dtype.name,
+                                crs=self.crs, transform=self.transform,
+                                nodata=nodata)
+
+        for i, band in enumerate(self.bands):
+            dataset.write(band.astype(self.dtype.newbyteorder('=')), i + 1)
+
+        return dataset
+
+
+def _as_buffer(data):
+    """
+    Unwrap a raster value into something numpy can view. Hex strings, as
+    returned when selecting the raster column directly, have to be decoded
+    but bytes from ST_AsBinary are used without a copy
+    """
+    data = getattr(data, 'data', data)
+
+    if isinstance(data, str):
+        data = bytes.fromhex(data)
+
+    return memoryview(data)
+
+
+def raster_from_wkb(data):
+    """
+    Decode a PostGIS raster from its WKB format. Band arrays are read only
+    views of the buffer provided, no pixels are copied.
+
+    Args:
+        data: Raster WKB as bytes/memoryview (e.g. from ST_AsBinary), a hex
+              string or a geoalchemy2 RasterElement
+
+    Returns:
+        raster: RasterArray instance
+    """
+    buf = _as_buffer(data)
+    endian = '<' if buf[0] == 1 else '>'
+
+    (_, version, nbands, scale_x, scale_y, ul_x, ul_y, skew_x, skew_y, srid,
+     width, height) = struct.unpack_from(endian + HEADER, buf, 0)
+
+    if version != 0:
+        raise ValueError('Unsupported raster WKB version {}'.format(version))
+
+    transform = Affine(scale_x, skew_x, ul_x, skew_y, scale_y, ul_y)
+    pos = HEADER_SIZE
+    bands = []
+    nodata = []
+
+    for i in range(nbands):
+        flags = buf[pos]
+        pos += 1
+
+        if flags & BAND_IS_OFFLINE:
+            raise ValueError('Band {} is stored outside the database and '
+                             'cannot be decoded'.format(i + 1))
+
+        dtype = np.dtype(PIXEL_TYPES[flags & BAND_PIXTYPE_MASK])
+        dtype = dtype.newbyteorder(endian)
+
+        # The nodata value is always present even when it isn't used
+        value = np.frombuffer(buf, dtype=dtype, count=1, offset=pos)[0]
+        pos += dtype.itemsize
+
+        band = np.frombuffer(buf, dtype=dtype, count=width * height,
+                             offset=pos).reshape(height, width)
+        pos += dtype.itemsize * width * height
+
+        bands.append(band)
+        nodata.append(value.item() if flags & BAND_HAS_NODATA else None)
+
+    return RasterArray(bands, transform, srid, nodata)
+
+
+def raster_to_wkb(raster):
+    """
+    Encode a raster in the little endian PostGIS raster WKB format, the
+    inverse of raster_from_wkb
+
+    Args:
+        raster: RasterArray instance
+
+    Returns:
+        wkb: Raster WKB as bytes
+    """
+    t = raster.transform
+    out = [struct.pack('<' + HEADER, 1, 0, raster.count, t.a, t.e, t.c, t.f,
+                       t.b, t.d, raster.srid or 0, raster.width, raster.height)]
+
+    for band, nodata in zip(raster.bands, raster.nodata):
+        native = band.dtype.newbyteorder('=')
+        if native not in PIXEL_TYPE_IDS:
+            raise ValueError('Pixel type {} cannot be stored in a PostGIS '
+                             'raster'.format(native))
+
+        dtype = native.newbyteorder('<')
+        flags = PIXEL_TYPE_IDS[native]
+        if nodata is not None:
+            flags |= BAND_HAS_NODATA
+
+        out.append(bytes([flags]))
+        out.append(np.array([0 if nodata is None else nodata],
+                            dtype=dtype).tobytes())
+        out.append(np.ascontiguousarray(band, dtype=dtype).tobytes())
+
+    return b''.join(out)
+
+
+def is_geotiff(data):
+    """
+    Check whether a raster value is a GeoTIFF (e.g. from ST_AsTiff)
+    """
+    data = getattr(data, 'data', data)
+
+    if isinstance(data, str):
+        return False
+
+    return bytes(data[:4]) in TIFF_MAGIC
+
+
+def _window(transform, bounds):
+    """
+    Pixel window (row_start, row_stop, col_start, col_stop) of bounds
+    snapped outward onto the grid of a transform
+    """
+    xmin, ymin, xmax, ymax = bounds
+    cols = sorted([(xmin - transform.c) / transform.a,
+                   (xmax - transform.c) / transform.a])
+    rows = sorted([(ymax - transform.f) / transform.e,
+                   (ymin - transform.f) / transform.e])
+
+    # Round first to avoid float error pushing an edge out by a pixel
+    return (int(np.floor(np.round(rows[0], 6))),
+            int(np.ceil(np.round(rows[1], 6))),
+            int(np.floor(np.round(cols[0], 6))),
+            int(np.ceil(np.round(cols[1], 6))))
+
+
+def mosaic_tiles(tiles, bbox=None):
+    """
+    Assemble tiles on a common grid into a single preallocated array.
+    Pixels of later tiles overwrite earlier ones except where they are
+    nodata.
+
+    Args:
+        tiles: List of RasterArrays sharing a resolution and alignment
+        bbox: Optional (xmin, ymin, xmax, ymax) to limit the mosaic to,
+              in the coordinates of the tiles
+
+    Returns:
+        raster: RasterArray instance or None if there are no tiles
+    """
+    if not tiles:
+        return None
+
+    first = tiles[0]
+    ref = first.transform
+
+    if ref.b != 0 or ref.d != 0:
+        raise ValueError('Rotated rasters cannot be mosaicked')
+
+    for t in tiles:
+        if not np.allclose([t.transform.a, t.transform.e], [ref.a, ref.e]):
+            raise ValueError('Tiles must share the same resolution')
+
+        # Upper left corners have to land on the same pixel grid
+        col = (t.transform.c - ref.c) / ref.a
+        row = (t.transform.f - ref.f) / ref.e
+        if not np.allclose([col, row], np.round([col, row]), atol=1e-6):
+            raise ValueError('Tiles are not aligned to the same grid')
+
+    # Extent of all the tiles in pixels of the first tile
+    windows = [_window(ref, t.bounds) for t in tiles]
+    r0 = min(w[0] for w in windows)
+    r1 = max(w[1] for w in windows)
+    c0 = min(w[2] for w in windows)
+    c1 = max(w[3] for w in windows)
+
+    if bbox is not None:
+        b = _window(ref, bbox)
+        r0, r1, c0, c1 = max(r0, b[0]), min(r1, b[1]), max(c0, b[2]), min(c1, b[3])
+
+    if r1 <= r0 or c1 <= c0:
+        return None
+
+    dtype = first.dtype.newbyteorder('=')
+    nodata = list(first.nodata)
+
+    # Fill with nodata, missing nodata becomes nan for floats
+    for i, v in enumerate(nodata):
+        if v is None and dtype.kind == 'f':
+            nodata[i] = np.nan
+
+    out = np.empty((first.count, r1 - r0, c1 - c0), dtype=dtype)
+    for i, v in enumerate(nodata):
+        out[i] = 0 if v is None else v
+
+    for t, (tr0, tr1, tc0, tc1) in zip(tiles, windows):
+        # Overlap of the tile and the output in output pixels
+        or0, or1 = max(tr0, r0), min(tr1, r1)
+        oc0, oc1 = max(tc0, c0), min(tc1, c1)
+
+        if or1 <= or0 or oc1 <= oc0:
+            continue
+
+        for i, band in enumerate(t.bands):
+            src = band[or0 - tr0:or1 - tr0, oc0 - tc0:oc1 - tc0]
+            dst = out[i, or0 - r0:or1 - r0, oc0 - c0:oc1 - c0]
+
+            if t.nodata[i] is None:
+                dst[:] = src
+            else:
+                valid = src != t.nodata[i]
+                dst[valid] = src[valid]
+
+    transform = Affine(ref.a, 0, ref.c + c0 * ref.a, 0, ref.e, ref.f + r0 * ref.e)
+
+    return RasterArray(list(out), transform, first.srid, list(first.nodata))
+
+
+def _tiles_statement(ids, envelope=None):
+    """
+    Build the select of tile ids and their raster WKB
+    """
+    raster = ImageData.raster
+    if envelope is not None:
+        raster = func.ST_Clip(raster, envelope, True)
+
+    return select(ImageData.id, func.ST_AsBinary(raster)).where(
+        ImageData.id.in_(ids))
+
+
+def _fetch_batch(engine, ids, envelope=None):
+    """
+    Fetch and decode a batch of tiles on a connection of its own
+    """
+    stmt = _tiles_statement(ids, envelope=envelope)
+
+    with engine.connect() as conn:
+        rows = conn.execute(stmt).fetchall()
+
+    return {i: raster_from_wkb(wkb) for i, wkb in rows if wkb is not None}
+
+
+def fetch_tiles(engine, ids, envelope=None, max_workers=4, batch_size=None):
+    """
+    Fetch and decode tiles from the images table concurrently. Tile ids are
+    split into batches spread across a thread pool where each worker checks
+    out its own pooled connection, so decoding one batch overlaps with
+    waiting on the network for others. Keep max_workers within the pool
+    size plus overflow of the engine.
+
+    Args:
+        engine: sqlalchemy engine
+        ids: List of tile ids to fetch
+        envelope: Optional geometry to clip each tile to on the server
+        max_workers: Number of threads/connections to use
+        batch_size: Tiles per query, defaults to spreading the ids over
+                    four batches per worker
+
+    Returns:
+        tiles: Dictionary of tile id to RasterArray
+    """
+    tiles = {}
+
+    for batch in _map_batches(_fetch_batch, engine, ids, max_workers=max_workers,
+                              batch_size=batch_size, envelope=envelope):
+        tiles.update(batch)
+
+    return tiles
+
+
+def _map_batches(fn, engine, ids, max_workers=4, batch_size=None, **kwargs):
+    """
+    Split tile ids into batches and call fn(engine, batch, **kwargs) on
+    each, spread across a thread pool when max_workers is more than one
+
+    Returns:
+        results: List of the results of each batch, in completion order
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+
+    max_workers = max_workers or 1
+    if batch_size is None:
+        batch_size = max(1, int(np.ceil(len(ids) / (4 * max_workers))))
+
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    if max_workers <= 1 or len(batches) == 1:
+        return [fn(engine, batch, **kwargs) for batch in batches]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(fn, engine, batch, **kwargs) for batch in batches]
+        return [future.result() for future in as_completed(futures)]
+
+
+def filter_images(query, type=None, surveyors=None, date=None):
+    """
+    Apply the typical filters used to select a raster to an ImageData query
+
+    Args:
+        query: sqlalchemy Query object
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+
+    Returns:
+        query: Filtered Query object
+    """
+    for att, value in [('type', type), ('surveyors', surveyors),
+                       ('date', date)]:
+        if value is not None:
+            query = query.filter(getattr(ImageData, att) == value)
+
+    return query
+
+
+def _choose_strategy(session, envelope, bbox, filters):
+    """
+    Decide between assembling the mosaic server side with ST_Union or
+    client side. ST_Union runs map algebra pixel by pixel, so it only pays
+    off for small outputs where it saves a round trip per tile. See
+    scripts/benchmarks/bench_raster_mosaic.py for the measurements behind
+    UNION_MAX_PIXELS.
+    """
+    q = session.query(func.count(ImageData.id),
+                      func.max(func.ST_ScaleX(ImageData.raster)),
+                      func.max(func.abs(func.ST_ScaleY(ImageData.raster))),
+                      func.max(func.ST_Width(ImageData.raster) *
+                               func.ST_Height(ImageData.raster)))
+    q = filter_images(q, **filters)
+    count, scale_x, scale_y, tile_pixels = q.filter(
+        func.ST_Intersects(ImageData.raster, envelope)).one()
+
+    if not count:
+        return 'client'
+
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1])
+    pixels = min(area / (scale_x * scale_y), count * tile_pixels)
+
+    return 'server' if pixels <= UNION_MAX_PIXELS else 'client'
+
+
+def _raster_srid(session, filters):
+    """
+    Srid of the first raster matching the filters, None when there are none
+    """
+    q = filter_images(session.query(func.ST_SRID(ImageData.raster)), **filters)
+    return q.limit(1).scalar()
+
+
+def _to_raster_srid(session, area, srid, filters):
+    """
+    Transform a geometry built in srid to the srid of the rasters matching
+    the filters, PostGIS won't compare geometries and rasters in different
+    ones. A geometry built without an srid is taken to be in the raster
+    srid already.
+
+    Args:
+        session: sqlalchemy session object
+        area: Function building the geometry from an srid
+        srid: Srid the geometry is in, None for the raster srid
+        filters: Dictionary of type, surveyors and date
+
+    Returns:
+        tuple: **area** - Geometry in the raster srid, None without rasters
+               **transformed** - True when the geometry was transformed
+    """
+    raster_srid = _raster_srid(session, filters)
+
+    if raster_srid is None:
+        return None, False
+
+    if srid is None or srid == raster_srid:
+        return area(raster_srid), False
+
+    return func.ST_Transform(area(srid), raster_srid), True
+
+
+def _bounds_of(session, area):
+    """
+    (xmin, ymin, xmax, ymax) of a geometry computed by PostGIS
+    """
+    return tuple(session.query(func.ST_XMin(area), func.ST_YMin(area),
+                               func.ST_XMax(area), func.ST_YMax(area)).one())
+
+
+def get_raster_mosaic(session, bbox, type=None, surveyors=None, date=None,
+                      strategy='auto', srid=None, max_workers=None):
+    """
+    Retrieve a single raster covering a bounding box from the tiles in the
+    images table. Only the tiles intersecting the bbox are fetched and each
+    is clipped to the bbox on the server.
+
+    Args:
+        session: sqlalchemy session object
+        bbox: (xmin, ymin, xmax, ymax) in the coordinates of the rasters
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+        strategy: 'server' to union the tiles with ST_Union, 'client' to
+                  assemble them locally or 'auto' to choose by size
+        srid: Srid of the bbox when not that of the rasters, it is
+              transformed and the mosaic covers its bounds in the raster
+              srid
+        max_workers: Fetch the tiles of a client side mosaic concurrently
+                     with this many connections, see fetch_tiles
+
+    Returns:
+        raster: RasterArray instance or None if no tiles intersect
+    """
+    filters = dict(type=type, surveyors=surveyors, date=date)
+
+    envelope, transformed = _to_raster_srid(
+        session, lambda s: func.ST_MakeEnvelope(*bbox, s), srid, filters)
+
+    if envelope is None:
+        return None
+
+    # The mosaic covers the bounds of the bbox in the raster coordinates
+    if transformed:
+        bbox = _bounds_of(session, envelope)
+
+    if strategy == 'auto':
+        strategy = _choose_strategy(session, envelope, bbox, filters)
+
+    clipped = func.ST_Clip(ImageData.raster, envelope, True)
+
+    if strategy == 'server':
+        q = session.query(func.ST_AsBinary(func.ST_Union(clipped)))
+    elif strategy == 'client' and max_workers:
+        q = session.query(ImageData.id)
+    elif strategy == 'client':
+        q = session.query(func.ST_AsBinary(clipped))
+    else:
+        raise ValueError('Unknown mosaic strategy {}'.format(strategy))
+
+    q = filter_images(q, **filters)
+    q = q.filter(func.ST_Intersects(ImageData.raster, envelope))
+
+    if strategy == 'client':
+        q = q.order_by(ImageData.id)
+
+    if strategy == 'client' and max_workers:
+        ids = [r[0] for r in q.all()]
+        fetched = fetch_tiles(session.get_bind(), ids, envelope=envelope,
+                              max_workers=max_workers)
+        tiles = [fetched[i] for i in ids if i in fetched]
+    else:
+        tiles = [raster_from_wkb(r[0]) for r in q.all() if r[0] is not None]
+
+    return mosaic_tiles(tiles, bbox=bbox)
+
+
+def _histogram_counts(conn, ids, clipped, band, edges):
+    """
+    Count the clipped pixels of tiles per bin on the server. Nodata and
+    clipped away pixels are nulls and left out, values on the last edge
+    land in the last bin like numpy.histogram.
+    """
+    values = select(func.unnest(func.ST_DumpValues(clipped, band, True)).label(
+        'v')).where(ImageData.id.in_(ids)).subquery()
+    thresholds = cast(postgresql.array([float(e) for e in edges]),
+                      postgresql.ARRAY(Float))
+    bins = len(edges) - 1
+    bin = func.least(func.width_bucket(values.c.v, thresholds), bins)
+
+    rows = conn.execute(select(bin, func.count()).where(
+        values.c.v.between(float(edges[0]), float(edges[-1]))).group_by(
+        bin)).fetchall()
+
+    counts = np.zeros(bins, dtype=np.int64)
+    for b, n in rows:
+        counts[b - 1] = n
+
+    return counts
+
+
+def _stats_batch(engine, ids, clipped=None, band=1, edges=None):
+    """
+    Summary statistics and optionally a histogram over the edges of the
+    clipped pixels of a batch of tiles
+
+    Returns:
+        tuple: **moments** - count, mean, stddev, min and max of the pixels
+               **counts** - Pixel count per bin, None without edges
+    """
+    agg = select(func.ST_SummaryStatsAgg(clipped, band, True).label(
+        'stats')).where(ImageData.id.in_(ids)).subquery()
+    stats = agg.c.stats
+
+    with engine.connect() as conn:
+        moments = conn.execute(select(stats.count, stats.mean, stats.stddev,
+                                      stats.min, stats.max)).one()
+
+        if edges is None or not moments[0]:
+            return moments, None
+
+        return moments, _histogram_counts(conn, ids, clipped, band, edges)
+
+
+def _histogram_batch(engine, ids, clipped=None, band=1, edges=None):
+    """
+    Histogram over the edges of the clipped pixels of a batch of tiles
+    """
+    with engine.connect() as conn:
+        return _histogram_counts(conn, ids, clipped, band, edges)
+
+
+def _tiles_in_area(session, geom, bbox, srid, filters):
+    """
+    Resolve a polygon or bbox to a geometry and find the ids of the tiles
+    matching the filters that intersect it
+
+    Returns:
+        tuple: **area** - Geometry to clip with, None without any rasters
+               **ids** - List of tile ids in order
+    """
+    if (geom is None) == (bbox is None):
+        raise ValueError('Provide either a geom or a bbox')
+
+    if geom is not None:
+        area, _ = _to_raster_srid(session, lambda s: from_shape(geom, srid=s),
+                                  srid, filters)
+    else:
+        area, _ = _to_raster_srid(
+            session, lambda s: func.ST_MakeEnvelope(*bbox, s), srid, filters)
+
+    if area is None:
+        return None, []
+
+    q = filter_images(session.query(ImageData.id), **filters)
+    q = q.filter(func.ST_Intersects(ImageData.raster, area)).order_by(ImageData.id)
+
+    return area, [r[0] for r in q.all()]
+
+
+def get_raster_stats(session, geom=None, bbox=None, type=None, surveyors=None,
+                     date=None, band=1, bins=None, range=None, srid=None,
+                     max_workers=None, batch_size=None):
+    """
+    Calculate statistics and a histogram of the pixels of the rasters in
+    the images table falling in a polygon or bbox. Everything is computed
+    by PostGIS with ST_SummaryStatsAgg over the clipped tiles, only the
+    numbers are transferred. Tiles are worked on in batches which can run
+    concurrently, each on its own pooled connection, and the batches are
+    combined exactly.
+
+    Args:
+        session: sqlalchemy session object
+        geom: Shapely polygon to describe the pixels inside of
+        bbox: (xmin, ymin, xmax, ymax) to use instead of a polygon
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+        band: Band number to describe
+        bins: Number of histogram bins or a sequence of bin edges, None
+              skips the histogram
+        range: (min, max) of the bins, defaults to the min and max found
+        srid: Srid of the polygon or bbox when not that of the rasters, it
+              is transformed to the raster srid
+        max_workers: Number of threads/connections to use
+        batch_size: Tiles per query, see fetch_tiles
+
+    Returns:
+        stats: analysis.StatsAccumulator with the count, mean, std, min and
+               max of the pixels and the histogram when bins are given. No
+               histogram or edges are set when no pixels are in the area
+    """
+    area, ids = _tiles_in_area(session, geom, bbox, srid,
+                               dict(type=type, surveyors=surveyors, date=date))
+    if area is None:
+        return StatsAccumulator()
+
+    clipped = func.ST_Clip(ImageData.raster, band, area, True)
+    engine = session.get_bind()
+    kwargs = dict(max_workers=max_workers, batch_size=batch_size,
+                  clipped=clipped, band=band)
+
+    # The edges are known up front unless the range comes from the data, in
+    # which case the histogram takes a second pass
+    edges = None
+    if bins is not None and (range is not None or np.ndim(bins) > 0):
+        edges = StatsAccumulator(bins=bins, range=range).edges
+
+    stats = StatsAccumulator()
+    histogram = None
+
+    for moments, counts in _map_batches(_stats_batch, engine, ids,
+                                        edges=edges, **kwargs):
+        count, mean, stddev, vmin, vmax = moments
+        if count:
+            stats._merge_moments(count, mean, stddev ** 2 * count, vmin, vmax)
+            if counts is not None:
+                histogram = counts if histogram is None else histogram + counts
+
+    if bins is None or not stats.count:
+        return stats
+
+    if edges is None:
+        edges = StatsAccumulator(bins=bins, range=(stats.min, stats.max)).edges
+        histogram = sum(_map_batches(_histogram_batch, engine, ids,
+                                     edges=edges, **kwargs))
+
+    stats.edges = np.asarray(edges, dtype=float)
+    stats.histogram = np.zeros(len(edges) - 1, dtype=np.int64)
+    if histogram is not None:
+        stats.histogram += histogram
+    stats.outside = stats.count - int(stats.histogram.sum())
+
+    return stats
+
+
+def iter_raster_points(session, geom=None, bbox=None, type=None,
+                       surveyors=None, date=None, band=1, srid=None,
+                       batch_size=16, max_workers=None):
+    """
+    Stream the pixels of the rasters in the images table falling in a
+    polygon or bbox as points, a tile at a time. Tiles are clipped on the
+    server and decoded straight into numpy arrays, no object is made per
+    pixel. Points are the pixel centers like ST_PixelAsCentroids.
+
+    Args:
+        session: sqlalchemy session object
+        geom: Shapely polygon to extract the pixels inside of
+        bbox: (xmin, ymin, xmax, ymax) to use instead of a polygon
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+        band: Band number to read the values of
+        srid: Srid of the polygon or bbox when not that of the rasters, it
+              is transformed to the raster srid
+        batch_size: Tiles fetched per query
+        max_workers: Fetch up to this many batches ahead concurrently, each
+                     on its own pooled connection
+
+    Yields:
+        tuple: **x**, **y**, **values** - 1D numpy arrays of a tile
+    """
+    area, ids = _tiles_in_area(session, geom, bbox, srid,
+                               dict(type=type, surveyors=surveyors, date=date))
+    engine = session.get_bind()
+    batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+
+    def points(batch, tiles):
+        for i in batch:
+            if i in tiles:
+                yield tiles[i].to_points(band=band)
+
+    if not max_workers or max_workers <= 1:
+        for batch in batches:
+            yield from points(batch, _fetch_batch(engine, batch, envelope=area))
+        return
+
+    # Keep a bounded number of batches in flight so memory stays flat
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, pool.submit(_fetch_batch, engine, batch, area)))
+
+            if len(pending) >= max_workers:
+                done, future = pending.popleft()
+                yield from points(done, future.result())
+
+        while pending:
+            done, future = pending.popleft()
+            yield from points(done, future.result())
+
+
+def get_raster_points(session, **kwargs):
+    """
+    Extract the pixels of the rasters in a polygon or bbox as points, see
+    iter_raster_points for the arguments
+
+    Returns:
+        tuple: **x**, **y**, **values** - 1D numpy arrays of every pixel
+    """
+    tiles = list(iter_raster_points(session, **kwargs))
+
+    if not tiles:
+        return np.empty(0), np.empty(0), np.empty(0)
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*tiles))
+
+
+def _point_coordinates(points):
+    """
+    Coordinates and epsg of a GeoSeries, GeoDataFrame or list of points
+    """
+    points = getattr(points, 'geometry', points)
+
+    if hasattr(points, 'crs'):
+        epsg = points.crs.to_epsg() if points.crs is not None else None
+        return np.asarray(points.x, dtype=float), np.asarray(points.y, dtype=float), epsg
+
+    xy = np.array([(p.x, p.y) for p in points], dtype=float).reshape(-1, 2)
+    return xy[:, 0], xy[:, 1], None
+
+
+def _sample_statement(x, y, srid, selections, band):
+    """
+    Build a select of the value of each selection at every point. The points
+    are sent as two arrays and unnested, each selection is a lateral
+    subquery finding the tiles under a point through the footprint index.
+    selections is a list of (filters, raster srid), points are transformed
+    to the srid of each selection's rasters when it differs from theirs.
+    """
+    points = func.unnest(cast(x.tolist(), postgresql.ARRAY(Float)),
+                         cast(y.tolist(), postgresql.ARRAY(Float))).table_valued(
+        'x', 'y', with_ordinality='i').render_derived(name='points')
+    point = func.ST_SetSRID(func.ST_MakePoint(points.c.x, points.c.y), srid)
+
+    stmt = select(points.c.i).select_from(points)
+
+    for n, (filters, raster_srid) in enumerate(selections):
+        at = point if raster_srid == srid else func.ST_Transform(point, raster_srid)
+
+        # Tiles sharing an edge both match points on it, nodata is null so
+        # max keeps the value of whichever tile has one
+        value = select(func.max(func.ST_Value(ImageData.raster, band, at)).label(
+            'value')).where(func.ST_Intersects(ImageData.raster, at))
+        value = filter_images(value, **filters).lateral('s{}'.format(n))
+
+        stmt = stmt.outerjoin(value, true()).add_columns(value.c.value)
+
+    return stmt.order_by(points.c.i)
+
+
+def sample_rasters(session, points, selections=None, band=1, srid=None,
+                   chunksize=10000, type=None, surveyors=None, date=None):
+    """
+    Sample the rasters in the images table at many points at once. Every
+    point is sent in a single query per chunk instead of a query per point
+    and raster. Points are transformed to the srid of the rasters in the
+    database when they are in another one.
+
+    Usage:
+        depths = query_to_geopandas(qry, engine)
+        snow, bare = sample_rasters(session, depths, selections=[
+            dict(type='DEM', surveyors='QSI', date=date(2020, 2, 1)),
+            dict(type='DEM', surveyors='USGS')])
+
+    Args:
+        session: sqlalchemy session object
+        points: GeoSeries, GeoDataFrame or list of shapely points
+        selections: List of dictionaries of type, surveyors and date
+                    filters, one per raster to sample. Defaults to the single
+                    selection given by the filter arguments.
+        band: Band number to sample
+        srid: Srid of the points, defaults to the crs of a GeoSeries or
+              GeoDataFrame and otherwise to the srid of the rasters
+        chunksize: Most points sent per query
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+
+    Returns:
+        values: Numpy array of the value at each point, nan where there is
+                no raster or only nodata. A list of arrays, one per
+                selection, when selections are given.
+    """
+    single = selections is None
+    if single:
+        selections = [dict(type=type, surveyors=surveyors, date=date)]
+
+    x, y, epsg = _point_coordinates(points)
+    values = np.full((len(selections), len(x)), np.nan)
+
+    if not len(x):
+        return values[0] if single else list(values)
+
+    # Selections without any rasters are left as nan
+    srids = [_raster_srid(session, filters) for filters in selections]
+    sampled = [n for n, s in enumerate(srids) if s is not None]
+    srid = srid or epsg or next((s for s in srids if s is not None), None)
+
+    if sampled:
+        columns = [(selections[n], srids[n]) for n in sampled]
+
+        for start in range(0, len(x), chunksize):
+            end = start + chunksize
+            stmt = _sample_statement(x[start:end], y[start:end], srid,
+                                     columns, band)
+
+            rows = session.execute(stmt).fetchall()
+            if rows:
+                chunk = np.array([r[1:] for r in rows], dtype=float)
+                values[sampled, start:end] = chunk.T
+
+    return values[0] if single else list(values)
+
+
+class TileCache(object):
+    """
+    Least recently used cache of decoded tiles bounded by the bytes of their
+    pixels. Safe to share between threads and rasters since tiles are keyed
+    by their id in the images table.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 ** 2):
+        """
+        Args:
+            max_bytes: Maximum bytes of pixels to hold before evicting
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        return key in self._tiles
+
+    def get(self, key):
+        """
+        Return a tile if cached marking it as recently used, otherwise None
+        """
+        with self._lock:
+            tile = self._tiles.get(key)
+
+            if tile is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._tiles.move_to_end(key)
+
+        return tile
+
+    def put(self, key, tile):
+        """
+        Add a tile evicting the least recently used ones when over budget
+        """
+        size = sum(b.nbytes for b in tile.bands)
+
+        with self._lock:
+            if key in self._tiles:
+                self.nbytes -= sum(b.nbytes for b in self._tiles.pop(key).bands)
+
+            self._tiles[key] = tile
+            self.nbytes += size
+
+            # Always keep the newest tile even if it alone is over budget
+            while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+                k, old = self._tiles.popitem(last=False)
+                self.nbytes -= sum(b.nbytes for b in old.bands)
+
+    def clear(self):
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+
+
+def _normalize_index(key, n):
+    """
+    Convert an int or slice on an axis of length n to the array of indices
+    it selects and whether the axis is dropped
+    """
+    if isinstance(key, slice):
+        return np.arange(*key.indices(n)), False
+
+    i = int(key)
+    if i < 0:
+        i += n
+    if not 0 <= i < n:
+        raise IndexError('Index {} is out of bounds for size {}'.format(key, n))
+
+    return np.array([i]), True
+
+
+class LazyRaster(object):
+    """
+    Numpy like view of a raster spread across many tiles. Slicing only
+    fetches the tiles a slice touches and decoded tiles are kept in an LRU
+    cache so repeated access to a window doesn't go back to the database.
+    """
+
+    def __init__(self, index, fetch, band=1, cache=None):
+        """
+        Args:
+            index: List of (id, transform, width, height) for every tile
+            fetch: Callable receiving a list of tile ids that returns a
+                   dictionary of id to RasterArray
+            band: Band number to read, starting at 1
+            cache: TileCache to use, a new one is made if None
+        """
+        self.fetch = fetch
+        self.band = band
+        self.cache = TileCache() if cache is None else cache
+
+        ref = index[0][1]
+        self.res = (ref.a, ref.e)
+
+        # Grid origin is the upper left most corner of all the tiles
+        origin_x = min(t.c for i, t, w, h in index) if ref.a > 0 else \
+            max(t.c for i, t, w, h in index)
+        origin_y = max(t.f for i, t, w, h in index) if ref.e < 0 else \
+            min(t.f for i, t, w, h in index)
+        self.transform = Affine(ref.a, 0, origin_x, 0, ref.e, origin_y)
+
+        # Pixel offsets of each tile on the grid
+        self.ids = np.array([i for i, t, w, h in index])
+        offsets = []
+        for i, t, w, h in index:
+            col = (t.c - origin_x) / ref.a
+            row = (t.f - origin_y) / ref.e
+            if not np.allclose([col, row], np.round([col, row]), atol=1e-6):
+                raise ValueError('Tile {} is not aligned to the grid'.format(i))
+            offsets.append([int(round(row)), int(round(row)) + h,
+                            int(round(col)), int(round(col)) + w])
+
+        self.offsets = np.array(offsets, dtype=int).reshape(-1, 4)
+        self.shape = (int(self.offsets[:, 1].max()),
+                      int(self.offsets[:, 3].max()))
+        # Pixel type information comes from the first tile fetched
+        self.dtype = None
+        self.nodata = None
+        self.srid = 0
+
+    @property
+    def height(self):
+        return self.shape[0]
+
+    @property
+    def width(self):
+        return self.shape[1]
+
+    def _tiles(self, ids):
+        """
+        Get tiles from the cache fetching any that are missing in one go
+        """
+        tiles = {i: self.cache.get(i) for i in ids}
+        missing = [i for i, t in tiles.items() if t is None]
+
+        if missing:
+            for i, tile in self.fetch(missing).items():
+                self.cache.put(i, tile)
+                tiles[i] = tile
+
+        return tiles
+
+    def _read_window(self, r0, r1, c0, c1):
+        """
+        Assemble the pixels of a window on the grid from its tiles
+        """
+        o = self.offsets
+        touched = ((o[:, 0] < r1) & (o[:, 1] > r0) &
+                   (o[:, 2] < c1) & (o[:, 3] > c0))
+        ids = self.ids[touched].tolist()
+        tiles = self._tiles(ids)
+
+        if self.dtype is None and tiles:
+            first = next(iter(tiles.values()))
+            self.dtype = first.dtype.newbyteorder('=')
+            self.nodata = first.nodata[self.band - 1]
+            self.srid = first.srid
+
+        dtype = self.dtype if self.dtype is not None else np.float64
+        fill = self.nodata
+        if fill is None:
+            fill = np.nan if dtype.kind == 'f' else 0
+
+        out = np.full((r1 - r0, c1 - c0), fill, dtype=dtype)
+
+        for i, (tr0, tr1, tc0, tc1) in zip(ids, o[touched]):
+            band = tiles[i].read(self.band)
+            or0, or1 = max(tr0, r0), min(tr1, r1)
+            oc0, oc1 = max(tc0, c0), min(tc1, c1)
+            out[or0 - r0:or1 - r0, oc0 - c0:oc1 - c0] = \
+                band[or0 - tr0:or1 - tr0, oc0 - tc0:oc1 - tc0]
+
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError('Rasters only have two dimensions')
+
+        key = key + (slice(None),) * (2 - len(key))
+        rows, drop_row = _normalize_index(key[0], self.height)
+        cols, drop_col = _normalize_index(key[1], self.width)
+
+        if len(rows) == 0 or len(cols) == 0:
+            return np.empty((len(rows), len(cols)), dtype=self.dtype)
+
+        r0, r1 = rows.min(), rows.max() + 1
+        c0, c1 = cols.min(), cols.max() + 1
+        out = self._read_window(r0, r1, c0, c1)
+
+        # Apply any steps or reversals after reading the covering window
+        if len(rows) != r1 - r0 or rows[0] != r0:
+            out = out[rows - r0, :]
+        if len(cols) != c1 - c0 or cols[0] != c0:
+            out = out[:, cols - c0]
+
+        if drop_row and drop_col:
+            return out[0, 0]
+        elif drop_row:
+            return out[0]
+        elif drop_col:
+            return out[:, 0]
+
+        return out
+
+    def window(self, bbox):
+        """
+        Read the pixels covering a bbox of (xmin, ymin, xmax, ymax)
+
+        Returns:
+            raster: RasterArray of the window
+        """
+        r0, r1, c0, c1 = _window(self.transform, bbox)
+        r0, r1 = max(r0, 0), min(r1, self.height)
+        c0, c1 = max(c0, 0), min(c1, self.width)
+
+        arr = self._read_window(r0, r1, c0, c1)
+        t = self.transform
+        transform = Affine(t.a, 0, t.c + c0 * t.a, 0, t.e, t.f + r0 * t.e)
+
+        return RasterArray([arr], transform, self.srid, [self.nodata])
+
+
+def get_lazy_raster(session, type=None, surveyors=None, date=None, band=1,
+                    cache=None, max_workers=None):
+    """
+    Build a lazily loaded raster from the tiles in the images table. Only
+    the tile metadata is queried until the raster is sliced.
+
+    Args:
+        session: sqlalchemy session object
+        type: Type of raster e.g. DEM
+        surveyors: Surveyors of the raster e.g. USGS
+        date: Date of the raster
+        band: Band number to read, starting at 1
+        cache: TileCache to use, pass one in to share it between rasters
+        max_workers: Fetch tiles concurrently with this many connections,
+                     see fetch_tiles
+
+    Returns:
+        raster: LazyRaster instance or None when no tiles match
+    """
+    r = ImageData.raster
+    q = session.query(ImageData.id, func.ST_UpperLeftX(r), func.ST_UpperLeftY(r),
+                      func.ST_ScaleX(r), func.ST_ScaleY(r), func.ST_Width(r),
+                      func.ST_Height(r))
+    q = filter_images(q, type=type, surveyors=surveyors, date=date)
+
+    index = [(i, Affine(sx, 0, x, 0, sy, y), w, h)
+             for i, x, y, sx, sy, w, h in q.all()]
+
+    if not index:
+        return None
+
+    def fetch(ids):
+        if max_workers:
+            return fetch_tiles(session.get_bind(), ids,
+                               max_workers=max_workers)
+
+        q = session.query(ImageData.id, func.ST_AsBinary(ImageData.raster))
+        q = q.filter(ImageData.id.in_(ids))
+        return {i: raster_from_wkb(wkb) for i, wkb in q.all()}
+
+    return LazyRaster(index, fetch, band=band, cache=cache)
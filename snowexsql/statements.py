@@ -0,0 +1,263 @@
+"""
+Module for running queries as server side prepared statements. Statements
+are compiled once per query shape (the same query with different values)
+and prepared once per connection so PostgreSQL plans them a single time
+instead of on every call.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from psycopg2 import errors
+from sqlalchemy.exc import CompileError
+
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+# Number of compiled query shapes kept in memory
+MAX_STATEMENTS = 512
+
+# Key in the pooled connection info holding the statements prepared on it
+CONNECTION_KEY = 'snowexsql_prepared'
+
+# Placeholders in the psycopg2 sql, expanding IN lists and escaped percents
+_PLACEHOLDERS = re.compile(
+    r'(NOT )?IN \(__\[POSTCOMPILE_([^\]]+)\]\)|%\(([^)]+)\)s|%%')
+
+
+class PreparedStatement(object):
+    """
+    A query compiled to PostgreSQL's numbered parameter style
+    """
+
+    def __init__(self, compiled, dialect):
+        """
+        Args:
+            compiled: sqlalchemy compiled statement for a psycopg2 dialect
+            dialect: Dialect the statement was compiled with
+        """
+        self.compiled = compiled
+        self.names = []
+        self.expanding = set()
+
+        def replace(match):
+            if match.group(0) == '%%':
+                return '%'
+
+            name = match.group(2) or match.group(3)
+            if name not in self.names:
+                self.names.append(name)
+            n = self.names.index(name) + 1
+
+            # Lists are sent as a single array so the statement works for
+            # any number of values
+            if match.group(2) is not None:
+                self.expanding.add(name)
+                op = '<> ALL' if match.group(1) else '= ANY'
+                return '{} (${})'.format(op, n)
+
+            return '${}'.format(n)
+
+        self.sql = _PLACEHOLDERS.sub(replace, str(compiled))
+        self.types = [self._type_name(n, dialect) for n in self.names]
+        self.name = 'snowexsql_' + hashlib.sha1(
+            '{}{}'.format(self.types, self.sql).encode('utf-8')).hexdigest()[:16]
+
+    def _type_name(self, name, dialect):
+        """
+        Name the parameter type so overloaded functions resolve, left as
+        unknown for PostgreSQL to infer when sqlalchemy doesn't know it
+        """
+        bind = self.compiled.binds.get(name)
+
+        try:
+            type_name = bind.type.compile(dialect=dialect)
+        except (AttributeError, CompileError, NotImplementedError):
+            return 'unknown'
+
+        if name in self.expanding:
+            type_name += '[]'
+
+        return type_name
+
+    def parameters(self, values):
+        """
+        Order the parameter values for EXECUTE applying the bind processors
+
+        Args:
+            values: Dictionary of parameter values by bind name
+
+        Returns:
+            params: List of values in parameter number order
+        """
+        processors = self.compiled._bind_processors
+        params = []
+
+        for name in self.names:
+            v = values[name]
+            process = processors.get(name)
+
+            if name in self.expanding:
+                if any(isinstance(i, tuple) for i in v):
+                    raise CompileError('Tuple IN lists cannot be prepared')
+                v = [process(i) for i in v] if process else list(v)
+
+            elif process is not None:
+                v = process(v)
+
+            params.append(v)
+
+        return params
+
+    @property
+    def prepare_sql(self):
+        """
+        The PREPARE statement creating this statement on a connection
+        """
+        types = ' ({})'.format(', '.join(self.types)) if self.types else ''
+        return 'PREPARE {}{} AS {}'.format(self.name, types, self.sql)
+
+    @property
+    def execute_sql(self):
+        """
+        The EXECUTE statement with driver placeholders for the parameters
+        """
+        if not self.names:
+            return 'EXECUTE {}'.format(self.name)
+
+        return 'EXECUTE {} ({})'.format(
+            self.name, ', '.join(['%s'] * len(self.names)))
+
+
+_statements = OrderedDict()
+_lock = threading.Lock()
+
+
+def prepare_query(query, dialect):
+    """
+    Compile a query into a prepared statement, reusing the compiled form of
+    any previous query of the same shape
+
+    Args:
+        query: Query object or sqlalchemy selectable
+        dialect: psycopg2 dialect to compile for, e.g. engine.dialect
+
+    Returns:
+        tuple: **statement** - PreparedStatement instance
+               **params** - List of parameter values for the statement
+    """
+    statement = getattr(query, 'statement', query)
+    cache_key = statement._generate_cache_key()
+
+    # Some constructs can't be cached so are compiled every time
+    if cache_key is None:
+        compiled = statement.compile(dialect=dialect)
+        prepared = PreparedStatement(compiled, dialect)
+        return prepared, prepared.parameters(compiled.construct_params())
+
+    key = (dialect.name, dialect.driver, cache_key.key)
+
+    with _lock:
+        prepared = _statements.get(key)
+        if prepared is not None:
+            _statements.move_to_end(key)
+
+    if prepared is None:
+        compiled = statement.compile(dialect=dialect, cache_key=cache_key)
+        prepared = PreparedStatement(compiled, dialect)
+
+        with _lock:
+            _statements[key] = prepared
+            while len(_statements) > MAX_STATEMENTS:
+                _statements.popitem(last=False)
+
+    values = prepared.compiled.construct_params(
+        extracted_parameters=cache_key.bindparams)
+    return prepared, prepared.parameters(values)
+
+
+def clear_statements():
+    """
+    Empty the compiled statement cache
+    """
+    with _lock:
+        _statements.clear()
+
+
+def _execute(cursor, prepared, params, names):
+    """
+    Prepare the statement on the connection if needed and execute it. A
+    connection keeps as many statements as are kept compiled, the least
+    recently used is deallocated to make room for a new one.
+    """
+    if prepared.name in names:
+        names.move_to_end(prepared.name)
+
+    else:
+        while len(names) >= MAX_STATEMENTS:
+            name, _ = names.popitem(last=False)
+            cursor.execute('DEALLOCATE {}'.format(name))
+
+        cursor.execute(prepared.prepare_sql)
+        names[prepared.name] = None
+
+    cursor.execute(prepared.execute_sql, params)
+
+
+def execute_prepared(engine, query):
+    """
+    Run a query as a server side prepared statement on a pooled connection.
+    The statement is prepared the first time its shape is run on a
+    connection and executed with only the parameters after that.
+
+    Args:
+        engine: sqlalchemy engine
+        query: Query object or sqlalchemy selectable
+
+    Returns:
+        tuple: **names** - List of the column names
+               **rows** - List of row tuples
+    """
+    prepared, params = prepare_query(query, engine.dialect)
+    conn = engine.raw_connection()
+
+    try:
+        names = conn.info.setdefault(CONNECTION_KEY, OrderedDict())
+        cursor = conn.cursor()
+
+        try:
+            _execute(cursor, prepared, params, names)
+
+        except errors.InvalidSqlStatementName:
+            # Something like DISCARD ALL dropped it, prepare again. Any
+            # others that are gone are found the same way when next used
+            log.debug('Statement {} is missing, preparing it again'
+                      ''.format(prepared.name))
+            conn.rollback()
+            names.pop(prepared.name, None)
+            cursor = conn.cursor()
+            _execute(cursor, prepared, params, names)
+
+        except errors.DuplicatePreparedStatement:
+            # Prepared on the connection without being recorded, use it
+            log.debug('Statement {} is already prepared'.format(prepared.name))
+            conn.rollback()
+            names[prepared.name] = None
+            cursor = conn.cursor()
+            _execute(cursor, prepared, params, names)
+
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.rollback()
+
+    except Exception:
+        conn.rollback()
+        raise
+
+    finally:
+        conn.close()
+
+    return columns, rows
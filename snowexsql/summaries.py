@@ -0,0 +1,342 @@
+"""
+Module for precomputed summaries of the points and layers tables. Row
+counts and value statistics are stored per combination of type, site_name,
+date, instrument and surveyors. The stored aggregates (count, mean, sum of
+squared deviations from the mean, min and max) can be combined, so any coarser grouping or filter on
+those columns is answered from the summary without scanning the data.
+Summaries are refreshed incrementally, only the groups with rows written by
+transactions the last refresh could not see are recomputed.
+"""
+from datetime import date
+
+import pandas as pd
+from sqlalchemy import (BigInteger, Column, Date, DateTime, Float, Index,
+                        MetaData, String, Table, case, cast, func, literal,
+                        inspect, literal_column, select, text, tuple_)
+from sqlalchemy.sql import sqltypes
+
+from .data import LayerData, PointData
+from .utilities import get_logger
+
+log = get_logger(__name__)
+
+# Columns the data is summarized by
+DIMENSIONS = ['type', 'site_name', 'date', 'instrument', 'surveyors']
+
+# Layer values are text, only those that look like numbers are summarized
+NUMBER_PATTERN = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+
+summary_meta = MetaData()
+
+
+def _summary_table(name):
+    """
+    Build a summary table, one row per group of the dimensions
+    """
+    return Table(
+        name, summary_meta,
+        Column('type', String(50)),
+        Column('site_name', String(250)),
+        Column('date', Date),
+        Column('instrument', String(50)),
+        Column('surveyors', String(100)),
+        Column('count', BigInteger),
+        Column('n', BigInteger),
+        Column('mean', Float),
+        Column('m2', Float),
+        Column('min', Float),
+        Column('max', Float),
+        Index('ix_{}_type_date'.format(name), 'type', 'date'),
+        schema='public')
+
+
+# Source table name to its model and summary table
+SUMMARIES = {
+    'points': (PointData, _summary_table('points_summary')),
+    'layers': (LayerData, _summary_table('layers_summary')),
+}
+
+WatermarksTable = Table(
+    'summary_watermarks', summary_meta,
+    Column('name', String(50), primary_key=True),
+    Column('snapshot_xmin', BigInteger),
+    Column('refreshed', DateTime(timezone=True)),
+    schema='public')
+
+
+def _numeric_value(model):
+    """
+    Value column as a float, non numeric layer values become null
+    """
+    if isinstance(model.value.type, sqltypes.Float):
+        return model.value
+
+    return case((model.value.op('~')(NUMBER_PATTERN), cast(model.value, Float)),
+                else_=None)
+
+
+def _group_keys(table):
+    """
+    Null safe versions of the dimension columns that can be hashed and
+    compared with IN. Null and the fill value land in the same group here,
+    which only means both groups get recomputed together.
+    """
+    keys = []
+    for d in DIMENSIONS:
+        fill = date(1, 1, 1) if d == 'date' else ''
+        keys.append(func.coalesce(table.c[d], literal(fill)))
+
+    return tuple_(*keys)
+
+
+def _aggregate(model, changed=None):
+    """
+    Select the summary rows of a model, limited to the groups in changed
+    """
+    value = _numeric_value(model)
+    source = model.__table__
+    dims = [source.c[d] for d in DIMENSIONS]
+
+    stmt = select(*dims,
+                  func.count().label('count'),
+                  func.count(value).label('n'),
+                  func.avg(value).label('mean'),
+                  (func.var_pop(value) * func.count(value)).label('m2'),
+                  func.min(value).label('min'),
+                  func.max(value).label('max'))
+
+    if changed is not None:
+        stmt = stmt.where(_group_keys(source).in_(select(changed)))
+
+    return stmt.group_by(*dims)
+
+
+def _written_since(model, distance):
+    """
+    Rows inserted or updated by a transaction at most distance transaction
+    ids before the current one. age() handles xid wraparound and frozen rows
+    are the maximum age, so they never match.
+    """
+    return func.age(literal_column('{}.xmin'.format(model.__tablename__))) <= distance
+
+
+def create_summaries(engine):
+    """
+    Create the summary tables if missing. Summaries stored as power sums by
+    an older version are dropped to be rebuilt.
+    """
+    with engine.begin() as conn:
+        for name, (model, summary) in SUMMARIES.items():
+            if not engine.dialect.has_table(conn, summary.name,
+                                            schema=summary.schema):
+                continue
+
+            columns = [c['name'] for c in inspect(conn).get_columns(
+                summary.name, schema=summary.schema)]
+
+            if 'm2' not in columns:
+                log.info('Dropping the outdated {} table'.format(summary.name))
+                summary.drop(bind=conn)
+                conn.execute(text('DELETE FROM {}.{} WHERE name = :name'.format(
+                    WatermarksTable.schema, WatermarksTable.name)), dict(name=name))
+
+    summary_meta.create_all(bind=engine, checkfirst=True)
+
+    # Watermarks tables from before the snapshot watermark get the column,
+    # their rows have none so the next refresh is a full one
+    with engine.begin() as conn:
+        conn.execute(text('ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS '
+                          'snapshot_xmin bigint'.format(WatermarksTable.schema,
+                                                        WatermarksTable.name)))
+
+
+def drop_summaries(engine):
+    """
+    Drop the summary tables, the next refresh rebuilds them from scratch
+    """
+    summary_meta.drop_all(bind=engine, checkfirst=True)
+
+
+def refresh_summary(engine, name='points', full=False):
+    """
+    Bring a summary up to date. Each refresh records the oldest transaction
+    still running when it started, the next one recomputes the groups
+    holding rows written by that transaction or any later one. This follows
+    commit order rather than the clock, so a long load that commits after a
+    refresh is still picked up. Deleted rows and rows moved to another group
+    aren't seen by an incremental refresh, use full after deleting or
+    regrouping data.
+
+    Args:
+        engine: sqlalchemy engine
+        name: Table to summarize, points or layers
+        full: Recompute every group
+
+    Returns:
+        groups: Number of summary rows written
+    """
+    model, summary = SUMMARIES[name]
+    create_summaries(engine)
+
+    with engine.begin() as conn:
+        # One refresh at a time, reads of the summary carry on
+        conn.execute(text('LOCK TABLE {}.{} IN EXCLUSIVE MODE'.format(
+            summary.schema, summary.name)))
+
+        previous = conn.execute(select(WatermarksTable.c.snapshot_xmin).where(
+            WatermarksTable.c.name == name)).scalar()
+
+        # Taken before aggregating, every transaction the aggregate can't see
+        # has an id at or above it
+        current, snapshot_xmin = conn.execute(text(
+            'SELECT txid_current(), txid_snapshot_xmin(txid_current_snapshot())')).one()
+
+        if full or previous is None:
+            conn.execute(summary.delete())
+            stmt = _aggregate(model)
+
+        else:
+            written = _written_since(model, current - previous)
+            changed = select(*_group_keys(model.__table__).clauses).where(
+                written).distinct().subquery()
+
+            conn.execute(summary.delete().where(
+                _group_keys(summary).in_(select(changed))))
+            stmt = _aggregate(model, changed=changed)
+
+        columns = [c.name for c in summary.columns]
+        groups = conn.execute(summary.insert().from_select(columns, stmt)).rowcount
+
+        conn.execute(WatermarksTable.delete().where(WatermarksTable.c.name == name))
+        conn.execute(WatermarksTable.insert().values(
+            name=name, snapshot_xmin=snapshot_xmin, refreshed=func.now()))
+
+    log.info('Refreshed {} groups of the {} summary'.format(groups, name))
+    return groups
+
+
+def refresh_summaries(engine, full=False):
+    """
+    Refresh the summaries of every table
+
+    Returns:
+        groups: Dictionary of table name to summary rows written
+    """
+    return {name: refresh_summary(engine, name=name, full=full)
+            for name in SUMMARIES}
+
+
+def _filter(stmt, table, filters):
+    """
+    Apply equality filters, lists of values become IN
+    """
+    for column, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            stmt = stmt.where(table.c[column].in_(list(value)))
+        else:
+            stmt = stmt.where(table.c[column] == value)
+
+    return stmt
+
+
+def _summary_statement(summary, by, filters):
+    """
+    Roll the stored groups up to the requested grouping. Means and squared
+    deviations are combined like analysis.StatsAccumulator merges them, the
+    spread of the group means about the overall mean is added to the sum of
+    each group's m2, so values far from zero keep their precision.
+    """
+    keys = [summary.c[b] for b in by]
+    weighted = func.sum(summary.c.n * summary.c.mean)
+
+    # Overall mean of the rolled up group alongside each stored group
+    overall = (weighted.over(partition_by=keys) /
+               func.nullif(cast(func.sum(summary.c.n).over(partition_by=keys),
+                                Float), 0))
+
+    groups = _filter(select(summary, overall.label('overall')), summary,
+                     filters).subquery()
+
+    keys = [groups.c[b] for b in by]
+    n = func.nullif(cast(func.sum(groups.c.n), Float), 0)
+    spread = groups.c.n * func.power(groups.c.mean - groups.c.overall, 2)
+    m2 = func.sum(groups.c.m2) + func.coalesce(func.sum(spread), 0)
+
+    stmt = select(*keys,
+                  cast(func.sum(groups.c.count), BigInteger).label('count'),
+                  (func.sum(groups.c.n * groups.c.mean) / n).label('mean'),
+                  func.sqrt(m2 / n).label('std'),
+                  func.min(groups.c.min).label('min'),
+                  func.max(groups.c.max).label('max'))
+
+    return stmt.group_by(*keys).order_by(*keys)
+
+
+def _data_statement(model, by, filters):
+    """
+    Compute the same statistics directly from the data
+    """
+    value = _numeric_value(model)
+    source = model.__table__
+
+    stmt = select(*[source.c[b] for b in by],
+                  func.count().label('count'),
+                  func.avg(value).label('mean'),
+                  func.stddev_pop(value).label('std'),
+                  func.min(value).label('min'),
+                  func.max(value).label('max'))
+
+    stmt = _filter(stmt, source, filters)
+    return stmt.group_by(*[source.c[b] for b in by]).order_by(
+        *[source.c[b] for b in by])
+
+
+def is_summarized(engine, name='points'):
+    """
+    Check whether a summary has been built for a table
+    """
+    with engine.connect() as conn:
+        if not engine.dialect.has_table(conn, WatermarksTable.name,
+                                        schema=WatermarksTable.schema):
+            return False
+
+        return conn.execute(select(WatermarksTable.c.name).where(
+            WatermarksTable.c.name == name)).first() is not None
+
+
+def summarize(engine, name='points', by=('type',), refresh=False,
+              use_summary=True, **filters):
+    """
+    Count and describe the values of the points or layers table by any of
+    type, site_name, date, instrument and surveyors. Answered from the
+    summary when it has been built and everything asked for is one of those
+    columns, otherwise computed from the data.
+
+    Args:
+        engine: sqlalchemy engine
+        name: Table to summarize, points or layers
+        by: Columns to group by
+        refresh: Incrementally refresh the summary first
+        use_summary: Set to False to always compute from the data
+        filters: Column=value filters, a list of values matches any of them
+
+    Returns:
+        df: pandas.DataFrame of the by columns then count, mean, std, min
+            and max, where count includes rows without a numeric value
+    """
+    model, summary = SUMMARIES[name]
+    by = list(by)
+
+    answerable = use_summary and set(by + list(filters)).issubset(DIMENSIONS)
+
+    if answerable and refresh:
+        refresh_summary(engine, name=name)
+
+    if answerable and is_summarized(engine, name=name):
+        stmt = _summary_statement(summary, by, filters)
+    else:
+        stmt = _data_statement(model, by, filters)
+
+    with engine.connect() as conn:
+        result = conn.execute(stmt)
+        return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
@@ -1,9 +1,21 @@
+import struct
+from datetime import date, time, timezone
 from os.path import dirname, join
 
+import numpy as np
+from affine import Affine
+from geoalchemy2.shape import from_shape
 from numpy.testing import assert_almost_equal
+from shapely import wkb
+from shapely.geometry import Point
 from sqlalchemy import asc
 
+from snowexsql.data import PointData
 from snowexsql.db import get_db, initialize
+from snowexsql.raster import BAND_HAS_NODATA, HEADER, PIXEL_TYPES, RasterArray
+
+# Columns of the raw point rows streamed in the chunking tests
+ROW_COLUMNS = ['id', 'type', 'value', 'site_name', 'geom']
 
 
 def pytest_generate_tests(metafunc):
@@ -21,6 +33,68 @@ def pytest_generate_tests(metafunc):
             )
 
 
+def make_point_rows(n, columns=ROW_COLUMNS, element=False):
+    """
+    Rows of points with the given columns without a database. The geometry
+    is WKB as it comes off a cursor or a geoalchemy2 element when element
+    is True
+    """
+    for i in range(n):
+        point = Point(743000 + i, 4324500 + i)
+        values = dict(
+            id=i, type='depth', value=float(i), easting=743000.0 + i,
+            northing=4324500.0 + i, site_name='Grand Mesa',
+            date=date(2020, 2, 1) if i else None,
+            time=time(10, 30, tzinfo=timezone.utc),
+            geom=from_shape(point, srid=26912) if element else
+            wkb.dumps(point, srid=26912))
+
+        yield tuple(values[c] for c in columns)
+
+
+def make_point_records(n):
+    """
+    Build a list of PointData objects without a database
+    """
+    columns = ['id', 'type', 'value', 'easting', 'northing', 'site_name', 'geom']
+    return [PointData(**dict(zip(columns, row)))
+            for row in make_point_rows(n, columns=columns, element=True)]
+
+
+def make_raster_wkb(bands, ul=(743000, 4324500), res=(1, -1), srid=26912,
+                    nodata=-9999, pixtype=10, endian='<'):
+    """
+    Encode arrays in the PostGIS raster WKB format
+    """
+    height, width = bands[0].shape
+    out = [struct.pack(endian + HEADER, 1 if endian == '<' else 0, 0,
+                       len(bands), res[0], res[1], ul[0], ul[1], 0, 0,
+                       srid, width, height)]
+    dtype = np.dtype(PIXEL_TYPES[pixtype]).newbyteorder(endian)
+
+    for band in bands:
+        flags = pixtype | (BAND_HAS_NODATA if nodata is not None else 0)
+        out.append(bytes([flags]))
+        out.append(np.array([nodata or 0], dtype=dtype).tobytes())
+        out.append(band.astype(dtype).tobytes())
+
+    return b''.join(out)
+
+
+def make_tiles(nodata=-9999):
+    """
+    Four 2x2 tiles covering a 4x4 grid with values equal to their index
+    """
+    grid = np.arange(16, dtype=float).reshape(4, 4)
+    tiles = []
+    for r in [0, 2]:
+        for c in [0, 2]:
+            t = Affine(1, 0, 743000 + c, 0, -1, 4324500 - r)
+            tiles.append(RasterArray([grid[r:r + 2, c:c + 2]], t, 26912,
+                                     [nodata]))
+    return grid, tiles
+
+
 class DBSetup:
     """
     Base class for all our tests. Ensures that we clean up after every class that's run
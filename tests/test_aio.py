@@ -0,0 +1,117 @@
+import asyncio
+import importlib.util
+from contextlib import asynccontextmanager
+from os.path import dirname, join
+
+import numpy as np
+import pytest
+
+from snowexsql.aio import *
+from snowexsql.data import PointData
+
+from .sql_test_base import (DBSetup, make_point_records, make_raster_wkb,
+                            make_tiles)
+
+
+class FakeAsyncEngine:
+    """
+    Stands in for an async engine, returns tiles for the ids bound in a
+    statement and tracks how many queries are in flight
+    """
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.queries = 0
+        self.active = 0
+        self.most_active = 0
+
+    @asynccontextmanager
+    async def connect(self):
+        yield self
+
+    async def execute(self, stmt):
+        self.queries += 1
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+
+        # Let the other batches run while this one waits
+        await asyncio.sleep(0.01)
+        self.active -= 1
+
+        ids = stmt.compile().params['id_1']
+        rows = []
+        for i in ids:
+            t = self.tiles[i].transform
+            rows.append((i, make_raster_wkb(self.tiles[i].bands, ul=(t.c, t.f))))
+        return type('Result', (), {'fetchall': lambda s: rows})()
+
+
+@pytest.mark.parametrize("max_concurrency, batch_size, expected_queries, expected_active", [
+    (1, None, 4, 1), (4, None, 4, 4), (2, 1, 4, 2), (4, 3, 2, 2)])
+def test_fetch_tiles(max_concurrency, batch_size, expected_queries, expected_active):
+    """
+    Test tiles are fetched in concurrent batches and decoded
+    """
+    grid, tiles = make_tiles()
+    engine = FakeAsyncEngine(dict(enumerate(tiles)))
+    fetched = asyncio.run(fetch_tiles(engine, range(4), max_concurrency=max_concurrency,
+                                      batch_size=batch_size))
+
+    assert engine.queries == expected_queries
+    assert engine.most_active == expected_active
+    assert sorted(fetched) == [0, 1, 2, 3]
+    np.testing.assert_array_equal(fetched[3].read(1), grid[2:4, 2:4])
+
+
+def test_fetch_tiles_empty():
+    assert asyncio.run(fetch_tiles(None, [])) == {}
+
+
+@pytest.mark.skipif(importlib.util.find_spec('asyncpg') is None,
+                    reason='asyncpg is not installed')
+class TestAsyncOnDB(DBSetup):
+    """
+    Test the async conversions match the synchronous ones
+    """
+
+    def setup_class(self):
+        """
+        Setup the database one time for testing
+        """
+        super().setup_class()
+        self.session.add_all(make_point_records(10))
+        self.session.commit()
+
+    def run(self, fn, *args, **kwargs):
+        async def main():
+            engine = get_async_engine(
+                'localhost/test', credentials=join(dirname(__file__), 'credentials.json'))
+            try:
+                return await fn(*args, engine, **kwargs)
+            finally:
+                await dispose_async_engines()
+
+        return asyncio.run(main())
+
+    def test_query_to_pandas(self):
+        qry = self.session.query(PointData.id, PointData.value).order_by(PointData.id)
+        df = self.run(query_to_pandas, qry)
+
+        assert len(df) == 10
+        assert df['value'].iloc[2] == 2
+
+    def test_query_to_geopandas(self):
+        qry = self.session.query(PointData).order_by(PointData.id)
+        df = self.run(query_to_geopandas, qry)
+
+        assert df.crs.to_epsg() == 26912
+        assert df['geom'].iloc[1].x == 743001
+
+    def test_concurrent_queries(self):
+        async def many(engine):
+            qrys = [self.session.query(PointData.value).filter(PointData.id == i)
+                    for i in range(10)]
+            return await asyncio.gather(*[query_to_pandas(q, engine) for q in qrys])
+
+        dfs = self.run(many)
+        assert [df['value'].iloc[0] for df in dfs] == list(range(10))
@@ -1,6 +1,17 @@
+import pickle
+
 import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
 
 from snowexsql.analysis import *
+from snowexsql.analysis import _numeric
+from snowexsql.data import LayerData, PointData
+
+from .sql_test_base import DBSetup
 
 
 def test_get_stats():
@@ -13,3 +24,157 @@ def test_get_stats():
 
     for s,v in expected.items():
         assert v == expected[s]
+
+
+@pytest.fixture()
+def values():
+    rng = np.random.default_rng(0)
+    x = rng.normal(50, 10, 10000)
+    x[::97] = np.nan
+    return x
+
+
+def test_get_stats_chunks(values):
+    """
+    Test chunks of data give the same stats as the whole array
+    """
+    received = get_stats(iter(np.array_split(values, 7)))
+    expected = {'mean': np.nanmean(values), 'min': np.nanmin(values),
+                'max': np.nanmax(values), 'std': np.nanstd(values)}
+
+    assert list(received) == ['mean', 'min', 'max', 'std']
+    for s, v in expected.items():
+        assert received[s] == pytest.approx(v)
+
+
+def test_stats_accumulator_merge(values):
+    """
+    Test accumulators of separate chunks merge to the totals
+    """
+    parts = [StatsAccumulator(bins=10, range=(0, 100)).update(c)
+             for c in np.array_split(values, 5)]
+    merged = StatsAccumulator(bins=10, range=(0, 100))
+    for p in parts:
+        merged.merge(pickle.loads(pickle.dumps(p)))
+
+    counts, _ = np.histogram(values[~np.isnan(values)], np.linspace(0, 100, 11))
+
+    assert merged.count == np.count_nonzero(~np.isnan(values))
+    assert merged.mean == pytest.approx(np.nanmean(values))
+    assert merged.std == pytest.approx(np.nanstd(values))
+    np.testing.assert_array_equal(merged.histogram, counts)
+    assert merged.outside == 0
+
+
+def test_stats_accumulator_quantiles(values):
+    stats = StatsAccumulator(sample_size=2000, seed=1)
+    for c in np.array_split(values, 10):
+        stats.update(c)
+
+    assert len(stats.sample) == 2000
+    np.testing.assert_allclose(stats.quantile([0.25, 0.5, 0.75]),
+                               np.nanquantile(values, [0.25, 0.5, 0.75]), rtol=0.03)
+
+
+def test_stats_accumulator_exact_quantiles():
+    """
+    Test quantiles are exact while the sample holds every value
+    """
+    stats = StatsAccumulator(sample_size=100).update([1, 2]).update([3, 4, 5])
+    assert stats.quantile(0.5) == 3
+
+
+def test_stats_accumulator_empty():
+    stats = StatsAccumulator().update([np.nan])
+
+    assert stats.count == 0
+    assert np.isnan(stats.mean) and np.isnan(stats.std)
+
+
+@pytest.mark.parametrize("kwargs", [dict(bins=10), dict(sample_size=None)])
+def test_stats_accumulator_errors(kwargs):
+    with pytest.raises(ValueError):
+        StatsAccumulator(**kwargs).quantile(0.5)
+
+
+def test_accumulate_groups():
+    chunks = [pd.DataFrame({'type': ['depth', 'swe'], 'value': [1.0, 10.0]}),
+              pd.DataFrame({'type': ['depth', 'depth'], 'value': [2.0, 3.0]})]
+    groups = accumulate(iter(chunks), column='value', by='type')
+
+    assert groups['depth'].mean == 2
+    assert groups['depth'].count == 3
+    assert groups['swe'].max == 10
+
+
+def test_get_stats_quantiles():
+    received = get_stats(np.array([1, 2, 3, 4, np.nan]), quantiles=[0.5, 0.75])
+
+    assert received['q0.5'] == 2.5
+    assert received['q0.75'] == 3.25
+
+
+def test_get_stats_accumulator_quantiles():
+    stats = StatsAccumulator(sample_size=10).update(np.array([1, 2, 3, 4.]))
+    received = get_stats(stats, quantiles=[0.5])
+
+    assert received['q0.5'] == 2.5
+
+
+def test_query_stats_integer_column():
+    """
+    Test integer columns are used as is, only text is matched as a number
+    """
+    qry = Session().query(PointData.version_number, LayerData.value)
+    stmt = select(_numeric(qry.statement.subquery().c['version_number']))
+    assert '~' not in str(stmt.compile(dialect=postgresql.dialect()))
+
+    stmt = select(_numeric(qry.statement.subquery().c['value']))
+    assert '~' in str(stmt.compile(dialect=postgresql.dialect()))
+
+
+@pytest.mark.parametrize("data, kwargs", [
+    (np.ones(3), dict(by='type')),
+    (iter([np.ones(3)]), dict(quantiles=[0.5])),
+    (StatsAccumulator().update(np.ones(3)), dict(quantiles=[0.5])),
+])
+def test_get_stats_errors(data, kwargs):
+    with pytest.raises(ValueError):
+        get_stats(data, **kwargs)
+
+
+class TestStatsOnDB(DBSetup):
+    """
+    Test statistics of queries calculated in the database
+    """
+
+    def setup_class(self):
+        super().setup_class()
+
+        for site, v in [('A', 10), ('A', 20), ('B', 30), ('B', None)]:
+            self.session.add(PointData(type='depth', site_id=site, value=v))
+        for v in ['217.5', '4F', '250']:
+            self.session.add(LayerData(type='density', site_id='1N20', value=v))
+        self.session.commit()
+
+    def test_get_stats_query(self):
+        received = get_stats(self.session.query(PointData.value), quantiles=[0.5])
+        values = np.array([10, 20, 30])
+
+        assert received['mean'] == pytest.approx(values.mean())
+        assert received['std'] == pytest.approx(values.std())
+        assert received['q0.5'] == 20
+
+    def test_get_stats_query_by(self):
+        df = get_stats(self.session.query(PointData.site_id, PointData.value),
+                       by='site_id')
+
+        assert df['site_id'].tolist() == ['A', 'B']
+        assert df['mean'].tolist() == [15, 30]
+        assert df['count'].tolist() == [2, 1]
+
+    def test_query_stats_text_values(self):
+        df = query_stats(self.session.query(LayerData.value), self.engine, ddof=1)
+
+        assert df['count'].iloc[0] == 2
+        assert df['std'].iloc[0] == pytest.approx(np.std([217.5, 250], ddof=1))
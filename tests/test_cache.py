@@ -0,0 +1,324 @@
+import os
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from snowexsql.cache import QueryCache, query_tables
+from snowexsql.conversions import query_to_geopandas, query_to_pandas
+from snowexsql.data import ImageData, LayerData, PointData
+
+from .sql_test_base import DBSetup, make_point_records
+
+
+@pytest.fixture()
+def session():
+    return Session()
+
+
+@pytest.fixture()
+def engine():
+    # Never connects, only used for compiling and the url
+    return create_engine('postgresql+psycopg2://user@localhost/test')
+
+
+@pytest.fixture()
+def cache(tmpdir, monkeypatch):
+    cache = QueryCache(str(tmpdir), max_bytes=10 * 1024 ** 2)
+    cache.version_calls = 0
+
+    def table_versions(engine, tables):
+        cache.version_calls += 1
+        return [cache.versions.get(t, 0) for t in tables]
+
+    cache.versions = {}
+    monkeypatch.setattr(cache, 'table_versions', table_versions)
+    return cache
+
+
+def make_frame(n=5):
+    return pd.DataFrame({'id': np.arange(n), 'value': np.linspace(0, 1, n)})
+
+
+def test_query_tables(session):
+    """
+    Test the tables referenced by a query are found once each
+    """
+    qry = session.query(PointData.id, LayerData.value).filter(
+        PointData.site_id == LayerData.site_id)
+    assert query_tables(qry) == [('public', 'layers'), ('public', 'points')]
+
+
+def test_query_tables_subquery(session):
+    """
+    Test tables inside a subquery are found
+    """
+    sub = session.query(ImageData.id).subquery()
+    qry = session.query(sub.c.id)
+    assert query_tables(qry) == [('public', 'images')]
+
+
+@pytest.mark.parametrize('other, same', [
+    # Same query with the same value
+    (lambda s: s.query(PointData.id).filter(PointData.type == 'depth'), True),
+    # Different bound value
+    (lambda s: s.query(PointData.id).filter(PointData.type == 'swe'), False),
+    # Different columns
+    (lambda s: s.query(PointData.value).filter(PointData.type == 'depth'), False),
+])
+def test_key(cache, session, engine, other, same):
+    """
+    Test the key depends on the sql and its bound parameters
+    """
+    qry = session.query(PointData.id).filter(PointData.type == 'depth')
+    key = cache.key(qry, engine, 'pandas')
+    assert (cache.key(other(session), engine, 'pandas') == key) == same
+
+
+def test_key_table_version(cache, session, engine):
+    """
+    Test a change in a table version changes the key
+    """
+    qry = session.query(PointData.id)
+    key = cache.key(qry, engine, 'pandas')
+
+    cache.versions[('public', 'points')] = 1
+    assert cache.key(qry, engine, 'pandas') != key
+
+
+def test_key_options(cache, session, engine):
+    """
+    Test options and the kind of result change the key
+    """
+    qry = session.query(PointData.id)
+    key = cache.key(qry, engine, 'pandas')
+
+    assert cache.key(qry, engine, 'geopandas') != key
+    assert cache.key(qry, engine, 'pandas', index_col='id') != key
+
+
+def test_query_to_pandas_cache_modes(cache, session, engine, monkeypatch):
+    """
+    Test results read with COPY and read_sql are cached separately
+    """
+    qry = session.query(PointData.id)
+    monkeypatch.setattr('snowexsql.conversions._try_copy',
+                        lambda *args, **kwargs: make_frame(1))
+    monkeypatch.setattr(pd, 'read_sql', lambda *args, **kwargs: make_frame(2))
+
+    assert len(query_to_pandas(qry, engine, cache=cache, copy=True)) == 1
+    assert len(query_to_pandas(qry, engine, cache=cache)) == 2
+    assert len(query_to_pandas(qry, engine, cache=cache, copy=True)) == 1
+    assert cache.hits == 1
+
+
+def test_fetch_hit(cache, session, engine):
+    """
+    Test a repeat fetch reads from the cache and tracks the statistics
+    """
+    qry = session.query(PointData.id)
+    calls = []
+
+    def read():
+        calls.append(1)
+        return make_frame()
+
+    df = cache.fetch(qry, engine, read)
+    cached = cache.fetch(qry, engine, read)
+
+    pd.testing.assert_frame_equal(df, cached)
+    assert len(calls) == 1
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+    assert stats['entries'] == 1
+
+
+def test_fetch_geopandas(cache, session, engine):
+    """
+    Test geodataframes keep their geometry and crs through the cache
+    """
+    qry = session.query(PointData)
+    expected = gpd.GeoDataFrame(
+        {'value': [1.0, 2.0]}, geometry=[Point(0, 0), Point(1, 1)],
+        crs='EPSG:26912')
+
+    cache.fetch(qry, engine, lambda: expected, kind='geopandas')
+    df = cache.fetch(qry, engine, lambda: None, kind='geopandas')
+
+    assert isinstance(df, gpd.GeoDataFrame)
+    assert df.crs.to_epsg() == 26912
+    assert df.geometry.iloc[1].equals(Point(1, 1))
+
+
+def test_fetch_invalidated(cache, session, engine):
+    """
+    Test a table change causes the result to be read again
+    """
+    qry = session.query(PointData.id)
+    cache.fetch(qry, engine, make_frame)
+
+    cache.versions[('public', 'points')] = 1
+    df = cache.fetch(qry, engine, lambda: make_frame(2))
+
+    assert len(df) == 2
+    assert cache.misses == 2
+
+
+def test_put_unserializable(cache):
+    """
+    Test results parquet can't store are skipped without an error
+    """
+    df = pd.DataFrame({'a': [object(), object()]})
+    cache.put('key', df)
+
+    assert cache.get('key') is None
+    assert os.listdir(cache.directory) == []
+
+
+def test_evict_lru(cache):
+    """
+    Test the least recently used results are removed once over budget
+    """
+    df = make_frame(1000)
+    cache.put('a', df)
+    size = cache.stats()['bytes']
+    cache.max_bytes = int(size * 2.5)
+
+    cache.put('b', df)
+
+    # Make a older than b then use it so b is the least recent
+    past = time.time() - 100
+    os.utime(cache._path('a'), (past, past))
+    os.utime(cache._path('b'), (past + 1, past + 1))
+    cache.get('a')
+
+    cache.put('c', df)
+
+    assert cache.evictions == 1
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+
+
+def test_clear(cache):
+    """
+    Test clearing the cache removes every result
+    """
+    cache.put('a', make_frame())
+    cache.clear()
+    assert cache.stats()['entries'] == 0
+
+
+def test_version_default():
+    """
+    Test the deterministic timestamps version is the default
+    """
+    assert QueryCache('.').version == 'timestamps'
+
+
+def test_version_method():
+    """
+    Test an unknown table version method raises an error
+    """
+    with pytest.raises(ValueError):
+        QueryCache('.', version='bad')
+
+
+class TestCacheOnDB(DBSetup):
+    """
+    Test the cache invalidates from the table versions in the database
+    """
+
+    def setup_class(self):
+        """
+        Setup the database one time for testing
+        """
+        super().setup_class()
+        self.session.add_all(make_point_records(10))
+        self.session.commit()
+
+    @pytest.mark.parametrize('version', ['stats', 'timestamps'])
+    def test_query_to_pandas_cache(self, tmpdir, version):
+        cache = QueryCache(str(tmpdir), version=version)
+        qry = self.session.query(PointData.id, PointData.value)
+
+        df = query_to_pandas(qry, self.engine, cache=cache)
+        cached = query_to_pandas(qry, self.engine, cache=cache)
+
+        pd.testing.assert_frame_equal(df, cached)
+        assert cache.hits == 1
+
+    def test_query_to_geopandas_cache(self, tmpdir):
+        cache = QueryCache(str(tmpdir))
+        qry = self.session.query(PointData)
+
+        query_to_geopandas(qry, self.engine, cache=cache)
+        df = query_to_geopandas(qry, self.engine, cache=cache)
+
+        assert cache.hits == 1
+        assert df.crs.to_epsg() == 26912
+
+    def test_cache_invalidated(self, tmpdir):
+        """
+        Test a write is seen by the very next read through the default cache
+        """
+        cache = QueryCache(str(tmpdir))
+        qry = self.session.query(PointData.id)
+
+        before = len(query_to_pandas(qry, self.engine, cache=cache))
+        self.session.add(PointData(type='depth', value=1.0))
+        self.session.commit()
+        df = query_to_pandas(qry, self.engine, cache=cache)
+
+        assert cache.hits == 0
+        assert len(df) == before + 1
+
+    def test_timestamps_version_without_stamps(self, tmpdir):
+        """
+        Test tables without time_created/time_updated are versioned by count
+        """
+        cache = QueryCache(str(tmpdir))
+        self.session.execute(text('CREATE TABLE version_test (id integer)'))
+        self.session.commit()
+
+        try:
+            before = cache.table_versions(self.engine, [('public', 'version_test')])
+            self.session.execute(text('INSERT INTO version_test VALUES (1)'))
+            self.session.commit()
+            after = cache.table_versions(self.engine, [('public', 'version_test')])
+
+            assert before == [['0']]
+            assert after == [['1']]
+
+        finally:
+            self.session.execute(text('DROP TABLE version_test'))
+            self.session.commit()
+
+    def test_stats_version_truncate(self, tmpdir):
+        """
+        Test truncating a table changes its version even though the row
+        counters don't move
+        """
+        cache = QueryCache(str(tmpdir), version='stats')
+        self.session.execute(text('CREATE TABLE version_test (id integer)'))
+        self.session.commit()
+
+        try:
+            before = cache.table_versions(self.engine, [('public', 'version_test')])
+            self.session.execute(text('TRUNCATE version_test'))
+            self.session.commit()
+            after = cache.table_versions(self.engine, [('public', 'version_test')])
+
+            assert before != after
+
+        finally:
+            self.session.execute(text('DROP TABLE version_test'))
+            self.session.commit()
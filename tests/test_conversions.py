@@ -1,15 +1,15 @@
-import os
-import shutil
-from os.path import isdir, join
+from os.path import join
 
 import pytest
 from sqlalchemy import func
 
 from snowexsql.conversions import *
-from .sql_test_base import DBSetup
+from snowexsql.load import load_points, load_raster
+
+from .sql_test_base import (ROW_COLUMNS, DBSetup, make_point_records,
+                            make_point_rows)
 
 
-@pytest.mark.skip('Need to determine how to setup db for testing post splitting')
 class TestConversionsOnDB(DBSetup):
     """
     Test any conversions that require a database
@@ -21,31 +21,21 @@ class TestConversionsOnDB(DBSetup):
         """
         super().setup_class()
 
-        # Upload one raster
-        raster_f = join(self.data_dir, 'be_gm1_0287', 'w001001x.adf')
-        u = UploadRaster(filename=raster_f, epsg=26912, use_s3=False)
-        u.submit(self.session)
-
-        # Upload some point data
-        fname = join(self.data_dir, 'depths.csv')
-        csv = PointDataCSV(fname, depth_is_metadata=False, units='cm', site_name='Grand Mesa',
-                           epsg=26912)
-        csv.submit(self.session)
+        # Load one raster and some point data
+        self.raster_f = join(self.data_dir, 'be_gm1_0287', 'w001001x.adf')
+        load_raster(self.engine, self.raster_f, epsg=26912, max_workers=1)
+        load_points(self.engine, join(self.data_dir, 'depths.csv'),
+                    site_name='Grand Mesa', units='cm')
 
     def test_points_to_geopandas(self):
         """
-        Test converting records of points to geopandas df
+        Test converting returned records of points to geopandas df
         """
         records = self.session.query(PointData).all()
         df = points_to_geopandas(records)
 
-        # Confirm the type
         assert isinstance(df, gpd.GeoDataFrame)
-
-        # Confirm we have geometry
         assert 'geom' in df.columns
-
-        # Confirm value count
         assert df['value'].count() == 10
 
     def test_query_to_geopandas_w_geom(self):
@@ -55,10 +45,7 @@ class TestConversionsOnDB(DBSetup):
         qry = self.session.query(PointData)
         df = query_to_geopandas(qry, self.engine)
 
-        # Confirm the type
         assert isinstance(df, gpd.GeoDataFrame)
-
-        # Confirm value count
         assert df['value'].count() == 10
 
     def test_query_to_geopandas_wo_geom(self):
@@ -69,28 +56,9 @@ class TestConversionsOnDB(DBSetup):
         qry = self.session.query(func.ST_Centroid(func.ST_Envelope(ImageData.raster)))
         df = query_to_geopandas(qry, self.engine, geom_col='ST_Centroid_1')
 
-        # Confirm the type
         assert isinstance(df, gpd.GeoDataFrame)
-
-        # Confirm value count
         assert df['ST_Centroid_1'].count() == 16
 
-    def test_points_to_geopandas(self):
-        """
-        Test converting returned records of points to geopandas df
-        """
-        records = self.session.query(PointData).all()
-        df = points_to_geopandas(records)
-
-        # Confirm the type
-        assert isinstance(df, gpd.GeoDataFrame)
-
-        # Confirm we have geometry
-        assert 'geom' in df.columns
-
-        # Confirm value count
-        assert df['value'].count() == 10
-
     def test_query_to_pandas(self):
         """
         Test converting a query of a query to a dataframe using Imagedata which has no geom column
@@ -98,24 +66,216 @@ class TestConversionsOnDB(DBSetup):
         qry = self.session.query(ImageData.id, ImageData.date)
         df = query_to_pandas(qry, self.engine)
 
-        # Confirm the type
         assert isinstance(df, pd.DataFrame)
-
-        # Confirm value count
         assert df['id'].count() == 16
 
-
     def test_raster_to_rasterio(self):
         """
         Test numpy retrieval array of a raster via rasterio
         """
         rasters = self.session.query(func.ST_AsTiff(ImageData.raster)).all()
-        dataset = raster_to_rasterio(self.session, rasters)[0]
+        datasets = raster_to_rasterio(self.session, rasters)
+        values = np.concatenate([d.read(1, masked=True).compressed()
+                                 for d in datasets])
+
+        with rasterio.open(self.raster_f) as ds:
+            expected = ds.read(1, masked=True).compressed()
+
+        assert len(datasets) == 16
+        np.testing.assert_approx_equal(values.mean(), expected.mean(),
+                                       significant=6)
+
+
+# Independent Tests
+def test_points_to_geopandas_wo_db():
+    """
+    Test the columnar conversion of records to geopandas
+    """
+    df = points_to_geopandas(make_point_records(10))
+
+    assert isinstance(df, gpd.GeoDataFrame)
+    assert df.geometry.name == 'geom'
+    assert df['value'].count() == 10
+
+    # Only table columns should make it into the dataframe
+    assert 'metadata' not in df.columns
+    assert df['geom'].iloc[3].x == 743003
+    assert df['geom'].iloc[3].y == 4324503
+
+
+@pytest.mark.parametrize("chunksize, max_bytes, n, expected_chunks", [
+    (100, None, 1000, 10),
+    (300, None, 1000, 4),
+    (1000, 50000, 100, 1)])
+def test_iter_dataframes_chunks(chunksize, max_bytes, n, expected_chunks):
+    """
+    Test rows are grouped into bounded dataframes with decoded geometry
+    """
+    from snowexsql.conversions import _iter_dataframes
+
+    chunks = list(_iter_dataframes(make_point_rows(n), ROW_COLUMNS,
+                                   chunksize=chunksize, max_bytes=max_bytes,
+                                   geom_col='geom'))
+
+    assert len(chunks) == expected_chunks
+    assert sum(len(df) for df in chunks) == n
+    assert all(len(df) <= chunksize for df in chunks)
+    assert isinstance(chunks[-1], gpd.GeoDataFrame)
+    assert chunks[-1]['geom'].iloc[-1].x == 743000 + n - 1
+
+
+def test_iter_dataframes_max_bytes():
+    """
+    Test a memory ceiling bounds every chunk, the first included
+    """
+    from snowexsql.conversions import _iter_dataframes
+
+    chunks = list(_iter_dataframes(make_point_rows(1000), ROW_COLUMNS,
+                                   chunksize=500, max_bytes=20000))
+
+    assert len(chunks[0]) < 500
+    assert sum(len(df) for df in chunks) == 1000
+    for df in chunks:
+        assert df.memory_usage(deep=True).sum() <= 20000
+
+
+def test_iter_dataframes_memory_ceiling():
+    """
+    Test the peak memory of streaming does not grow with the table size
+    """
+    import tracemalloc
+    from snowexsql.conversions import _iter_dataframes
+
+    peaks = []
 
-        arr = dataset.read(1)
+    for n in [5000, 20000]:
+        tracemalloc.start()
+        count = 0
+        for df in _iter_dataframes(make_point_rows(n), ROW_COLUMNS,
+                                   chunksize=1000, max_bytes=200000,
+                                   geom_col='geom'):
+            count += len(df)
+            del df
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        assert count == n
+
+    # Four times the rows should not cost more memory
+    assert peaks[1] < 1.5 * peaks[0]
+
+
+class TestStreamingOnDB(DBSetup):
+    """
+    Test streaming queries off a server side cursor
+    """
+
+    def setup_class(self):
+        """
+        Setup the database one time for testing
+        """
+        super().setup_class()
+        self.session.add_all(make_point_records(25))
+        self.session.commit()
+
+    @pytest.mark.parametrize("chunksize, expected_chunks", [(10, 3), (25, 1)])
+    def test_query_to_geopandas_chunks(self, chunksize, expected_chunks):
+        """
+        Test streaming a query of points as geopandas chunks
+        """
+        qry = self.session.query(PointData).order_by(PointData.id)
+        chunks = list(query_to_geopandas_chunks(qry, self.engine,
+                                                chunksize=chunksize))
+
+        assert len(chunks) == expected_chunks
+        assert all(isinstance(df, gpd.GeoDataFrame) for df in chunks)
+        assert sum(df['value'].count() for df in chunks) == 25
+
+    def test_query_to_pandas_chunks(self):
+        """
+        Test streaming a query without a geometry into pandas chunks
+        """
+        qry = self.session.query(PointData.id, PointData.value)
+        chunks = list(query_to_pandas_chunks(qry, self.engine, chunksize=20))
+
+        assert len(chunks) == 2
+        assert isinstance(chunks[0], pd.DataFrame)
+
+    def test_query_to_arrow(self):
+        """
+        Test converting a query of points to an arrow table
+        """
+        qry = self.session.query(PointData)
+        table = query_to_arrow(qry, self.engine, chunksize=10)
+
+        assert table.num_rows == 25
+        assert b'geo' in table.schema.metadata
+
+    def test_query_to_geoparquet(self, tmp_path):
+        """
+        Test streaming a query of points to a GeoParquet file
+        """
+        f = str(tmp_path / 'points.parquet')
+        qry = self.session.query(PointData)
+        count = query_to_geoparquet(qry, self.engine, f, row_group_size=10)
+        df = gpd.read_parquet(f)
+
+        assert count == 25
+        assert df['value'].count() == 25
+        assert df.crs.to_epsg() == 26912
+
+
+POINT_FIELDS = [('id', PointData.id.type), ('type', PointData.type.type),
+                ('value', PointData.value.type), ('date', PointData.date.type),
+                ('time', PointData.time.type), ('geom', PointData.geom.type)]
+
+
+def make_point_partitions(n, size):
+    """
+    Rows of the POINT_FIELDS split into partitions like a streamed result
+    """
+    rows = list(make_point_rows(n, columns=[f for f, _ in POINT_FIELDS],
+                                element=True))
+    return [rows[i:i + size] for i in range(0, n, size)]
+
+
+def test_arrow_batches():
+    """
+    Test rows are converted to arrow with WKB geometry and geo metadata
+    """
+    import json
+    import pyarrow as pa
+    from snowexsql.conversions import _arrow_batches
+
+    batches = list(_arrow_batches(make_point_partitions(10, 4), POINT_FIELDS))
+    table = pa.Table.from_batches(batches)
+
+    assert len(batches) == 3
+    assert table.num_rows == 10
+    assert table.schema.field('id').type == pa.int32()
+    assert table.schema.field('date').type == pa.date32()
+    assert table.schema.field('geom').type == pa.binary()
+
+    geo = json.loads(table.schema.metadata[b'geo'])
+    assert geo['primary_column'] == 'geom'
+    assert geo['columns']['geom']['encoding'] == 'WKB'
+    assert geo['columns']['geom']['crs']['id']['code'] == 26912
+
+
+def test_write_geoparquet(tmp_path):
+    """
+    Test writing streamed batches to a GeoParquet file geopandas can read
+    """
+    import pyarrow.parquet as pq
+    from snowexsql.conversions import _arrow_batches, _write_parquet
 
-        v = np.mean(arr)
+    f = str(tmp_path / 'points.parquet')
+    batches = _arrow_batches(make_point_partitions(10, 4), POINT_FIELDS)
+    count = _write_parquet(batches, POINT_FIELDS, f, row_group_size=4)
 
-        # Mean pulled from gdalinfo -stats be_gm1_0287/w001001x.adf
-        np.testing.assert_approx_equal(v, 3058.005, significant=3)
+    assert count == 10
+    assert pq.ParquetFile(f).num_row_groups == 3
 
+    df = gpd.read_parquet(f)
+    assert df.crs.to_epsg() == 26912
+    assert df.geometry.name == 'geom'
+    assert df['geom'].iloc[3].x == 743003
@@ -1,9 +1,14 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os import remove
 from os.path import dirname, join
 
 import pytest
-from sqlalchemy import MetaData, Table, inspect
+from sqlalchemy import MetaData, Table, create_engine, inspect, text
 
+from snowexsql import db
 from snowexsql.data import ImageData, LayerData, PointData, SiteData
 from snowexsql.db import *
 
@@ -84,3 +89,200 @@ def test_getting_db(return_metadata, expected_objs):
 
     result = get_db('builder:db_builder@localhost/test', return_metadata=return_metadata)
     assert len(result) == expected_objs
+
+
+@pytest.fixture()
+def registry():
+    yield
+    dispose_engines()
+
+
+def test_get_engine_shared(registry):
+    """
+    Test the same database and credentials share one engine
+    """
+    creds = join(dirname(__file__), 'credentials.json')
+    engine = get_engine('localhost/test', credentials=creds)
+
+    assert get_engine('localhost/test', credentials=creds) is engine
+    assert get_engine('builder:db_builder@localhost/test') is engine
+    assert get_db('localhost/test', credentials=creds)[0] is engine
+
+
+@pytest.mark.parametrize("db_str, kwargs", [
+    ('localhost/other', {}),
+    ('localhost/test', {'pool_size': 2}),
+    ('localhost/test', {'pool_pre_ping': False})])
+def test_get_engine_distinct(registry, db_str, kwargs):
+    """
+    Test different databases or pool settings get their own engine
+    """
+    assert get_engine(db_str, **kwargs) is not get_engine('localhost/test')
+
+
+def test_get_engine_pool(registry):
+    """
+    Test the pool settings are applied to the engine
+    """
+    engine = get_engine('localhost/test', pool_size=3, max_overflow=1,
+                        pool_recycle=60)
+
+    assert engine.pool.size() == 3
+    assert engine.pool._max_overflow == 1
+    assert engine.pool._recycle == 60
+    assert engine.pool._pre_ping
+
+
+def test_get_session_factory(registry):
+    """
+    Test sessions come from one factory bound to the shared engine
+    """
+    Session = get_session_factory('localhost/test')
+
+    assert get_session_factory('localhost/test') is Session
+    assert Session().get_bind() is get_engine('localhost/test')
+
+
+def test_dispose_engines():
+    """
+    Test disposing empties the registry
+    """
+    engine = get_engine('localhost/test')
+    dispose_engines()
+    assert get_engine('localhost/test') is not engine
+    dispose_engines()
+
+
+def test_session_scope_error(registry):
+    """
+    Test errors in a session scope are raised after rolling back
+    """
+    with pytest.raises(ValueError):
+        with session_scope('localhost/test') as session:
+            session.add(PointData(value=1))
+            raise ValueError('Failed')
+
+    assert len(session.new) == 0
+
+
+def test_get_scoped_session_threads(registry):
+    """
+    Test each thread gets its own session from the shared engine
+    """
+    Session = get_scoped_session('localhost/test')
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        sessions = list(pool.map(lambda i: (threading.get_ident(), Session()), range(20)))
+
+    by_thread = {}
+    for ident, session in sessions:
+        assert by_thread.setdefault(ident, session) is session
+
+    assert len(set(map(id, by_thread.values()))) == len(by_thread)
+    assert get_scoped_session('localhost/test') is Session
+    assert Session().get_bind() is get_engine('localhost/test')
+
+
+def test_worker_session(registry):
+    """
+    Test the thread's session is removed once the work is done and nested
+    blocks share it
+    """
+    Session = get_scoped_session('localhost/test')
+
+    with worker_session('localhost/test') as session:
+        with worker_session('localhost/test') as nested:
+            assert nested is session
+        assert Session.registry.has()
+
+    assert not Session.registry.has()
+
+
+def test_worker_session_error(registry):
+    with pytest.raises(ValueError):
+        with worker_session('localhost/test') as session:
+            session.add(PointData(value=1))
+            raise ValueError('Failed')
+
+    assert len(session.new) == 0
+    assert not get_scoped_session('localhost/test').registry.has()
+
+
+def test_after_fork_detaches_connections(registry, monkeypatch):
+    """
+    Test connections checked out at a fork are detached from their session
+    and kept referenced instead of being reset from the child
+    """
+    # A database that can be connected to without a server
+    monkeypatch.setattr(db, 'create_engine',
+                        lambda *args, **kwargs: create_engine('sqlite://'))
+    engine = get_engine('localhost/test')
+    Session = get_scoped_session('localhost/test')
+    session = Session()
+
+    conn = engine.connect()
+    dbapi_conn = conn.connection.dbapi_connection
+    pool = engine.pool
+
+    db._after_fork()
+
+    try:
+        assert conn.connection.dbapi_connection is None
+        assert any(c is dbapi_conn for c in db._inherited)
+        assert any(p is pool for p in db._inherited)
+        assert engine.pool is not pool
+        assert any(s is session for s in db._inherited)
+        assert not Session.registry.has()
+
+        # Closing the detached connection leaves the DBAPI connection alone
+        conn.close()
+        dbapi_conn.execute('SELECT 1')
+
+    finally:
+        db._inherited.clear()
+
+
+@pytest.mark.parametrize('obj, name', [
+    (db.pool_base, '_strong_ref_connection_records'),
+    (db.pool_base._ConnectionFairy, 'dbapi_connection')])
+def test_check_pool_internals(monkeypatch, obj, name):
+    """
+    Test a sqlalchemy without the pool internals used at a fork fails loudly
+    """
+    db._check_pool_internals()
+
+    monkeypatch.delattr(obj, name)
+    with pytest.raises(ImportError, match=name):
+        db._check_pool_internals()
+
+
+def _backend_pid(db_str, credentials):
+    with get_engine(db_str, credentials=credentials).connect() as conn:
+        return conn.execute(text('SELECT pg_backend_pid()')).scalar()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='Requires fork')
+class TestForkOnDB(DBSetup):
+    """
+    Test forked workers get their own connections and leave the parent's
+    alone
+    """
+
+    def test_engines_after_fork(self):
+        creds = join(dirname(__file__), 'credentials.json')
+        context = multiprocessing.get_context('fork')
+
+        with self.engine.connect() as conn:
+            trans = conn.begin()
+            conn.execute(text('CREATE TEMP TABLE fork_test (a integer)'))
+            conn.execute(text('INSERT INTO fork_test VALUES (1)'))
+            parent = conn.execute(text('SELECT pg_backend_pid()')).scalar()
+
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                child = pool.submit(_backend_pid, self.db, creds).result()
+
+            # A new connection in the child, the parent's transaction is
+            # still open on its own
+            assert child != parent
+            assert conn.execute(text('SELECT count(*) FROM fork_test')).scalar() == 1
+            trans.rollback()
@@ -3,12 +3,28 @@ from os.path import join
 from geoalchemy2.elements import WKBElement
 from geoalchemy2.shape import to_shape
 from shapely.geometry import Point
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
 
+from snowexsql.data import ImageData
 from snowexsql.functions import *
+from snowexsql.load import load_raster
 from .sql_test_base import DBSetup
-import pytest 
+import pytest
+
+
+def test_pixel_as_points_fields():
+    """
+    Test the fields of the rows of ST_PixelAsPoints can be selected
+    """
+    pixels = ST_PixelAsPoints(ImageData.raster, 1)
+    sql = str(select(pixels.x, pixels.y, pixels.val).compile(
+        dialect=postgresql.dialect()))
+
+    assert '(ST_PixelAsPoints(public.images.raster, %(ST_PixelAsPoints_1)s)).val' in sql
+    assert isinstance(pixels.geom.type, Geometry)
+
 
-@pytest.mark.skip('Need to figure out how to upload a raster for testing')
 class TestFunctions(DBSetup):
 
     def setup_class(self):
@@ -18,8 +34,7 @@ class TestFunctions(DBSetup):
         super().setup_class()
 
         self.raster_f = join(self.data_dir, 'be_gm1_0328', 'w001001x.adf')
-        u = UploadRaster(filename=self.raster_f, epsg=26912, use_s3=False)
-        u.submit(self.session)
+        load_raster(self.engine, self.raster_f, epsg=26912, max_workers=1)
 
     def test_pixel_as_point(self):
         """
@@ -27,7 +42,8 @@ class TestFunctions(DBSetup):
         """
 
         # Get the first pixel as a point
-        records = self.session.query(ST_PixelAsPoint(ImageData.raster, 1, 1)).limit(1).scalar()
+        records = self.session.query(ST_PixelAsPoint(ImageData.raster, 1, 1)).order_by(
+            ImageData.id).limit(1).scalar()
 
         # Get the Geometry from the Well known binary format
         q = self.session.scalar(records.ST_GeomFromEWKB())
@@ -38,20 +54,20 @@ class TestFunctions(DBSetup):
         # Convert geom to shapely object and compare
         assert to_shape(q) == Point(743000, 4324500)
 
-    # def test_pixel_as_points(self):
-    #     '''
-    #     Test coordinate retrieval of a single pixel
-    #     '''
-    #
-    #     # Get the first pixel as a point
-    #     records = self.session.query(ST_PixelAsPoints(ImageData.raster)).limit(5).all()
-    #
-    #     # Check that its the correct type
-    #     for r in records:
-    #         # Get the Geometry from the Well known binary format
-    #         q = self.session.scalar(r[0].ST_GeomFromEWKB())
-    #
-    #         assert isinstance(q, WKBElement)
+    def test_pixel_as_points(self):
+        '''
+        Test retrieving the pixels of a tile as points
+        '''
+        pixels = ST_PixelAsPoints(ImageData.raster, 1)
+        tile = self.session.query(ImageData.id).order_by(ImageData.id).limit(1).scalar()
 
-        # Convert geom to shapely object and compare
-        # assert to_shape(q) == Point(743000, 4324500)
+        records = self.session.query(pixels.x, pixels.y, pixels.val, pixels.geom).filter(
+            ImageData.id == tile).limit(5).all()
+
+        assert len(records) == 5
+        for x, y, val, geom in records:
+            assert isinstance(geom, WKBElement)
+
+        # Points are the upper left corner of each pixel
+        x, y, val, geom = records[0]
+        assert to_shape(geom) == Point(743000 + (x - 1) * 0.5, 4324500 - (y - 1) * 0.5)
@@ -0,0 +1,88 @@
+import pandas as pd
+import pytest
+
+from snowexsql.data import Base
+from snowexsql.indexes import *
+
+from .sql_test_base import DBSetup
+
+
+def test_indexes_match_models():
+    """
+    Test every managed index is on a real table and column
+    """
+    tables = {t.name: t for t in Base.metadata.sorted_tables}
+
+    for index in INDEXES:
+        assert index.table in tables
+        for c in index.columns:
+            # Expressions name their column in parentheses
+            c = c.split('(')[-1].rstrip(')')
+            assert c in tables[index.table].columns
+
+
+def test_index_names_unique():
+    names = [i.name for i in INDEXES]
+    assert len(names) == len(set(names))
+
+
+@pytest.mark.parametrize("concurrently, expected", [
+    (False, 'CREATE INDEX IF NOT EXISTS ix_points_type_date ON public.points USING btree (type, date)'),
+    (True, 'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_points_type_date ON public.points USING btree (type, date)'),
+])
+def test_index_sql(concurrently, expected):
+    index = IndexSpec('ix_points_type_date', 'points', ['type', 'date'], 'btree')
+    assert index_sql(index, concurrently=concurrently) == expected
+
+
+def make_stats():
+    return pd.DataFrame(
+        [['points', 1000000, 50, 900000000, 10],
+         ['layers', 500000, 10, 4000, 0],
+         ['sites', 100, 500, 50000, 0],
+         ['images', 20000, 5, 100000, 50]],
+        columns=['table', 'rows', 'seq_scan', 'seq_tup_read', 'idx_scan'])
+
+
+def test_advise():
+    """
+    Test large tables with sequential scans reading many rows are flagged
+    """
+    df = advise(make_stats(), {'idx_points_geom'})
+
+    # Layers scans read few rows, sites is small and images mostly uses indexes
+    assert df['table'].tolist() == ['points']
+    assert df['rows_per_scan'].iloc[0] == 18000000
+    assert 'idx_points_geom' not in df['missing_indexes'].iloc[0]
+    assert 'ix_points_type_date' in df['missing_indexes'].iloc[0]
+
+
+def test_advise_indexed():
+    """
+    Test a table with all its indexes is still flagged with different advice
+    """
+    df = advise(make_stats(), {i.name for i in INDEXES})
+    assert df['missing_indexes'].iloc[0] == []
+    assert 'EXPLAIN' in df['advice'].iloc[0]
+
+
+class TestIndexesOnDB(DBSetup):
+    """
+    Test the managed indexes are made on the database
+    """
+
+    def test_initialize_creates_indexes(self):
+        assert {i.name for i in INDEXES}.issubset(existing_indexes(self.engine))
+
+    def test_ensure_indexes_missing(self):
+        with self.engine.begin() as conn:
+            conn.execute('DROP INDEX ix_points_site_id')
+
+        created = ensure_indexes(self.engine, concurrently=True)
+        assert created == ['ix_points_site_id']
+        assert ensure_indexes(self.engine) == []
+
+    def test_index_advisor(self):
+        df = index_advisor(self.engine, min_rows=0)
+        assert list(df.columns) == ['table', 'rows', 'seq_scan', 'idx_scan',
+                                    'rows_per_scan', 'missing_indexes', 'advice']
@@ -0,0 +1,183 @@
+import json
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from snowexsql.conversions import query_to_pandas, query_to_pandas_chunks
+from snowexsql.data import PointData
+from snowexsql.instrumentation import *
+from snowexsql.instrumentation import _can_explain
+
+from .sql_test_base import DBSetup
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ('SELECT a FROM t WHERE b = %(b_1)s', 'SELECT a FROM t WHERE b = ?'),
+    ('SELECT a FROM t WHERE b IN (%(b_1_1)s, %(b_1_2)s, %(b_1_3)s)',
+     'SELECT a FROM t WHERE b IN (?, ...)'),
+    ('SELECT a\n  FROM t WHERE b = $1', 'SELECT a FROM t WHERE b = ?'),
+])
+def test_statement_shape(sql, expected):
+    assert statement_shape(sql) == expected
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ('SELECT 1', True),
+    ('  with x as (select 1) select * from x', True),
+    ('WITH x AS (DELETE FROM t RETURNING *) SELECT * FROM x', False),
+    ('UPDATE t SET a = 1', False),
+    ('SELECT pg_advisory_lock(%(key)s)', False),
+    ("SELECT nextval('points_id_seq')", False),
+    ('SELECT * FROM points WHERE id = 1 FOR UPDATE', False),
+    ('SELECT * FROM points FOR NO KEY UPDATE SKIP LOCKED', False),
+])
+def test_can_explain(sql, expected):
+    assert _can_explain(sql) == expected
+
+
+@pytest.fixture()
+def engine():
+    engine = create_engine('sqlite://')
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE t (a INTEGER, b TEXT)'))
+        conn.execute(text('INSERT INTO t VALUES (:a, :b)'),
+                     [dict(a=i, b='x' * 10) for i in range(20)])
+    return engine
+
+
+def test_instrumentation_statements(engine):
+    """
+    Test rows, bytes and timing are recorded for each statement
+    """
+    with Instrumentation(engine) as stats:
+        with engine.connect() as conn:
+            conn.execute(text('SELECT a, b FROM t WHERE a < :a'), dict(a=5)).fetchall()
+            conn.execute(text('UPDATE t SET b = :b WHERE a < :a'), dict(a=3, b='y'))
+
+    select, update = stats.records()
+
+    assert select['shape'] == 'SELECT a, b FROM t WHERE a < ?'
+    assert select['rows'] == 5
+    assert select['bytes'] == 5 * (10 + 8)
+    assert select['execute_seconds'] > 0
+    assert update['rows'] == 3
+
+
+def test_instrumentation_detached(engine):
+    stats = Instrumentation(engine)
+    stats.detach()
+
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1')).fetchall()
+
+    assert stats.records() == []
+
+
+def test_instrumentation_decode(engine):
+    """
+    Test conversion functions are reported with their decode time
+    """
+    with Instrumentation(engine) as stats:
+        timed(pd.read_sql)(text('SELECT * FROM t'), engine)
+
+    report = stats.report()
+
+    assert report['kind'].tolist() == ['statement', 'call']
+    assert report['shape'].iloc[1] == 'read_sql'
+    assert report['rows'].iloc[0] == 20
+    assert report['decode_seconds'].iloc[1] > 0
+
+
+class NamedCursor(object):
+    """
+    Acts like a psycopg2 named cursor, the description is only set once
+    the first rows are fetched
+    """
+
+    name = 'c1'
+    rowcount = -1
+    description = None
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        self.description = [('a',)]
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+
+def test_instrumentation_streamed():
+    """
+    Test rows from a named cursor are counted as they are fetched
+    """
+    stats = Instrumentation()
+    context = type('Context', (), {})()
+
+    stats._before(None, None, 'SELECT a FROM t', {}, context, False)
+    stats._after(None, NamedCursor([(i,) for i in range(5)]),
+                 'SELECT a FROM t', {}, context, False)
+
+    assert stats.records() == []
+
+    while context.cursor.fetchmany(2):
+        pass
+    context.cursor.close()
+
+    statement, = stats.records()
+    assert statement['rows'] == 5
+
+
+def test_report_empty():
+    assert Instrumentation().report().empty
+
+
+class TestInstrumentationOnDB(DBSetup):
+    """
+    Test plans are captured for slow statements
+    """
+
+    def test_explain(self):
+        self.session.add(PointData(type='depth', value=1))
+        self.session.commit()
+
+        with Instrumentation(self.engine, explain_threshold=0) as stats:
+            query_to_pandas(self.session.query(PointData.value), self.engine)
+
+        statement = stats.records(kind='statement')[0]
+        plan = json.loads(statement['plan'])
+
+        assert 'Plan' in plan[0]
+        assert stats.records(kind='call')[0]['shape'] == 'query_to_pandas'
+
+    def test_explain_skips_advisory_lock(self):
+        """
+        Test taking an advisory lock isn't explained, running it again on
+        another connection would wait on this one forever
+        """
+        with Instrumentation(self.engine, explain_threshold=0) as stats:
+            with self.engine.connect() as conn:
+                conn.execute(text('SELECT pg_advisory_lock(1)'))
+                conn.execute(text('SELECT pg_advisory_unlock(1)'))
+
+        assert all(r['plan'] is None for r in stats.records(kind='statement'))
+
+    def test_streamed_rows(self):
+        """
+        Test rows streamed from a server side cursor are counted
+        """
+        self.session.add_all([PointData(type='depth', value=i)
+                              for i in range(3)])
+        self.session.commit()
+
+        with Instrumentation(self.engine) as stats:
+            df = pd.concat(query_to_pandas_chunks(
+                self.session.query(PointData.value), self.engine,
+                chunksize=2))
+
+        statement = stats.records(kind='statement')[0]
+        assert statement['rows'] == len(df) == 3
@@ -0,0 +1,307 @@
+from io import StringIO
+from os.path import dirname, join
+
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio
+import shapely
+from shapely.geometry import Point
+from sqlalchemy import func, text
+
+from snowexsql.data import ImageData, LayerData, PointData, SiteData
+from snowexsql.load import *
+from snowexsql.raster import mosaic_tiles, raster_from_wkb
+
+from .sql_test_base import DBSetup
+
+DATA_DIR = join(dirname(__file__), 'data')
+RASTER = join(DATA_DIR, 'be_gm1_0287', 'w001001x.adf')
+
+
+@pytest.mark.parametrize("name, expected", [
+    ('Depth (cm)', ('depth', 'cm')),
+    ('# Easting [m]', ('easting', 'm')),
+    ('Time (hh:mm, local, MST)', ('time', 'hh:mm, local, MST')),
+    ('﻿Camera', ('camera', None)),
+    ('LWC-vol A (%)', ('lwc_vol_a', '%')),
+])
+def test_standardize_name(name, expected):
+    assert standardize_name(name) == expected
+
+
+def test_points_to_ewkb():
+    """
+    Test the bulk encoding matches shapely
+    """
+    x = np.array([743000.5, 743001.25])
+    y = np.array([4324500.0, 4324501.75])
+    wkb = points_to_ewkb(x, y, 26912)
+
+    for i, w in enumerate(wkb):
+        geom = shapely.from_wkb(w)
+        assert geom.equals(Point(x[i], y[i]))
+        assert shapely.get_srid(geom) == 26912
+
+
+def read_points(f, **kwargs):
+    return pd.concat(read_point_csv(join(DATA_DIR, f), **kwargs), ignore_index=True)
+
+
+@pytest.mark.parametrize("f, count, instrument, date, time", [
+    ('depths.csv', 10, 'magnaprobe', '2020-01-28', '11:48:00-07:00'),
+    ('pole_depths.csv', 14, 'camera', '2020-01-27', '11:00:00-07:00'),
+    ('gpr.csv', 40, 'gpr', '2019-01-28', '16:15:49.562000+00:00'),
+])
+def test_read_point_csv(f, count, instrument, date, time):
+    df = read_points(f, site_name='Grand Mesa')
+
+    assert len(df) == count
+    assert df['instrument'].iloc[0] == instrument
+    assert df['date'].iloc[0] == date
+    assert df['time'].iloc[0] == time
+    assert (df['site_name'] == 'Grand Mesa').all()
+    assert df['geom'].notna().all()
+
+
+def test_read_point_csv_gpr_types():
+    """
+    Test each gpr measurement becomes its own type
+    """
+    df = read_points('gpr.csv')
+    counts = df.groupby('type')['value'].count().to_dict()
+
+    assert counts == {'density': 10, 'depth': 10, 'swe': 10, 'two_way_travel': 10}
+    assert df.loc[df['type'] == 'swe', 'units'].iloc[0] == 'mm'
+    assert df['utm_zone'].iloc[0] == '12'
+
+
+def test_read_point_csv_batches():
+    """
+    Test large files are read in bounded batches
+    """
+    batches = list(read_point_csv(join(DATA_DIR, 'gpr.csv'), chunksize=3))
+    assert [len(b) for b in batches] == [12, 12, 12, 4]
+
+
+def test_read_point_csv_camera_equipment():
+    df = read_points('pole_depths.csv')
+    assert df['equipment'].iloc[0] == 'camera id = W1B'
+
+
+def test_read_profile_csv_samples():
+    """
+    Test multi sample profiles are averaged with the samples kept
+    """
+    df = read_profile_csv(join(DATA_DIR, 'density.csv'))
+
+    assert len(df) == 4
+    assert df['type'].unique().tolist() == ['density']
+    assert df['value'].iloc[0] == '217.5'
+    assert df['sample_a'].iloc[0] == '190.0'
+    assert df['sample_c'].iloc[0] is None
+    assert df['depth'].iloc[0] == 35
+    assert df['bottom_depth'].iloc[0] == 25
+    assert df['site_id'].iloc[0] == '1N20'
+    assert df['date'].iloc[0] == '2020-02-05'
+    assert df['time'].iloc[0] == '13:30:00-07:00'
+
+
+@pytest.mark.parametrize("f, types", [
+    ('LWC.csv', ['dielectric_constant']),
+    ('LWC2.csv', ['density', 'permittivity', 'lwc_vol']),
+    ('SSA.csv', ['sample_signal', 'reflectance', 'specific_surface_area', 'deq']),
+    ('temperature.csv', ['temperature']),
+    ('stratigraphy.csv', ['grain_size', 'grain_type', 'hand_hardness', 'manual_wetness']),
+])
+def test_read_profile_csv_types(f, types):
+    df = read_profile_csv(join(DATA_DIR, f))
+    assert df['type'].unique().tolist() == types
+
+
+def test_read_profile_csv_comments():
+    df = read_profile_csv(join(DATA_DIR, 'stratigraphy.csv'))
+    hardness = df[df['type'] == 'hand_hardness']
+
+    assert hardness['value'].tolist() == ['F', '4F', '4F', '4F', '1F']
+    assert hardness['comments'].iloc[3] == 'Cups'
+
+
+def test_read_profile_csv_instrument():
+    df = read_profile_csv(join(DATA_DIR, 'SSA.csv'))
+    assert df['instrument'].iloc[0] == 'IS3-SP-11-01F'
+    assert df['units'].iloc[0] == 'mV'
+
+
+def test_read_site_csv():
+    df = read_site_csv(join(DATA_DIR, 'site_5S21.csv'))
+    row = df.iloc[0]
+
+    assert len(df) == 1
+    assert row['site_id'] == '5S21'
+    assert row['aspect'] == 0
+    assert row['air_temp'] == 1.5
+    assert row['total_depth'] == 110
+    assert row['ground_roughness'] == 'Smooth'
+    assert row['site_notes'] == 'surface temp = 14:44, bottom temp = 14:56'
+    assert row['date'] == '2020-02-01'
+
+
+def test_read_site_csv_multiline():
+    """
+    Test quoted header values spanning lines are kept together
+    """
+    row = read_site_csv(join(DATA_DIR, 'site_details.csv')).iloc[0]
+
+    assert row['slope_angle'] == 5
+    assert row['aspect'] == 180
+    assert row['air_temp'] is None
+    assert row['site_notes'].startswith('Start temperature measurements')
+    assert row['site_notes'].endswith('possible')
+
+
+class FakeCursor:
+    def copy_expert(self, sql, buf):
+        self.sql = sql
+        self.data = buf.read()
+
+
+def test_copy_rows():
+    """
+    Test only table columns are sent and ids are left to the database
+    """
+    cursor = FakeCursor()
+    df = read_points('depths.csv')
+    count = copy_rows(cursor, PointData.__table__, df)
+
+    assert count == 10
+    assert cursor.sql.startswith('COPY public.points (')
+    assert ' id,' not in cursor.sql and 'time_created' not in cursor.sql
+    assert 'measurement_tool' not in cursor.sql
+
+    copied = pd.read_csv(StringIO(cursor.data), header=None)
+    assert copied.shape == (10, cursor.sql.count(',') + 1)
+
+
+def test_raster_windows():
+    """
+    Test edge tiles are cut short
+    """
+    windows = raster_windows(10, 7, tile_size=(4, 4))
+
+    assert len(windows) == 6
+    assert (windows[2].width, windows[2].height) == (2, 4)
+    assert (windows[5].col_off, windows[5].row_off) == (8, 4)
+    assert (windows[5].width, windows[5].height) == (2, 3)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_read_raster_tiles(max_workers):
+    """
+    Test the tiles reassemble into the original raster
+    """
+    batches = list(read_raster_tiles(RASTER, epsg=26912, tile_size=(300, 300),
+                                     max_workers=max_workers, batch_size=3,
+                                     type='DEM', surveyors='USGS'))
+    df = pd.concat(batches, ignore_index=True)
+
+    assert len(batches) == 6
+    assert len(df) == 16
+    assert (df['type'] == 'DEM').all()
+
+    raster = mosaic_tiles([raster_from_wkb(r) for r in df['raster']])
+
+    with rasterio.open(RASTER) as src:
+        assert raster.transform == src.transform
+        np.testing.assert_array_equal(raster.read(1), src.read(1))
+
+    assert raster.srid == 26912
+
+
+def test_read_raster_tiles_skip_empty(tmp_path):
+    """
+    Test tiles of only nodata are skipped
+    """
+    f = str(tmp_path / 'empty.tif')
+    data = np.full((1, 8, 8), -9999, dtype=np.float32)
+    data[0, :4, :4] = 1
+
+    with rasterio.open(f, 'w', driver='GTiff', width=8, height=8, count=1,
+                       dtype='float32', crs='EPSG:26912', nodata=-9999,
+                       transform=rasterio.Affine(1, 0, 0, 0, -1, 8)) as dst:
+        dst.write(data)
+
+    tiles = pd.concat(read_raster_tiles(f, tile_size=(4, 4), max_workers=1))
+    assert len(tiles) == 1
+
+    tiles = pd.concat(read_raster_tiles(f, tile_size=(4, 4), max_workers=1,
+                                        skip_empty=False))
+    assert len(tiles) == 4
+
+
+def test_read_raster_tiles_no_epsg():
+    with pytest.raises(ValueError):
+        next(read_raster_tiles(RASTER))
+
+
+def test_add_raster_constraints_unknown():
+    with pytest.raises(ValueError):
+        add_raster_constraints(None, constraints=['srid', 'colour'])
+
+
+class TestLoadOnDB(DBSetup):
+    """
+    Test bulk loading the test data
+    """
+
+    def test_load_points(self):
+        stats = load_points(self.engine, join(DATA_DIR, 'gpr.csv'), batch_size=4,
+                            site_name='Grand Mesa', surveyors='Tate Meehan')
+        assert stats['rows'] == 40
+
+        records = self.session.query(PointData).filter(
+            PointData.instrument == 'gpr').all()
+        assert len(records) == 40
+        assert records[0].geom is not None
+
+    def test_load_profile(self):
+        stats = load_profile(self.engine, join(DATA_DIR, 'density.csv'))
+        assert stats['rows'] == 4
+
+        values = self.session.query(LayerData.value).filter(
+            LayerData.type == 'density').all()
+        assert len(values) == 4
+
+    def test_load_site(self):
+        load_site(self.engine, join(DATA_DIR, 'site_details.csv'))
+        site = self.session.query(SiteData).filter(SiteData.site_id == '1N20').one()
+        assert site.aspect == 180
+
+    def test_load_raster(self):
+        stats = load_raster(self.engine, RASTER, epsg=26912, max_workers=2,
+                            type='DEM', surveyors='USGS', units='meters')
+        assert stats['rows'] == 16
+
+        srids = self.session.query(func.ST_SRID(ImageData.raster)).distinct().all()
+        assert srids == [(26912,)]
+
+    def test_load_raster_other_srid(self):
+        """
+        Test loading leaves the images table open to rasters of any srid
+        until constraints are added explicitly
+        """
+        load_raster(self.engine, RASTER, epsg=26912, max_workers=1, type='DEM')
+        load_raster(self.engine, RASTER, epsg=26911, max_workers=1, type='DEM')
+
+        srids = self.session.query(func.ST_SRID(ImageData.raster)).distinct()
+        assert sorted(s for s, in srids) == [26911, 26912]
+
+        self.session.query(ImageData).filter(
+            func.ST_SRID(ImageData.raster) == 26911).delete(
+            synchronize_session=False)
+        self.session.commit()
+
+        add_raster_constraints(self.engine)
+        srid = self.session.execute(text(
+            "SELECT srid FROM raster_columns WHERE r_table_name = 'images'")).scalar()
+        assert srid == 26912
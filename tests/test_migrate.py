@@ -0,0 +1,154 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import BigInteger, Date, Float, Integer, String, Text, select
+from sqlalchemy.dialects import postgresql
+
+from snowexsql.data import Base
+from snowexsql.indexes import INDEXES
+from snowexsql.migrate import *
+
+from .sql_test_base import DBSetup
+
+
+def make_live():
+    """
+    Build a live schema matching the models with every index present
+    """
+    live = {t.name: {c.name: c.type for c in t.columns}
+            for t in Base.metadata.sorted_tables}
+    return live, {i.name for i in INDEXES}
+
+
+@pytest.mark.parametrize("live, model, expected", [
+    (String(50), String(50), 'same'),
+    (postgresql.VARCHAR(50), String(100), 'widen'),
+    (String(100), String(50), 'conflict'),
+    (String(100), Text(), 'widen'),
+    (Integer(), BigInteger(), 'widen'),
+    (postgresql.BIGINT(), Integer(), 'conflict'),
+    (postgresql.REAL(), Float(), 'widen'),
+    (postgresql.DOUBLE_PRECISION(), Float(), 'same'),
+    (postgresql.DATE(), Date(), 'same'),
+    (postgresql.DATE(), String(50), 'conflict'),
+])
+def test_compare_types(live, model, expected):
+    assert compare_types(live, model) == expected
+
+
+def test_diff_schema_nothing():
+    """
+    Test an up to date database needs no steps
+    """
+    live, indexes = make_live()
+    steps, conflicts = diff_schema(live, indexes=indexes)
+
+    assert steps == []
+    assert conflicts == []
+
+
+def test_diff_schema_add_column():
+    live, indexes = make_live()
+    del live['points']['equipment']
+    steps, conflicts = diff_schema(live, indexes=indexes)
+
+    assert steps == [MigrationStep(
+        'add_column:points.equipment',
+        'ALTER TABLE public.points ADD COLUMN IF NOT EXISTS equipment VARCHAR(50)',
+        True)]
+
+
+def test_diff_schema_widen():
+    live, indexes = make_live()
+    live['layers']['value'] = String(20)
+    steps, conflicts = diff_schema(live, indexes=indexes)
+
+    assert steps[0].key == 'widen_column:layers.value'
+    assert steps[0].sql == 'ALTER TABLE public.layers ALTER COLUMN value TYPE VARCHAR(50)'
+
+
+def test_diff_schema_conflict():
+    """
+    Test narrowing is reported and not migrated
+    """
+    live, indexes = make_live()
+    live['layers']['value'] = Text()
+    steps, conflicts = diff_schema(live, indexes=indexes)
+
+    assert steps == []
+    assert conflicts == ['layers.value is TEXT in the database but VARCHAR(50) in the model']
+
+
+def test_diff_schema_new_table_and_index():
+    """
+    Test missing tables are created and indexes are built concurrently last
+    """
+    live, indexes = make_live()
+    del live['sites']
+    indexes.remove('ix_sites_site_id')
+    steps, conflicts = diff_schema(live, indexes=indexes)
+
+    assert [s.key for s in steps] == ['create_table:sites', 'create_index:ix_sites_site_id']
+    assert steps[0].sql.startswith('CREATE TABLE public.sites')
+    assert 'CONCURRENTLY' in steps[1].sql
+    assert not steps[1].transactional
+
+
+def test_diff_schema_partitioned_index():
+    """
+    Test indexes on partitioned tables are built inside a transaction
+    """
+    live, indexes = make_live()
+    indexes.remove('ix_points_site_id')
+    steps, conflicts = diff_schema(live, indexes=indexes, partitioned={'points'})
+
+    assert steps[0].sql.startswith('CREATE INDEX IF NOT EXISTS')
+    assert steps[0].transactional
+
+
+class TestMigrateOnDB(DBSetup):
+    """
+    Test migrating a database that is behind the models
+    """
+
+    def test_migrate(self):
+        with self.engine.begin() as conn:
+            conn.execute('ALTER TABLE points DROP COLUMN equipment')
+            conn.execute('ALTER TABLE layers ALTER COLUMN value TYPE VARCHAR(20)')
+            conn.execute('DROP INDEX ix_layers_site_id_type')
+
+        version = schema_version(self.engine)
+        steps = migrate(self.engine)
+
+        assert [s.key for s in steps] == [
+            'add_column:points.equipment', 'widen_column:layers.value',
+            'create_index:ix_layers_site_id_type']
+        assert schema_version(self.engine) == version + 3
+        assert migrate(self.engine) == []
+
+    def test_migrate_concurrent(self):
+        """
+        Test a migration waiting on another plans after it, applying nothing
+        twice
+        """
+        with self.engine.begin() as conn:
+            conn.execute('ALTER TABLE points DROP COLUMN equipment')
+
+        version = schema_version(self.engine)
+        with ThreadPoolExecutor(2) as pool:
+            results = list(pool.map(lambda _: migrate(self.engine), range(2)))
+
+        assert sorted(len(steps) for steps in results) == [0, 1]
+
+        with self.engine.connect() as conn:
+            keys = [r[0] for r in conn.execute(select(MigrationsTable.c.key).where(
+                MigrationsTable.c.version > version))]
+        assert keys == ['add_column:points.equipment']
+
+    def test_migrate_dry_run(self):
+        with self.engine.begin() as conn:
+            conn.execute('ALTER TABLE sites DROP COLUMN site_notes')
+
+        steps = migrate(self.engine, dry_run=True)
+        assert [s.key for s in steps] == ['add_column:sites.site_notes']
+        assert migrate(self.engine, dry_run=True) == steps
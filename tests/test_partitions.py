@@ -0,0 +1,126 @@
+import pytest
+from sqlalchemy import func
+
+from snowexsql.data import PointData
+from snowexsql.db import initialize
+from snowexsql.indexes import existing_indexes
+from snowexsql.partitions import *
+
+from .sql_test_base import DBSetup
+
+
+def test_partitioned_table_primary_key():
+    """
+    Test the partition keys join the primary key without touching the model
+    """
+    table = partitioned_table(PartitionScheme(by=('type', 'date')))
+
+    assert table.primary_key.columns.keys() == ['id', 'type', 'date']
+    assert table.dialect_options['postgresql']['partition_by'] == 'LIST (type)'
+    assert PointData.__table__.primary_key.columns.keys() == ['id']
+
+
+@pytest.mark.parametrize("by", [(), ('value',), ('type', 'type')])
+def test_partitioned_table_bad_keys(by):
+    with pytest.raises(ValueError):
+        partitioned_table(PartitionScheme(by=by))
+
+
+def test_partition_ddl_type():
+    statements = partition_ddl(PartitionScheme(types=['depth', "it's"]))
+
+    assert 'id SERIAL NOT NULL' in statements[0]
+    assert statements[0].endswith('PARTITION BY LIST (type)')
+    assert statements[1:] == [
+        "CREATE TABLE public.points_depth PARTITION OF public.points FOR VALUES IN ('depth')",
+        "CREATE TABLE public.points_it_s PARTITION OF public.points FOR VALUES IN ('it''s')",
+        "CREATE TABLE public.points_default PARTITION OF public.points DEFAULT"]
+
+
+def test_partition_ddl_date():
+    statements = partition_ddl(PartitionScheme(by=('date',), water_years=[2020]))
+
+    assert statements[0].endswith('PARTITION BY RANGE (date)')
+    assert statements[1] == ("CREATE TABLE public.points_wy2020 PARTITION OF "
+                             "public.points FOR VALUES FROM ('2019-10-01') TO "
+                             "('2020-10-01')")
+
+
+def test_partition_ddl_type_and_date():
+    """
+    Test each type is sub partitioned by water year
+    """
+    scheme = PartitionScheme(by=('type', 'date'), types=['depth'],
+                             water_years=[2020, 2021])
+    names = [s.split()[2] for s in partition_ddl(scheme)]
+
+    assert names == ['public.points', 'public.points_depth',
+                     'public.points_depth_wy2020', 'public.points_depth_wy2021',
+                     'public.points_depth_default', 'public.points_default',
+                     'public.points_default_wy2020', 'public.points_default_wy2021',
+                     'public.points_default_default']
+
+
+def test_partition_ddl_name():
+    """
+    Test a table built under another name keeps the partition names
+    """
+    scheme = PartitionScheme(by=('type', 'date'), types=['depth'],
+                             water_years=[2020])
+    statements = partition_ddl(scheme, name='points_partitioned')
+
+    assert statements[0].startswith('CREATE TABLE public.points_partitioned (')
+    assert statements[1] == ("CREATE TABLE public.points_depth PARTITION OF "
+                             "public.points_partitioned FOR VALUES IN ('depth') "
+                             "PARTITION BY RANGE (date)")
+    assert statements[2] == ("CREATE TABLE public.points_depth_wy2020 PARTITION "
+                             "OF public.points_depth FOR VALUES FROM "
+                             "('2019-10-01') TO ('2020-10-01')")
+
+
+class TestPartitionsOnDB(DBSetup):
+    """
+    Test creating and migrating to a partitioned points table
+    """
+    scheme = PartitionScheme(by=('type', 'date'), types=['depth'],
+                             water_years=[2020])
+
+    def add_points(self):
+        for t, d in [('depth', '2020-02-01'), ('depth', '2021-02-01'),
+                     ('swe', '2020-02-01')]:
+            self.session.add(PointData(type=t, date=d, value=1))
+        self.session.commit()
+
+    def count(self, table):
+        with self.engine.connect() as conn:
+            return conn.execute('SELECT count(*) FROM {}'.format(table)).scalar()
+
+    def test_initialize_partitioned(self):
+        initialize(self.engine, partitions=self.scheme)
+        self.add_points()
+
+        assert is_partitioned(self.engine)
+        assert self.count('points_depth_wy2020') == 1
+        assert self.count('points_depth_default') == 1
+        assert self.count('points_default_wy2020') == 1
+        assert 'ix_points_type_date' in existing_indexes(self.engine)
+
+    def test_partition_points(self):
+        initialize(self.engine)
+        self.add_points()
+
+        assert partition_points(self.engine, self.scheme)
+        assert not partition_points(self.engine, self.scheme)
+        assert self.count('points') == 3
+        assert self.count('points_depth_wy2020') == 1
+        assert partitioned_tables(self.engine) == {'points', 'points_depth',
+                                                 'points_default'}
+
+        indexes = existing_indexes(self.engine)
+        assert 'ix_points_type_date' in indexes
+        assert 'ix_points_type_date_points_partitioned' not in indexes
+
+        # New rows keep getting new ids
+        self.add_points()
+        ids = self.session.query(func.count(PointData.id.distinct())).scalar()
+        assert ids == 6
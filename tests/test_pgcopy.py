@@ -0,0 +1,193 @@
+import struct
+from datetime import date, time, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+
+from snowexsql.conversions import query_to_geopandas, query_to_pandas
+from snowexsql.data import PointData
+from snowexsql.pgcopy import *
+
+from .sql_test_base import DBSetup, make_point_records
+
+
+def make_stream(rows, formats):
+    """
+    Build a binary COPY stream, formats are struct codes or 'b' for bytes
+    """
+    out = [SIGNATURE, struct.pack('>ii', 0, 0)]
+
+    for row in rows:
+        out.append(struct.pack('>h', len(row)))
+
+        for v, f in zip(row, formats):
+            if v is None:
+                out.append(struct.pack('>i', -1))
+            else:
+                b = v if f == 'b' else struct.pack('>' + f, v)
+                out.append(struct.pack('>i', len(b)) + b)
+
+    out.append(struct.pack('>h', -1))
+    return b''.join(out)
+
+
+def test_parse_fixed_width():
+    """
+    Test parsing rows with only fixed width columns and no nulls
+    """
+    buf = make_stream([(1, 2.5, 7336), (2, 3.5, 7337)], ['i', 'd', 'i'])
+    ids, values, dates = parse_copy_binary(buf, [23, 701, 1082])
+
+    np.testing.assert_array_equal(ids, [1, 2])
+    np.testing.assert_array_equal(values, [2.5, 3.5])
+    assert dates[0] == np.datetime64('2020-02-01')
+
+
+def test_parse_nulls():
+    """
+    Test nulls in numeric columns become nan
+    """
+    buf = make_stream([(1, None), (None, 3.5)], ['i', 'd'])
+    ids, values = parse_copy_binary(buf, [23, 701])
+
+    assert np.isnan(ids[1])
+    assert np.isnan(values[0])
+    assert values[1] == 3.5
+
+
+def test_parse_variable_width():
+    """
+    Test text, binary and time with time zone columns
+    """
+    tz = struct.pack('>qi', (3600 + 61) * 1000000 + 1, 25200)
+    buf = make_stream([(1, b'depth', b'\x01\x02', tz),
+                       (2, None, None, None)], ['i', 'b', 'b', 'b'])
+    ids, types, geom, times = parse_copy_binary(
+        buf, [23, 1043, 'binary', 1266])
+
+    assert list(types) == ['depth', None]
+    assert geom[0] == b'\x01\x02'
+    assert times[0] == time(1, 1, 1, 1,
+                            tzinfo=timezone(timedelta(hours=-7)))
+    assert times[1] is None
+
+
+def test_parse_empty():
+    """
+    Test a result with no rows
+    """
+    ids, = parse_copy_binary(make_stream([], ['i']), [23])
+    assert len(ids) == 0
+
+
+def test_parse_bad_signature():
+    """
+    Test we fail on anything not in the binary format
+    """
+    with pytest.raises(ValueError):
+        parse_copy_binary(b'1\t2\n', [23, 23])
+
+
+def test_parse_unsupported_type():
+    """
+    Test an unknown type raises so the caller can fall back
+    """
+    with pytest.raises(CopyNotSupported):
+        parse_copy_binary(make_stream([(b'1',)], ['b']), [1700])
+
+
+def test_compile_query():
+    """
+    Test compiling a query gives driver sql and processed params
+    """
+    from sqlalchemy.orm import Query
+
+    engine = create_engine('postgresql+psycopg2://')
+    q = Query(PointData.value).filter(PointData.date == date(2020, 2, 1))
+    q = q.filter(PointData.type.in_(['depth', 'swe']))
+    sql, params = compile_query(q, engine.dialect)
+
+    assert '%(date_1)s' in sql
+    assert 'POSTCOMPILE' not in sql
+    assert params['date_1'] == date(2020, 2, 1)
+    assert sorted(params.values(), key=str)[1:] == ['depth', 'swe']
+
+
+@pytest.mark.parametrize('kwargs, copied', [
+    ({}, True), (dict(index_col='id'), False), (dict(parse_dates=['date']), False)])
+def test_query_to_pandas_copy_kwargs(monkeypatch, kwargs, copied):
+    """
+    Test reading options the COPY reader can't apply fall back to read_sql
+    """
+    from sqlalchemy.orm import Query
+
+    engine = create_engine('postgresql+psycopg2://')
+    monkeypatch.setattr('snowexsql.conversions._try_copy',
+                        lambda *args, **kw: pd.DataFrame({'copy': [1]}))
+    monkeypatch.setattr(pd, 'read_sql',
+                        lambda *args, **kw: pd.DataFrame({'read_sql': [1]}))
+
+    df = query_to_pandas(Query(PointData.id), engine, copy=True, **kwargs)
+    assert list(df.columns) == (['copy'] if copied else ['read_sql'])
+
+
+@pytest.mark.parametrize('kwargs, copied', [
+    (dict(crs=26912), True), (dict(index_col='id'), False)])
+def test_query_to_geopandas_copy_kwargs(monkeypatch, kwargs, copied):
+    import geopandas as gpd
+    from sqlalchemy.orm import Query
+
+    engine = create_engine('postgresql+psycopg2://')
+    monkeypatch.setattr('snowexsql.conversions._try_copy',
+                        lambda *args, **kw: pd.DataFrame({'copy': [1]}))
+    monkeypatch.setattr(gpd.GeoDataFrame, 'from_postgis',
+                        lambda *args, **kw: pd.DataFrame({'read_sql': [1]}))
+
+    df = query_to_geopandas(Query(PointData), engine, copy=True, **kwargs)
+    assert list(df.columns) == (['copy'] if copied else ['read_sql'])
+
+
+class TestCopyOnDB(DBSetup):
+    """
+    Test reading through binary COPY matches the normal read
+    """
+
+    def setup_class(self):
+        """
+        Setup the database one time for testing
+        """
+        super().setup_class()
+        self.session.add_all(make_point_records(10))
+        self.session.commit()
+
+    def test_query_to_pandas_copy(self):
+        qry = self.session.query(PointData.id, PointData.value,
+                                 PointData.date).order_by(PointData.id)
+        expected = query_to_pandas(qry, self.engine)
+        df = query_to_pandas(qry, self.engine, copy=True)
+
+        np.testing.assert_array_equal(df['id'], expected['id'])
+        np.testing.assert_array_equal(df['value'], expected['value'])
+
+    def test_query_to_pandas_copy_timestamptz(self):
+        """
+        Test timestamptz columns match the normal read in dtype and value
+        """
+        qry = self.session.query(PointData.id, PointData.time_created).order_by(
+            PointData.id)
+        expected = query_to_pandas(qry, self.engine)
+        df = query_to_pandas(qry, self.engine, copy=True)
+
+        assert df['time_created'].dtype == expected['time_created'].dtype
+        pd.testing.assert_series_equal(df['time_created'],
+                                       expected['time_created'])
+
+    def test_query_to_geopandas_copy(self):
+        qry = self.session.query(PointData).order_by(PointData.id)
+        df = query_to_geopandas(qry, self.engine, copy=True)
+
+        assert df['value'].count() == 10
+        assert df.crs.to_epsg() == 26912
+        assert df['geom'].iloc[1].x == 743001
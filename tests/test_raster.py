@@ -0,0 +1,515 @@
+from contextlib import contextmanager
+from os.path import dirname, join
+
+import geopandas as gpd
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+from geoalchemy2.elements import RasterElement
+from pyproj import Transformer
+from shapely.geometry import Point
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql
+
+from snowexsql.conversions import raster_to_geopandas, raster_to_rasterio
+from snowexsql.data import ImageData
+from snowexsql.load import load_raster
+from snowexsql.raster import *
+from snowexsql.raster import (_point_coordinates, _sample_statement,
+                              _to_raster_srid)
+
+from .sql_test_base import DBSetup, make_raster_wkb, make_tiles
+
+
+@pytest.mark.parametrize("pixtype, endian", [
+    (10, '<'), (11, '>'), (5, '<'), (4, '>')])
+def test_raster_from_wkb(pixtype, endian):
+    """
+    Test decoding a two band raster of various types
+    """
+    band = np.arange(12).reshape(3, 4)
+    wkb = make_raster_wkb([band, band * 2], pixtype=pixtype, endian=endian,
+                          nodata=0)
+    raster = raster_from_wkb(wkb)
+
+    assert raster.shape == (2, 3, 4)
+    assert raster.srid == 26912
+    assert raster.nodata == [0, 0]
+    np.testing.assert_array_equal(raster.read(2), band * 2)
+    assert raster.transform.c == 743000
+    assert raster.transform.f == 4324500
+    assert raster.bounds == (743000, 4324497, 743004, 4324500)
+
+
+@pytest.mark.parametrize("dtype, nodata", [
+    ('<f4', -9999), ('>f8', None), ('u1', 0), ('>i2', -1)])
+def test_raster_to_wkb(dtype, nodata):
+    """
+    Test encoding round trips through the decoder
+    """
+    band = np.arange(12).reshape(3, 4).astype(dtype)
+    transform = Affine(3, 0, 743000, 0, -3, 4324500)
+    raster = RasterArray([band, band * 2], transform, 26912, [nodata, nodata])
+    decoded = raster_from_wkb(raster_to_wkb(raster))
+
+    assert decoded.shape == (2, 3, 4)
+    assert decoded.transform == transform
+    assert decoded.srid == 26912
+    assert decoded.nodata == [nodata, nodata]
+    assert decoded.dtype == np.dtype(dtype).newbyteorder('<')
+    np.testing.assert_array_equal(decoded.read(2), band * 2)
+
+
+def test_raster_to_wkb_unsupported():
+    raster = RasterArray([np.ones((2, 2), dtype=np.int64)], Affine.identity(),
+                         26912, [None])
+    with pytest.raises(ValueError):
+        raster_to_wkb(raster)
+
+
+def test_raster_from_wkb_no_copy():
+    """
+    Test the bands are views of the buffer
+    """
+    wkb = make_raster_wkb([np.ones((3, 4))])
+    raster = raster_from_wkb(wkb)
+
+    assert np.shares_memory(raster.read(1), np.frombuffer(wkb, np.uint8))
+
+
+def test_raster_from_hex():
+    """
+    Test decoding the hex strings returned for the raster column
+    """
+    wkb = make_raster_wkb([np.ones((2, 2))], nodata=None)
+    raster = raster_from_wkb(RasterElement(wkb.hex()))
+
+    assert raster.nodata == [None]
+    assert raster.read(1).sum() == 4
+
+
+def test_to_rasterio():
+    """
+    Test the rasterio wrapper holds the data and georeferencing
+    """
+    band = np.arange(12, dtype=float).reshape(3, 4)
+    dataset = raster_from_wkb(make_raster_wkb([band])).to_rasterio()
+
+    np.testing.assert_array_equal(dataset.read(1), band)
+    assert dataset.crs.to_epsg() == 26912
+    assert dataset.nodata == -9999
+
+
+def test_raster_to_rasterio_tiff():
+    """
+    Test GeoTiffs remain readable after being returned
+    """
+    f = join(dirname(__file__), 'data', 'uavsar_latlon.amp1.real.tif')
+    with open(f, 'rb') as fp:
+        tif = fp.read()
+
+    dataset = raster_to_rasterio(None, [(memoryview(tif),)])[0]
+    assert dataset.read(1).shape == (dataset.height, dataset.width)
+
+
+def test_raster_to_rasterio_wkb():
+    """
+    Test raster WKB results are decoded natively
+    """
+    band = np.arange(12, dtype=float).reshape(3, 4)
+    dataset = raster_to_rasterio(None, [(make_raster_wkb([band]),)])[0]
+    np.testing.assert_array_equal(dataset.read(1), band)
+
+
+def test_mosaic_tiles():
+    """
+    Test assembling tiles into one array
+    """
+    grid, tiles = make_tiles()
+    raster = mosaic_tiles(tiles[::-1])
+
+    np.testing.assert_array_equal(raster.read(1), grid)
+    assert raster.transform.c == 743000
+    assert raster.transform.f == 4324500
+
+
+def test_mosaic_tiles_bbox():
+    """
+    Test the mosaic is limited to a bbox snapped to the grid
+    """
+    grid, tiles = make_tiles()
+    raster = mosaic_tiles(tiles, bbox=(743000.5, 4324497.5, 743002.5, 4324499))
+
+    np.testing.assert_array_equal(raster.read(1), grid[1:3, 0:3])
+    assert raster.bounds == (743000, 4324497, 743003, 4324499)
+
+
+def test_mosaic_tiles_gaps():
+    """
+    Test missing tiles and nodata pixels are left as nodata
+    """
+    grid, tiles = make_tiles()
+    tiles[0].bands[0] = np.array([[0, -9999], [4, 5]], dtype=float)
+    raster = mosaic_tiles(tiles[0:3])
+
+    assert raster.read(1)[0, 1] == -9999
+    assert raster.read(1)[3, 3] == -9999
+
+
+def test_mosaic_tiles_misaligned():
+    """
+    Test tiles off the grid are refused
+    """
+    from affine import Affine
+
+    grid, tiles = make_tiles()
+    tiles[1].transform = Affine(1, 0, 743002.5, 0, -1, 4324500)
+
+    with pytest.raises(ValueError):
+        mosaic_tiles(tiles)
+
+
+class TestLazyRaster:
+    """
+    Test slicing a lazy raster fetches and caches only what is needed
+    """
+
+    def setup_method(self):
+        self.grid, tiles = make_tiles()
+        self.tiles = dict(enumerate(tiles))
+        self.fetched = []
+        index = [(i, t.transform, t.width, t.height)
+                 for i, t in self.tiles.items()]
+        self.raster = LazyRaster(index, self.fetch,
+                                 cache=TileCache(max_bytes=64))
+
+    def fetch(self, ids):
+        self.fetched.append(sorted(ids))
+        return {i: self.tiles[i] for i in ids}
+
+    @pytest.mark.parametrize("key", [
+        (slice(None), slice(None)),
+        (slice(1, 3), slice(0, 2)),
+        (slice(None, None, 2), slice(3, 0, -1)),
+        (2, slice(None)),
+        (slice(None), -1),
+        (3, 3),
+        slice(1, 2)])
+    def test_getitem(self, key):
+        np.testing.assert_array_equal(self.raster[key], self.grid[key])
+
+    def test_only_touched_tiles(self):
+        self.raster[0:2, 2:4]
+        assert self.fetched == [[1]]
+
+    def test_cache_reuse(self):
+        self.raster[0, 0]
+        self.raster[1, 1]
+        assert self.fetched == [[0]]
+        assert self.raster.cache.hits == 1
+
+    def test_cache_eviction(self):
+        # Each tile is 32 bytes so only two fit
+        self.raster[:, :]
+        assert len(self.raster.cache) == 2
+        assert self.raster.cache.nbytes == 64
+
+        # The oldest tile was evicted so it is fetched again
+        self.raster[0, 0]
+        assert self.fetched == [[0, 1, 2, 3], [0]]
+        assert 0 in self.raster.cache
+
+    def test_window(self):
+        raster = self.raster.window((743001, 4324497, 743003, 4324499))
+        np.testing.assert_array_equal(raster.read(1), self.grid[1:3, 1:3])
+        assert raster.transform.c == 743001
+        assert raster.srid == 26912
+
+
+class FakeEngine:
+    """
+    Stands in for an engine, returns tiles for the ids bound in a statement
+    """
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.threads = set()
+        self.queries = 0
+
+    @contextmanager
+    def connect(self):
+        yield self
+
+    def execute(self, stmt):
+        import threading
+
+        self.threads.add(threading.get_ident())
+        self.queries += 1
+        ids = stmt.compile().params['id_1']
+        rows = []
+        for i in ids:
+            t = self.tiles[i].transform
+            rows.append((i, make_raster_wkb(self.tiles[i].bands, ul=(t.c, t.f))))
+        return type('Result', (), {'fetchall': lambda s: rows})()
+
+
+@pytest.mark.parametrize("max_workers, batch_size, expected_queries", [
+    (1, None, 4), (4, None, 4), (4, 1, 4), (2, 3, 2)])
+def test_fetch_tiles(max_workers, batch_size, expected_queries):
+    """
+    Test tiles are fetched in batches and decoded
+    """
+    grid, tiles = make_tiles()
+    engine = FakeEngine(dict(enumerate(tiles)))
+    fetched = fetch_tiles(engine, range(4), max_workers=max_workers,
+                          batch_size=batch_size)
+
+    assert engine.queries == expected_queries
+    assert sorted(fetched) == [0, 1, 2, 3]
+    np.testing.assert_array_equal(fetched[3].read(1), grid[2:4, 2:4])
+
+    raster = mosaic_tiles([fetched[i] for i in range(4)])
+    assert raster.read(1).shape == (4, 4)
+
+
+def test_fetch_tiles_empty():
+    assert fetch_tiles(FakeEngine({}), []) == {}
+
+
+class TestRasterAreaOnDB(DBSetup):
+    """
+    Test raster statistics and points of an area in the database against
+    the file
+    """
+    raster_f = join(dirname(__file__), 'data', 'be_gm1_0287', 'w001001x.adf')
+
+    # Pixel aligned box covering the bottom left 200 x 200 pixels
+    bbox = (743000, 4323500, 743100, 4323600)
+
+    def setup_class(self):
+        super().setup_class()
+        load_raster(self.engine, self.raster_f, epsg=26912, type='DEM',
+                    surveyors='USGS', units='meters')
+
+        with rasterio.open(self.raster_f) as ds:
+            self.values = ds.read(1, masked=True)[800:1000, 0:200].compressed()
+
+    @pytest.mark.parametrize('max_workers', [None, 3])
+    def test_get_raster_stats(self, max_workers):
+        stats = get_raster_stats(self.session, bbox=self.bbox, type='DEM',
+                                 max_workers=max_workers, batch_size=2)
+
+        assert stats.count == len(self.values)
+        assert stats.mean == pytest.approx(self.values.mean())
+        assert stats.std == pytest.approx(self.values.std(), rel=1e-4)
+        assert stats.min == pytest.approx(self.values.min())
+        assert stats.max == pytest.approx(self.values.max())
+
+    @pytest.mark.parametrize('range', [None, (3050, 3100)])
+    def test_get_raster_stats_histogram(self, range):
+        stats = get_raster_stats(self.session, bbox=self.bbox, type='DEM',
+                                 bins=10, range=range)
+        expected, edges = np.histogram(self.values, 10, range=range)
+
+        np.testing.assert_allclose(stats.edges, edges)
+        np.testing.assert_array_equal(stats.histogram, expected)
+        assert stats.outside == len(self.values) - expected.sum()
+
+    def test_get_raster_stats_other_srid(self):
+        stats = get_raster_stats(self.session, bbox=self.lonlat_bbox(),
+                                 srid=4326, type='DEM')
+        assert 0 < stats.count < 400 * 400
+
+    def test_get_raster_mosaic_other_srid(self):
+        raster = get_raster_mosaic(self.session, self.lonlat_bbox(), srid=4326,
+                                   type='DEM', strategy='client')
+        left, bottom, right, top = raster.bounds
+
+        assert raster.srid == 26912
+        assert 742990 <= left < right <= 743110
+        assert 4323490 <= bottom < top <= 4323610
+
+    def lonlat_bbox(self):
+        """
+        The bbox in lon/lat, shrunk a little so it stays inside the raster
+        """
+        to_lonlat = Transformer.from_crs(26912, 4326, always_xy=True)
+        xmin, ymin, xmax, ymax = self.bbox
+        lon0, lat0 = to_lonlat.transform(xmin + 5, ymin + 5)
+        lon1, lat1 = to_lonlat.transform(xmax - 5, ymax - 5)
+        return (lon0, lat0, lon1, lat1)
+
+    def test_get_raster_stats_polygon(self):
+        from shapely.geometry import box
+        stats = get_raster_stats(self.session, geom=box(*self.bbox))
+        assert stats.count == len(self.values)
+
+    def test_get_raster_stats_no_rasters(self):
+        stats = get_raster_stats(self.session, bbox=self.bbox, type='SWE')
+        assert stats.count == 0
+
+    @pytest.mark.parametrize('range', [None, (3050, 3100)])
+    def test_get_raster_stats_empty_area(self, range):
+        stats = get_raster_stats(self.session, bbox=(0, 0, 10, 10), type='DEM',
+                                 bins=10, range=range)
+
+        assert stats.count == 0
+        assert stats.edges is None
+        assert stats.histogram is None
+
+    @pytest.mark.parametrize('max_workers', [None, 2])
+    def test_get_raster_points(self, max_workers):
+        x, y, values = get_raster_points(self.session, bbox=self.bbox,
+                                         batch_size=1, max_workers=max_workers)
+
+        assert len(values) == len(self.values)
+        assert x.min() == 743000.25
+        assert y.max() == 4323599.75
+        np.testing.assert_array_equal(np.sort(values), np.sort(self.values))
+
+    def test_raster_to_geopandas(self):
+        df = raster_to_geopandas(self.session, bbox=self.bbox, type='DEM')
+
+        assert len(df) == len(self.values)
+        assert df.crs.to_epsg() == 26912
+        assert df['value'].mean() == pytest.approx(self.values.mean())
+
+    def test_raster_to_rasterio_wkb(self):
+        """
+        Test tiles queried as WKB decode to the same datasets as GeoTIFFs
+        """
+        qry = self.session.query(ImageData.id).order_by(ImageData.id)
+        tiffs = qry.with_entities(func.ST_AsTiff(ImageData.raster)).all()
+        wkbs = qry.with_entities(func.ST_AsBinary(ImageData.raster)).all()
+
+        assert len(wkbs) == len(tiffs) > 1
+        for wkb, tif in zip(raster_to_rasterio(self.session, wkbs),
+                            raster_to_rasterio(self.session, tiffs)):
+            np.testing.assert_array_equal(wkb.read(1), tif.read(1))
+            assert wkb.transform == tif.transform
+            assert wkb.crs == tif.crs
+
+    @pytest.mark.parametrize('chunksize', [2, 100])
+    def test_sample_rasters(self, chunksize):
+        with rasterio.open(self.raster_f) as ds:
+            grid = ds.read(1)
+
+        rows, cols = np.array([0, 10, 999, 500]), np.array([0, 20, 999, 3])
+        points = [Point(743000 + (c + 0.5) * 0.5, 4324000 - (r + 0.5) * 0.5)
+                  for r, c in zip(rows, cols)]
+        points.append(Point(0, 0))
+
+        dem, swe = sample_rasters(self.session, points, chunksize=chunksize,
+                                  selections=[dict(type='DEM'), dict(type='SWE')])
+
+        np.testing.assert_allclose(dem[:-1], grid[rows, cols])
+        assert np.isnan(dem[-1])
+        assert np.isnan(swe).all()
+
+    def test_sample_rasters_geodataframe(self):
+        df = gpd.GeoDataFrame(geometry=[Point(743000.25, 4323999.75)], crs=26912)
+        values = sample_rasters(self.session, df, type='DEM', surveyors='USGS')
+
+        assert values.shape == (1,)
+        assert not np.isnan(values[0])
+
+    def test_sample_rasters_other_crs(self):
+        df = gpd.GeoDataFrame(geometry=[Point(743000.25, 4323999.75)], crs=26912)
+        expected = sample_rasters(self.session, df, type='DEM')
+        received = sample_rasters(self.session, df.to_crs(4326), type='DEM')
+
+        np.testing.assert_allclose(received, expected)
+
+
+@pytest.mark.parametrize('range', [None, (0, 1)])
+def test_get_raster_stats_no_tiles(monkeypatch, range):
+    """
+    Test an area without tiles gives no histogram rather than NaN edges
+    """
+    from shapely.geometry import box
+
+    class Session:
+        def get_bind(self):
+            return None
+
+    monkeypatch.setattr('snowexsql.raster._tiles_in_area',
+                        lambda *args: (func.ST_GeomFromText('POINT(0 0)'), []))
+    stats = get_raster_stats(Session(), geom=box(0, 0, 1, 1), bins=10,
+                             range=range)
+
+    assert stats.count == 0
+    assert stats.edges is None
+    assert stats.histogram is None
+
+
+def test_sample_statement_transform():
+    """
+    Test points are only transformed for rasters in another srid
+    """
+    stmt = _sample_statement(np.array([-108.2]), np.array([39.0]), 4326,
+                             [(dict(type='DEM'), 26912), (dict(type='SWE'), 4326)], 1)
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+
+    assert sql.count('ST_Transform(') == 2
+    assert 'LATERAL' in sql
+
+
+@pytest.mark.parametrize('srid, transformed', [(None, False), (26912, False),
+                                               (4326, True)])
+def test_to_raster_srid(monkeypatch, srid, transformed):
+    """
+    Test an area is only transformed when it isn't in the raster srid
+    """
+    monkeypatch.setattr('snowexsql.raster._raster_srid',
+                        lambda session, filters: 26912)
+
+    area, received = _to_raster_srid(
+        None, lambda s: func.ST_MakeEnvelope(0, 0, 1, 1, s), srid, {})
+    sql = str(area.compile(dialect=postgresql.dialect(),
+                           compile_kwargs={'literal_binds': True}))
+
+    assert received == transformed
+    assert ('ST_Transform' in sql) == transformed
+    assert ('4326' in sql) == transformed
+
+
+def test_point_coordinates():
+    points = [Point(1, 2), Point(3, 4)]
+    x, y, epsg = _point_coordinates(points)
+    np.testing.assert_array_equal(x, [1, 3])
+    np.testing.assert_array_equal(y, [2, 4])
+    assert epsg is None
+
+    x, y, epsg = _point_coordinates(gpd.GeoDataFrame(geometry=points, crs=26912))
+    np.testing.assert_array_equal(x, [1, 3])
+    assert epsg == 26912
+
+    x, y, epsg = _point_coordinates([])
+    assert len(x) == 0
+
+
+def test_sample_rasters_no_points():
+    assert len(sample_rasters(None, [], srid=26912)) == 0
+
+
+def test_to_points():
+    """
+    Test pixel centers and values are extracted without the nodata pixels
+    """
+    grid = np.arange(6, dtype=np.float32).reshape(2, 3)
+    grid[0, 1] = -9999
+    grid[1, 2] = np.nan
+    raster = RasterArray([grid], Affine(2, 0, 100, 0, -2, 50), 26912, [-9999])
+
+    x, y, values = raster.to_points()
+
+    np.testing.assert_array_equal(values, [0, 2, 3, 4])
+    np.testing.assert_array_equal(x, [101, 105, 101, 103])
+    np.testing.assert_array_equal(y, [49, 49, 47, 47])
+
+
+@pytest.mark.parametrize('fn', [get_raster_stats, get_raster_points])
+def test_needs_an_area(fn):
+    with pytest.raises(ValueError):
+        fn(None)
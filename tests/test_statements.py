@@ -0,0 +1,291 @@
+from datetime import date
+
+import geoalchemy2
+import numpy as np
+import pytest
+from psycopg2 import errors
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from snowexsql.conversions import query_to_geopandas, query_to_pandas
+from snowexsql.data import ImageData, PointData
+from snowexsql.statements import *
+
+from .sql_test_base import DBSetup, make_point_records
+
+
+@pytest.fixture()
+def session():
+    return Session()
+
+
+@pytest.fixture()
+def dialect():
+    return create_engine('postgresql+psycopg2://user@localhost/test').dialect
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    clear_statements()
+
+
+def test_prepare_query_sql(session, dialect):
+    """
+    Test placeholders are numbered and typed
+    """
+    qry = session.query(PointData.id).filter(
+        PointData.type == 'depth', PointData.value > 10).limit(5)
+    prepared, params = prepare_query(qry, dialect)
+
+    assert '$1' in prepared.sql and '$3' in prepared.sql
+    assert '%' not in prepared.sql
+    assert prepared.types == ['VARCHAR(50)', 'INTEGER', 'INTEGER']
+    assert params == ['depth', 10, 5]
+    assert prepared.prepare_sql.startswith(
+        'PREPARE {} (VARCHAR(50), INTEGER, INTEGER) AS SELECT'.format(prepared.name))
+    assert prepared.execute_sql == 'EXECUTE {} (%s, %s, %s)'.format(prepared.name)
+
+
+def test_prepare_query_reused(session, dialect):
+    """
+    Test queries of the same shape share the compiled statement
+    """
+    first, params = prepare_query(
+        session.query(PointData.id).filter(PointData.type == 'depth'), dialect)
+    second, params = prepare_query(
+        session.query(PointData.id).filter(PointData.type == 'swe'), dialect)
+    other, _ = prepare_query(
+        session.query(PointData.value).filter(PointData.type == 'swe'), dialect)
+
+    assert second is first
+    assert params == ['swe']
+    assert other.name != first.name
+
+
+@pytest.mark.parametrize('negate, op', [(False, '= ANY ($1)'), (True, '<> ALL ($1)')])
+def test_prepare_query_in(session, dialect, negate, op):
+    """
+    Test IN lists become a single array parameter for any number of values
+    """
+    col = PointData.site_id
+    make = lambda v: session.query(PointData.id).filter(
+        ~col.in_(v) if negate else col.in_(v))
+
+    prepared, params = prepare_query(make(['1N20', '2N12']), dialect)
+    again, more = prepare_query(make(['1N20', '2N12', '5S31']), dialect)
+
+    assert op in prepared.sql
+    assert prepared.types == ['VARCHAR(50)[]']
+    assert again is prepared
+    assert params == [['1N20', '2N12']]
+    assert more == [['1N20', '2N12', '5S31']]
+
+
+def test_prepare_query_percent(session, dialect):
+    """
+    Test escaped percent signs are restored
+    """
+    prepared, _ = prepare_query(
+        session.query(PointData.id % 2), dialect)
+    assert '% $1' in prepared.sql
+
+
+def test_prepare_query_spatial(session, dialect):
+    """
+    Test queries with geometry and raster columns are cached by shape
+    """
+    make = lambda i: session.query(
+        func.ST_Value(ImageData.raster, 1, PointData.geom)).filter(
+        PointData.id == i, ImageData.type == 'DEM')
+
+    prepared, _ = prepare_query(make(1), dialect)
+    again, params = prepare_query(make(2), dialect)
+
+    assert again is prepared
+    assert params == [1, 2, 'DEM']
+
+
+def test_prepare_query_uncacheable(session, dialect):
+    """
+    Test queries with GeoAlchemy2's own types are compiled every time but
+    still share a prepared statement, without touching those types
+    """
+    make = lambda x: session.query(PointData.id).filter(
+        func.ST_Intersects(PointData.geom, func.ST_GeomFromEWKT(
+            'SRID=26912;POINT({} 4324000)'.format(x))))
+
+    prepared, _ = prepare_query(make(743000), dialect)
+    again, params = prepare_query(make(743001), dialect)
+
+    assert again is not prepared
+    assert again.name == prepared.name
+    assert params == ['SRID=26912;POINT(743001 4324000)']
+    assert not geoalchemy2.Geometry.cache_ok
+
+
+def test_prepare_query_processors(session, dialect):
+    """
+    Test bind processors are applied to the parameters
+    """
+    qry = session.query(PointData.id).filter(PointData.date == date(2020, 2, 1))
+    prepared, params = prepare_query(qry, dialect)
+
+    assert prepared.types == ['DATE']
+    assert params == [date(2020, 2, 1)]
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = [('id',)]
+
+    def execute(self, sql, params=None):
+        if self.conn.fail and sql.startswith('EXECUTE'):
+            self.conn.fail = False
+            raise errors.InvalidSqlStatementName()
+        if self.conn.duplicate and sql.startswith('PREPARE'):
+            self.conn.duplicate = False
+            raise errors.DuplicatePreparedStatement()
+        self.conn.executed.append(sql.split(' ')[0])
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.info = {}
+        self.executed = []
+        self.fail = False
+        self.duplicate = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeEngine:
+    def __init__(self, dialect):
+        self.dialect = dialect
+        self.conn = FakeConnection()
+
+    def raw_connection(self):
+        return self.conn
+
+
+def test_execute_prepared_once(session, dialect):
+    """
+    Test statements are prepared once per connection
+    """
+    engine = FakeEngine(dialect)
+
+    for v in ['depth', 'swe', 'density']:
+        names, rows = execute_prepared(
+            engine, session.query(PointData.id).filter(PointData.type == v))
+
+    assert names == ['id']
+    assert rows == [(1,)]
+    assert engine.conn.executed == ['PREPARE'] + ['EXECUTE'] * 3
+
+
+def test_execute_prepared_missing(session, dialect):
+    """
+    Test a statement dropped from the connection is prepared again
+    """
+    engine = FakeEngine(dialect)
+    qry = session.query(PointData.id)
+
+    execute_prepared(engine, qry)
+    engine.conn.fail = True
+    execute_prepared(engine, qry)
+
+    assert engine.conn.executed == ['PREPARE', 'EXECUTE', 'PREPARE', 'EXECUTE']
+
+
+def test_execute_prepared_missing_keeps_others(session, dialect):
+    """
+    Test only the missing statement is prepared again, the others on the
+    connection are still executed directly
+    """
+    engine = FakeEngine(dialect)
+    first, second = session.query(PointData.id), session.query(PointData.value)
+
+    execute_prepared(engine, first)
+    execute_prepared(engine, second)
+    engine.conn.fail = True
+    execute_prepared(engine, first)
+    execute_prepared(engine, second)
+
+    assert engine.conn.executed[4:] == ['PREPARE', 'EXECUTE', 'EXECUTE']
+
+
+def test_execute_prepared_duplicate(session, dialect):
+    """
+    Test a statement already prepared on the connection is executed
+    """
+    engine = FakeEngine(dialect)
+    engine.conn.duplicate = True
+    execute_prepared(engine, session.query(PointData.id))
+    execute_prepared(engine, session.query(PointData.id))
+
+    assert engine.conn.executed == ['EXECUTE', 'EXECUTE']
+
+
+def test_execute_prepared_deallocates(session, dialect, monkeypatch):
+    """
+    Test the least recently used statement is deallocated from a full
+    connection
+    """
+    monkeypatch.setattr('snowexsql.statements.MAX_STATEMENTS', 2)
+    engine = FakeEngine(dialect)
+    queries = [session.query(c) for c in [PointData.id, PointData.value,
+                                          PointData.type]]
+
+    for qry in [queries[0], queries[1], queries[0], queries[2]]:
+        execute_prepared(engine, qry)
+
+    assert engine.conn.executed == ['PREPARE', 'EXECUTE', 'PREPARE', 'EXECUTE',
+                                    'EXECUTE', 'DEALLOCATE', 'PREPARE', 'EXECUTE']
+    assert list(engine.conn.info[CONNECTION_KEY]) == [
+        prepare_query(q, dialect)[0].name for q in [queries[0], queries[2]]]
+
+
+class TestPreparedOnDB(DBSetup):
+    """
+    Test prepared reads match the normal read
+    """
+
+    def setup_class(self):
+        """
+        Setup the database one time for testing
+        """
+        super().setup_class()
+        self.session.add_all(make_point_records(10))
+        self.session.commit()
+
+    def test_query_to_pandas_prepared(self):
+        for v in [5, 2]:
+            qry = self.session.query(PointData.id, PointData.value).filter(
+                PointData.value > v).order_by(PointData.id)
+            expected = query_to_pandas(qry, self.engine)
+            df = query_to_pandas(qry, self.engine, prepared=True)
+
+            np.testing.assert_array_equal(df['id'], expected['id'])
+            np.testing.assert_array_equal(df['value'], expected['value'])
+
+    def test_query_to_geopandas_prepared(self):
+        qry = self.session.query(PointData).filter(
+            PointData.id.in_([1, 2, 3])).order_by(PointData.id)
+        df = query_to_geopandas(qry, self.engine, prepared=True)
+
+        assert len(df) == 3
+        assert df.crs.to_epsg() == 26912
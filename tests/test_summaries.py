@@ -0,0 +1,137 @@
+import re
+from datetime import date
+
+import numpy as np
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from snowexsql.data import LayerData, PointData
+from snowexsql.summaries import *
+from snowexsql.summaries import _written_since
+
+from .sql_test_base import DBSetup
+
+
+@pytest.mark.parametrize("value, expected", [
+    ('217.5', True), ('-3', True), ('.5', True), ('1e-3', True),
+    (' 42 ', True), ('4F', False), ('F', False), ('1.2.3', False), ('', False)])
+def test_number_pattern(value, expected):
+    assert bool(re.match(NUMBER_PATTERN, value)) == expected
+
+
+def test_summary_tables():
+    """
+    Test every dimension is stored with the aggregates needed to roll up
+    """
+    for name, (model, summary) in SUMMARIES.items():
+        columns = [c.name for c in summary.columns]
+        assert columns[:len(DIMENSIONS)] == DIMENSIONS
+        assert columns[len(DIMENSIONS):] == ['count', 'n', 'mean', 'm2', 'min', 'max']
+
+
+def test_written_since():
+    """
+    Test changed rows are found by the age of the transaction that wrote them
+    """
+    sql = str(_written_since(PointData, 5).compile(
+        dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+    assert sql == 'age(points.xmin) <= 5'
+
+
+class TestSummariesOnDB(DBSetup):
+    """
+    Test summaries match the data and refresh incrementally
+    """
+
+    def setup_class(self):
+        super().setup_class()
+
+        for i, v in enumerate([10, 20, 30, 40]):
+            self.session.add(PointData(type='depth', site_name='Grand Mesa',
+                                       date=date(2020, 1, 28 + i % 2),
+                                       instrument='magnaprobe', value=v))
+        for v in ['217.5', '4F', '250']:
+            self.session.add(LayerData(type='density', site_id='1N20',
+                                       date=date(2020, 2, 5), value=v))
+        self.session.commit()
+
+        refresh_summaries(self.engine, full=True)
+
+    def teardown_class(self):
+        summary_meta.drop_all(bind=self.engine)
+        super().teardown_class()
+
+    def test_summarize_matches_data(self):
+        summary = summarize(self.engine, by=['type', 'date'])
+        data = summarize(self.engine, by=['type', 'date'], use_summary=False)
+
+        assert summary['count'].tolist() == [2, 2]
+        np.testing.assert_allclose(summary[['mean', 'std', 'min', 'max']],
+                                   data[['mean', 'std', 'min', 'max']])
+
+    def test_summarize_layers_numeric_only(self):
+        df = summarize(self.engine, name='layers', type='density')
+
+        assert df['count'].iloc[0] == 3
+        assert df['mean'].iloc[0] == pytest.approx(233.75)
+
+    def test_refresh_incremental(self):
+        self.session.add(PointData(type='swe', site_name='Grand Mesa',
+                                   date=date(2020, 1, 28), value=5))
+        self.session.commit()
+
+        assert refresh_summary(self.engine, name='points') == 1
+
+        df = summarize(self.engine, by=['type'], type=['swe', 'depth'])
+        assert df['count'].tolist() == [4, 1]
+
+    def test_refresh_late_commit(self):
+        """
+        Test rows from a transaction that began before a refresh and
+        committed after it are picked up by the next refresh
+        """
+        late = self.engine.connect()
+        trans = late.begin()
+        late.execute(PointData.__table__.insert().values(
+            type='temperature', site_name='Grand Mesa', date=date(2020, 2, 1),
+            value=7))
+
+        refresh_summary(self.engine, name='points')
+        trans.commit()
+        late.close()
+
+        refresh_summary(self.engine, name='points')
+
+        df = summarize(self.engine, by=['type'], type='temperature')
+        assert df['count'].tolist() == [1]
+
+    def test_refresh_nothing_written(self):
+        refresh_summary(self.engine, name='points')
+        assert refresh_summary(self.engine, name='points') == 0
+
+    def test_summarize_large_offset(self):
+        """
+        Test the spread of values far from zero survives rolling up groups
+        """
+        values = 3000 + np.array([-0.01, 0.01, 0.005, -0.005, 0.002, 0.0])
+        for i, v in enumerate(values):
+            self.session.add(PointData(type='elevation', site_name='Grand Mesa',
+                                       date=date(2020, 2, 1 + i % 3), value=v))
+        self.session.commit()
+        refresh_summary(self.engine, name='points')
+
+        summary = summarize(self.engine, by=['type'], type='elevation')
+        data = summarize(self.engine, by=['type'], type='elevation',
+                         use_summary=False)
+
+        assert summary['std'].iloc[0] == pytest.approx(values.std(), rel=1e-6)
+        np.testing.assert_allclose(summary[['mean', 'std', 'min', 'max']],
+                                   data[['mean', 'std', 'min', 'max']],
+                                   rtol=1e-6)
+
+    def test_summarize_falls_back(self):
+        """
+        Test filters outside the summary are answered from the data
+        """
+        df = summarize(self.engine, by=['type'], equipment='none')
+        assert df.empty